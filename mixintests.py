@@ -54,6 +54,19 @@ class MixinTests(unittest.TestCase):
                   '-aaa', 'bbb', '-ccc', 'ddd', '-eee', 'fff', "-vf", "subtitles=subtitle.srt"]
         self.assertEqual(expect, options, "Output options mismatch (video)")
 
+    def test_command_template_cached(self):
+        config = self.get_setup()
+        profile = config.get_profile('profile1')
+        template = config.command_template(profile, ['mixin1'])
+        self.assertIs(template, config.command_template(profile, ['mixin1']), "template not reused")
+        self.assertIsNot(template, config.command_template(profile, ['mixin3']), "mixins must key the template")
+        # callers may extend the returned options without corrupting the cache
+        options = config.output_from_profile(profile, ['mixin1'])
+        options.append('-extra')
+        self.assertNotIn('-extra', config.output_from_profile(profile, ['mixin1']))
+        cli = template.build('in.mp4', 'out.mkv.tmp', ['-map', '0:0'])
+        self.assertEqual(['-y', '-i', 'in.mp4', *options[:-1], '-map', '0:0', 'out.mkv.tmp'], cli)
+
     def test_mixins_do_not_combine(self):
         config = self.get_setup()
         profile = config.get_profile('profile2')
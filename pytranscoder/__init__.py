@@ -6,10 +6,16 @@ __license__ = 'GPLv3'
 #
 # Global state indicators
 #
-from queue import Queue
+from pytranscoder.events import JobEvents
+from pytranscoder.status import StatusBoard
+from pytranscoder.timing import Timings
 
 verbose = False
 keep_source = False
 dry_run = False
+use_probe_cache = True
+full_log = False
 
-status_queue = Queue()
+job_events = JobEvents()
+status_board = StatusBoard()
+timings = Timings(job_events)
@@ -0,0 +1,142 @@
+"""
+    Holding back new encodes while the machine is short of cpu, memory or disk space
+"""
+import asyncio
+import os
+import shutil
+import sys
+import time
+from threading import Lock
+from typing import Dict, Any, Optional
+
+import crayons
+
+SETTINGS = ('max_load', 'min_memory', 'min_disk', 'interval')
+
+
+def available_memory_mb() -> Optional[float]:
+    """Memory available to new processes without swapping, None where it can't be told"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def load_average() -> Optional[float]:
+    try:
+        return os.getloadavg()[0]
+    except (OSError, AttributeError):
+        return None
+
+
+class AdmissionControl:
+    """Decides whether the machine has the headroom to start another encode.
+
+    Slots ask before starting each encoder and wait while the 1 minute load average is too high, or available
+    memory or free space on the output volume too low. Running encodes are left alone, and the configured number
+    of slots per queue remains the most that can run. While slots are waiting, at most one encode starts per
+    interval, giving the load average time to catch up with it before the next.
+    """
+
+    def __init__(self, max_load: Optional[float] = None, min_memory: Optional[int] = None,
+                 min_disk: Optional[int] = None, interval: float = 10):
+        """
+        :param max_load:    Highest 1 minute load average to start new encodes at
+        :param min_memory:  Available memory in MB needed to start an encode
+        :param min_disk:    Free space in MB needed on the volume the encode is written to
+        :param interval:    Seconds between checks while waiting
+        """
+        self.max_load = max_load
+        self.min_memory = min_memory
+        self.min_disk = min_disk
+        self.interval = interval
+        self._lock = Lock()
+        self._waiting = 0                       # slots held back, taking turns once there is room
+        self._started = 0.0                     # time.monotonic() of the last encode let through
+        self.paused: Optional[str] = None       # why new encodes are held back, if they are
+
+    @staticmethod
+    def from_config(settings: Optional[Dict[str, Any]]) -> Optional['AdmissionControl']:
+        """Build from the admission section of the configuration, None if there is none"""
+        if not settings:
+            return None
+        for name in settings:
+            if name not in SETTINGS:
+                print(f'Invalid admission setting "{name}", must be one of {", ".join(SETTINGS)}')
+                sys.exit(1)
+        control = AdmissionControl(**settings)
+        return control if control.enabled else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_load is not None or self.min_memory is not None or self.min_disk is not None
+
+    def pressure(self, path: str) -> Optional[str]:
+        """Reason not to start an encode writing to path now, None if there is room"""
+        if self.max_load is not None:
+            load = load_average()
+            if load is not None and load > self.max_load:
+                return f'load {load:.1f} above {self.max_load}'
+        if self.min_memory is not None:
+            memory = available_memory_mb()
+            if memory is not None and memory < self.min_memory:
+                return f'{memory:.0f} MB memory available, below {self.min_memory} MB'
+        if self.min_disk is not None:
+            try:
+                free = shutil.disk_usage(path).free / (1024 * 1024)
+            except OSError:
+                free = None
+            if free is not None and free < self.min_disk:
+                return f'{free:.0f} MB free on {path}, below {self.min_disk} MB'
+        return None
+
+    def check(self, path: str) -> bool:
+        """True if an encode writing to path may start, telling the user when starts pause and resume"""
+        reason = self.pressure(path)
+        with self._lock:
+            if reason is not None and self.paused is None:
+                print(crayons.yellow(f'Pausing new encodes: {reason}'))
+            elif reason is None and self.paused is not None:
+                print(crayons.green('Resuming encodes'))
+            self.paused = reason
+            if reason is not None:
+                return False
+            now = time.monotonic()
+            if self._waiting > 0 and now - self._started < self.interval:
+                # the last one let through doesn't show in the load average yet
+                return False
+            self._started = now
+        return True
+
+    def _wait(self, count: int):
+        with self._lock:
+            self._waiting += count
+
+    def admit(self, path: str):
+        """Wait until there is room to start an encode writing to path"""
+        if self.check(path):
+            return
+        self._wait(1)
+        try:
+            while True:
+                time.sleep(self.interval)
+                if self.check(path):
+                    return
+        finally:
+            self._wait(-1)
+
+    async def admit_async(self, path: str):
+        if self.check(path):
+            return
+        self._wait(1)
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                if self.check(path):
+                    return
+        finally:
+            self._wait(-1)
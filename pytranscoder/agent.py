@@ -0,0 +1,114 @@
+"""
+    Resident pytranscoder agent, started once per cluster host over ssh and kept running for all its jobs.
+
+    Reads one JSON request per line on stdin:
+        {"op": "run", "id": 1, "cmd": ["/usr/bin/ffmpeg", ...], "progress": true}
+        {"op": "kill", "id": 1}
+    and writes one JSON record per line to stdout, each tagged with the id of its job:
+        {"id": 1, "event": "started", "pid": 1234}
+        {"id": 1, "event": "progress", "stats": {"frame": "100", "fps": "25.0", ...}}
+        {"id": 1, "event": "output", "line": "..."}
+        {"id": 1, "event": "exit", "code": 0}
+    With "progress" the encoder is expected to write ffmpeg -progress blocks to stdout, which are sent as
+    progress records, and its console output (stderr) as output records. Without, all output is sent as is.
+
+    A {"event": "ready"} record is written once the agent is up. Closing stdin stops the agent and any job
+    still running. Uses the standard library only, so any host with Python 3 can run it.
+"""
+import json
+import subprocess
+import sys
+import threading
+
+VERSION = 1
+
+
+class Agent:
+
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.jobs = dict()
+        self.lock = threading.Lock()
+
+    def send(self, record: dict):
+        with self.lock:
+            try:
+                self.output.write(json.dumps(record) + '\n')
+                self.output.flush()
+            except OSError:
+                # client went away
+                pass
+
+    def run(self, job_id, cmd, progress: bool):
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE if progress else subprocess.STDOUT,
+                                    universal_newlines=True, errors='replace')
+        except OSError as ex:
+            self.send({'id': job_id, 'event': 'output', 'line': str(ex) + '\n'})
+            self.send({'id': job_id, 'event': 'exit', 'code': 127})
+            return
+        with self.lock:
+            self.jobs[job_id] = proc
+        self.send({'id': job_id, 'event': 'started', 'pid': proc.pid})
+        readers = [threading.Thread(target=self.read_progress if progress else self.read_output,
+                                    args=(job_id, proc.stdout), daemon=True)]
+        if progress:
+            readers.append(threading.Thread(target=self.read_output, args=(job_id, proc.stderr), daemon=True))
+        for reader in readers:
+            reader.start()
+        threading.Thread(target=self.wait, args=(job_id, proc, readers), daemon=True).start()
+
+    def read_output(self, job_id, stream):
+        for line in stream:
+            self.send({'id': job_id, 'event': 'output', 'line': line})
+
+    def read_progress(self, job_id, stream):
+        block = dict()
+        for line in stream:
+            key, sep, value = line.strip().partition('=')
+            if not sep:
+                continue
+            if key != 'progress':
+                block[key] = value
+                continue
+            # "progress" closes each block
+            if value != 'end':
+                self.send({'id': job_id, 'event': 'progress', 'stats': block})
+            block = dict()
+
+    def wait(self, job_id, proc, readers):
+        for reader in readers:
+            reader.join()
+        code = proc.wait()
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        self.send({'id': job_id, 'event': 'exit', 'code': code})
+
+    def kill(self, job_id):
+        with self.lock:
+            proc = self.jobs.get(job_id, None)
+        if proc is not None:
+            proc.kill()
+
+    def serve(self, requests=sys.stdin):
+        self.send({'event': 'ready', 'version': VERSION})
+        for line in requests:
+            try:
+                request = json.loads(line)
+            except ValueError:
+                continue
+            if request.get('op') == 'run':
+                self.run(request['id'], request['cmd'], request.get('progress', False))
+            elif request.get('op') == 'kill':
+                self.kill(request['id'])
+        # client went away, take the jobs along
+        with self.lock:
+            running = list(self.jobs.values())
+        for proc in running:
+            proc.kill()
+            proc.wait()
+
+
+if __name__ == '__main__':
+    Agent().serve()
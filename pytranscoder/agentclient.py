@@ -0,0 +1,187 @@
+"""
+    Talking to the resident agents on cluster hosts
+"""
+import itertools
+import json
+import queue
+import shlex
+import subprocess
+from threading import Lock, Thread
+from typing import Dict, List, Optional, Any, Callable
+
+from pytranscoder import agent
+
+
+def agent_command(python: str) -> List[str]:
+    """Remote command starting the agent, which is sent along with it so nothing needs installing on the host"""
+    with open(agent.__file__) as f:
+        source = f.read()
+    return [python, '-u', '-c', shlex.quote(source)]
+
+
+class AgentJob:
+    """One encoder run by an agent, giving the records sent back for it as they come in"""
+
+    def __init__(self, client: 'AgentClient', job_id: int, deliver: Optional[Callable[[Dict], None]] = None):
+        """
+        :param deliver: Called with each record instead of queueing it for iteration, from the reader thread
+        """
+        self.client = client
+        self.id = job_id
+        self.records: queue.Queue = queue.Queue()
+        self.deliver = deliver or self.records.put
+        self.proc: Optional[subprocess.Popen] = None     # agent running the job
+
+    def __iter__(self):
+        """Records of the job, the last one always being its exit"""
+        while True:
+            record = self.records.get()
+            yield record
+            if record['event'] == 'exit':
+                return
+
+    def kill(self):
+        self.client.send({'op': 'kill', 'id': self.id}, self.proc)
+
+
+class AgentClient:
+    """The connection to the agent on one host, shared by all slots of the host.
+
+    The agent is started on first use and again if it went away, like when the connection dropped. Jobs
+    running when that happens end with exit code 255, same as ssh reports a lost connection.
+    """
+
+    # seconds to wait for a new agent to be up
+    START_TIMEOUT = 30
+
+    def __init__(self, command: List[str]):
+        """
+        :param command: Command line starting the agent, typically ssh to the host followed by agent_command()
+        """
+        self.command = command
+        self.proc: Optional[subprocess.Popen] = None
+        self.jobs: Dict[int, AgentJob] = dict()
+        self._ids = itertools.count(1)
+        self._lock = Lock()                 # guards proc, jobs and writing requests
+        self._start_lock = Lock()           # one start at a time, without holding up the readers
+        self._running = set()               # agents up and not yet seen to exit
+
+    def start(self) -> bool:
+        """Make sure the agent is running, starting it if needed. False if it could not be started"""
+        with self._start_lock:
+            with self._lock:
+                if self.proc in self._running and self.proc.poll() is None:
+                    return True
+            try:
+                proc = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, universal_newlines=True)
+            except OSError:
+                return False
+            with self._lock:
+                self.proc = proc
+                self._running.add(proc)
+            ready = queue.Queue()
+            Thread(target=self._read, args=(proc, ready), daemon=True).start()
+            try:
+                if ready.get(timeout=AgentClient.START_TIMEOUT):
+                    return True
+            except queue.Empty:
+                pass
+            proc.kill()
+            return False
+
+    def _read(self, proc: subprocess.Popen, ready: queue.Queue):
+        """Pass the records of the agent on to their jobs"""
+        for line in proc.stdout:
+            try:
+                record: Dict[str, Any] = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('event') == 'ready':
+                ready.put(True)
+                continue
+            with self._lock:
+                job = self.jobs.get(record.get('id'), None)
+                if job is not None and record['event'] == 'exit':
+                    del self.jobs[job.id]
+            if job is not None:
+                job.deliver(record)
+        ready.put(False)
+        proc.wait()
+        # agent is gone, and so are the jobs it was running
+        with self._lock:
+            self._running.discard(proc)
+            if self.proc is proc:
+                self.proc = None
+            lost = [job for job in self.jobs.values() if job.proc is proc]
+            for job in lost:
+                del self.jobs[job.id]
+        for job in lost:
+            job.deliver({'id': job.id, 'event': 'exit', 'code': 255})
+
+    def send(self, request: Dict[str, Any], proc: Optional[subprocess.Popen] = None):
+        """Write a request to an agent, the current one if not given"""
+        with self._lock:
+            self._send(request, proc or self.proc)
+
+    @staticmethod
+    def _send(request: Dict[str, Any], proc: Optional[subprocess.Popen]):
+        try:
+            proc.stdin.write(json.dumps(request) + '\n')
+            proc.stdin.flush()
+        except (OSError, AttributeError, ValueError):
+            # agent gone, its reader ends the jobs
+            pass
+
+    def run(self, cmd: List[str], progress: bool = False,
+            deliver: Optional[Callable[[Dict], None]] = None) -> AgentJob:
+        """Start an encoder on the host
+
+        :param progress:    The encoder writes ffmpeg -progress blocks to stdout, to be sent as progress records
+        :param deliver:     Where to pass the records of the job, instead of iterating over it
+        """
+        job = AgentJob(self, next(self._ids), deliver)
+        self.start()
+        with self._lock:
+            # the agent may have gone again already, in which case its reader ended the jobs it had
+            if self.proc is None or self.proc not in self._running:
+                job.deliver({'id': job.id, 'event': 'exit', 'code': 255})
+                return job
+            job.proc = self.proc
+            self.jobs[job.id] = job
+            self._send({'op': 'run', 'id': job.id, 'cmd': cmd, 'progress': progress}, job.proc)
+        return job
+
+    def close(self):
+        """Stop the agent, which takes any job still running along"""
+        with self._lock:
+            proc, self.proc = self.proc, None
+        if proc is not None and proc.poll() is None:
+            proc.stdin.close()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+class AgentPool:
+    """The agents of all hosts of a run, one per host however many slots use it"""
+
+    def __init__(self):
+        self.clients: Dict[str, AgentClient] = dict()
+        self._lock = Lock()
+
+    def get(self, name: str, command: Callable[[], List[str]]) -> AgentClient:
+        """
+        :param command: Makes the command line starting the agent, called the first time the host is used
+        """
+        with self._lock:
+            if name not in self.clients:
+                self.clients[name] = AgentClient(command())
+            return self.clients[name]
+
+    def close(self):
+        with self._lock:
+            for client in self.clients.values():
+                client.close()
+            self.clients.clear()
@@ -3,26 +3,38 @@
 """
 import datetime
 import os
+import shlex
 import shutil
 import subprocess
 import sys
+import time
 from pathlib import PureWindowsPath, PosixPath
-from queue import Queue, Empty
 from tempfile import gettempdir
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread, Lock
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Callable
 
 import crayons
 
 import pytranscoder
 
 from pytranscoder import verbose
+from pytranscoder.agentclient import AgentClient, AgentPool, agent_command
 from pytranscoder.config import ConfigFile
-from pytranscoder.ffmpeg import FFmpeg
+from pytranscoder.events import file_size
+from pytranscoder.ffmpeg import FFmpeg, pipe_output_options, streamable_source
 from pytranscoder.handbrake import Handbrake
+from pytranscoder.jobqueue import JobQueue, job_order
 from pytranscoder.media import MediaInfo
-from pytranscoder.processor import Processor
+from pytranscoder.predict import SpeedHistory, batch_estimate
+from pytranscoder.probe import MediaProbe
+from pytranscoder.processor import Processor, Encode, ResourceUsage
+from pytranscoder.prefetch import Prefetcher
 from pytranscoder.profile import Profile
+from pytranscoder.sshpool import SshConnection, SshPool
+from pytranscoder.status import StatusRenderer
+from pytranscoder.transfer import ResumableTransfer, TRANSFERS
+from pytranscoder.supervisor import Supervisor
 from pytranscoder.utils import filter_threshold, get_local_os_type, calculate_progress, run
 
 
@@ -54,6 +66,26 @@ class RemoteHostProperties:
     def working_dir(self):
         return self.props.get('working_dir', None)
 
+    @property
+    def prefetch(self) -> int:
+        return int(self.props.get('prefetch', 0))
+
+    @property
+    def pipe(self) -> bool:
+        return self.props.get('pipe', False)
+
+    @property
+    def transfer(self) -> str:
+        return self.props.get('transfer', 'scp')
+
+    @property
+    def agent(self) -> bool:
+        return self.props.get('agent', False)
+
+    @property
+    def python_path(self) -> str:
+        return self.props.get('python', 'python3')
+
     @property
     def host_type(self):
         return self.props['type']
@@ -69,7 +101,7 @@ class RemoteHostProperties:
 
     def get_processor_by_name(self, name: str) -> Processor:
         if name == 'ffmpeg':
-            return FFmpeg(self.ffmpeg_path)
+            return FFmpeg(self.ffmpeg_path, self.ffmpeg_progress)
         if self.hbcli_path:
             return Handbrake(self.hbcli_path)
         print(f'Unknown processor type "{name}" for host "{self.name}"')
@@ -79,6 +111,10 @@ class RemoteHostProperties:
     def ffmpeg_path(self):
         return self.props.get('ffmpeg', None)
 
+    @property
+    def ffmpeg_progress(self) -> bool:
+        return self.props.get('ffmpeg_progress', False)
+
     @property
     def hbcli_path(self):
         return self.props.get('hbcli', None)
@@ -141,8 +177,14 @@ class RemoteHostProperties:
             if 'os' in self.props:
                 _os = self.props['os']
                 _os in ['macos', 'linux', 'win10'] or msg.append(f'Unsupported "os" type {_os}')
+            if self.agent and self.is_windows():
+                msg.append('"agent" not supported on Windows hosts')
         if self.props['type'] == 'streaming':
             'working_dir' in self.props or msg.append(f'Missing "working_dir"')
+            _transfer = self.transfer
+            _transfer in TRANSFERS or msg.append(f'Unsupported "transfer" type {_transfer}')
+            if _transfer == 'resumable' and self.is_windows():
+                msg.append('"resumable" transfer not supported on Windows hosts')
         if len(msg) > 0:
             print(f'Validation error(s) for host {self.name}:')
             print('\n'.join(msg))
@@ -156,11 +198,20 @@ class EncodeJob:
     media_info: MediaInfo
     profile_name: str
 
-    def __init__(self, inpath: str, info: MediaInfo, profile_name: str, mixins: List[str]):
+    def __init__(self, inpath: str, info: MediaInfo, profile_name: str, mixins: List[str], queue: str = '_default',
+                 priority: int = 0):
         self.inpath = os.path.abspath(inpath)
         self.media_info = info
         self.profile_name = profile_name
         self.mixins = mixins
+        self.queue = queue
+        self.priority = priority
+        self.queued = time.monotonic()
+        self.uploaded = False
+
+    @property
+    def work(self) -> float:
+        return self.media_info.work
 
 
 class ManagedHost(Thread):
@@ -179,6 +230,7 @@ class ManagedHost(Thread):
         self.hostname = hostname
         self.props = props
         self.queue = queue
+        self.source_queue = queue       # the cluster queue, self.queue may be a view on it
         self._complete = list()
         self._manager = cluster
 #        self.ffmpeg = FFmpeg(props.ffmpeg_path)
@@ -195,8 +247,8 @@ class ManagedHost(Thread):
     def configfile(self) -> ConfigFile:
         return self._manager.config
 
-    def complete(self, source, elapsed=0):
-        self._complete.append((source, elapsed))
+    def complete(self, source, elapsed=0, usage: Optional[ResourceUsage] = None):
+        self._complete.append((source, elapsed, usage))
 
     @property
     def completed(self) -> List:
@@ -220,8 +272,20 @@ class ManagedHost(Thread):
         else:
             return str(PosixPath(path))
 
+    @property
+    def connection(self) -> SshConnection:
+        return self._manager.connections.get(self.props.user, self.props.ip)
+
     def ssh_cmd(self):
-        return [self._manager.ssh, self.props.user + '@' + self.props.ip]
+        return self.connection.command()
+
+    @property
+    def agent(self) -> Optional[AgentClient]:
+        """Resident agent on the host to run encoders, None to start each over ssh"""
+        if not self.props.agent:
+            return None
+        return self._manager.agents.get(self.hostname,
+                                        lambda: [*self.ssh_cmd(), *agent_command(self.props.python_path)])
 
     def ping_test_ok(self):
         addr = self.props.ip
@@ -260,9 +324,58 @@ class ManagedHost(Thread):
                 self.log(p.stderr)
         return p
 
+    def ready(self) -> bool:
+        """Check the host can be used before taking any work"""
+        return self.host_ok()
+
+    def prepare(self, job: EncodeJob) -> Optional[Encode]:
+        """Get a job ready to encode on this host, or None if there is nothing to run"""
+        return None
+
+    def drain(self):
+        """Wait for any work still going on in the background once the queue is done"""
+        pass
+
+    def go(self):
+        #
+        # Keep pulling items from the queue until done. Other threads will be pulling from the same queue
+        # if multiple hosts configured on the same cluster.
+        #
+        while True:
+            job: EncodeJob = self.queue.get()
+            if job is None:
+                # queue closed and drained, all done
+                break
+            try:
+                encode = self.prepare(job)
+                if encode is not None:
+                    encode.finish(encode.run())
+            except Exception as ex:
+                self.failed(job, ex)
+            finally:
+                self.queue.task_done()
+        self.drain()
+
+    def failed(self, job: EncodeJob, ex: Exception):
+        """Handling the job raised an exception, it gets no further"""
+        self.log(ex)
+        pytranscoder.job_events.emit('failed', path=job.inpath, queue=job.queue, host=self.hostname, code=None,
+                                     reason='error')
+
+    def print_estimate(self, profile: Profile, job: EncodeJob):
+        """Show the expected encode time on this host, if there is history to go on"""
+        if self._manager.history is not None:
+            estimate = self._manager.history.describe(profile.name, job.media_info, self.hostname)
+            if estimate is not None:
+                print(f'Estimate : {estimate}')
+
     def match_profile(self, job: EncodeJob, name: str) -> Optional[Profile]:
         if job.profile_name is None:
-            rule = self.configfile.match_rule(job.media_info, restrict_profiles=self.props.profiles)
+            with pytranscoder.timings.measure(job.inpath, 'match'):
+                rule = self.configfile.match_rule(job.media_info, restrict_profiles=self.props.profiles)
+            pytranscoder.job_events.emit('matched', path=job.inpath, host=self.hostname,
+                                         rule=rule.name if rule else None, profile=rule.profile if rule else None,
+                                         skip=rule is None)
             if rule is None:
                 self.log(crayons.yellow(
                     f'Failed to match rule/profile for host {name} for file {job.inpath} - skipped'))
@@ -274,8 +387,13 @@ class ManagedHost(Thread):
 class StreamingManagedHost(ManagedHost):
     """Implementation of a streaming host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue, cluster):
+    def __init__(self, hostname, props: RemoteHostProperties, queue: JobQueue, cluster):
         super().__init__(hostname, props, queue, cluster)
+        self.retriever: Optional[ThreadPoolExecutor] = None
+        if props.prefetch > 0 and not pytranscoder.dry_run:
+            # upload the next sources while encoding, and retrieve results while the next one encodes
+            self.queue = Prefetcher(queue, self.stage, props.prefetch, self.has_room)
+            self.retriever = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{hostname}-retrieve')
 
     #
     # initiate tests through here to avoid a new thread
@@ -290,180 +408,293 @@ class StreamingManagedHost(ManagedHost):
         if self.host_ok():
             self.go()
 
-    def go(self):
+    def drain(self):
+        if self.retriever is not None:
+            self.retriever.shutdown(wait=True)
 
-        ssh_cmd = [self._manager.ssh, self.props.user + '@' + self.props.ip]
+    @staticmethod
+    def source_path(job: EncodeJob) -> str:
+        # Convert escaped spaces back to normal. Typical for bash to escape spaces and special characters
+        # in filenames.
+        return job.inpath.replace('\\ ', ' ')
 
-        #
-        # Keep pulling items from the queue until done. Other threads will be pulling from the same queue
-        # if multiple hosts configured on the same cluster.
-        #
-        while not self.queue.empty():
+    def remote_source_path(self, job: EncodeJob) -> str:
+        return os.path.join(self.props.working_dir, os.path.basename(self.source_path(job)))
+
+    def remote_free_space(self) -> Optional[int]:
+        """Bytes free in the remote working directory, None if that can't be told"""
+        if self.props.is_windows():
+            return None
+        try:
+            df = subprocess.run([*self.ssh_cmd(), 'df', '-Pk', shlex.quote(self.props.working_dir)],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=30)
+            if df.returncode != 0:
+                return None
+            return int(df.stdout.strip().splitlines()[-1].split()[3]) * 1024
+        except (subprocess.TimeoutExpired, ValueError, IndexError):
+            return None
+
+    def has_room(self, job: EncodeJob) -> bool:
+        """Whether the remote working directory can take the source and the encoded result of a job"""
+        profile = self.match_profile(job, self.name)
+        if profile is None or self.pipe_options(job, profile) is not None:
+            # nothing to copy
+            return True
+        free = self.remote_free_space()
+        return free is None or free >= 2 * file_size(self.source_path(job))
+
+    def stage(self, job: EncodeJob) -> bool:
+        """Match and upload a job ahead of its encode, when prefetching"""
+        profile = self.match_profile(job, self.name)
+        if profile is None:
+            return False
+        return self.pipe_options(job, profile) is not None or self.upload(job)
+
+    def pipe_options(self, job: EncodeJob, profile: Profile) -> Optional[List[str]]:
+        """Output options to stream a job through the ssh connection, None if it has to be copied over instead"""
+        if not self.props.pipe or self.props.is_windows() or not profile.is_ffmpeg:
+            return None
+        inpath = self.source_path(job)
+        if not streamable_source(inpath):
+            return None
+        template = self._manager.config.command_template(profile, job.mixins)
+        extension = profile.get('extension') or os.path.splitext(inpath)[1]
+        return pipe_output_options(template.output_options, extension)
+
+    @property
+    def transfer(self) -> Optional[ResumableTransfer]:
+        """Copies media to and from the host, None to use plain scp"""
+        if self.props.transfer != 'resumable':
+            return None
+        return ResumableTransfer(self.connection, self.configfile.bandwidth)
+
+    def upload(self, job: EncodeJob) -> bool:
+        """Copy the source of a job to the remote working directory"""
+        inpath = self.source_path(job)
+        transfer = self.transfer
+        if transfer is not None:
+            remote_inpath = self.remote_source_path(job)
+            self.log(f'copying {inpath} to {self.connection.remote(remote_inpath)}')
+            with pytranscoder.timings.measure(inpath, 'upload'):
+                code, output = transfer.upload(inpath, remote_inpath)
+        else:
+            target_dir = self.props.working_dir
+            if self.props.is_windows():
+                # trick to make scp work on the Windows side
+                target_dir = '/' + target_dir
+
+            scp = self.connection.scp(inpath, self.connection.remote(target_dir))
+            self.log(' '.join(scp))
+
+            with pytranscoder.timings.measure(inpath, 'upload'):
+                code, output = run(scp)
+        if code != 0:
+            self.log(crayons.red('Unknown error copying source to remote - media skipped'))
+            pytranscoder.job_events.emit('failed', path=job.inpath, queue=job.queue, host=self.hostname, code=code,
+                                         reason='upload')
+            if self._manager.verbose:
+                self.log(output)
+            return False
+        job.uploaded = True
+        return True
+
+    def in_background(self, finish: Callable[[Optional[int], datetime.timedelta], None]) -> Callable:
+        """Have the retriever run the wrap up of a job, so the slot can go on with the next encode"""
+        def guarded(code: Optional[int], elapsed: datetime.timedelta):
             try:
-                job: EncodeJob = self.queue.get()
-                inpath = job.inpath
+                finish(code, elapsed)
+            except Exception as ex:
+                self.log(ex)
+            finally:
+                # the result is in, so the staging of the next sources may count on its room
+                self.queue.finished()
 
-                #
-                # Convert escaped spaces back to normal. Typical for bash to escape spaces and special characters
-                # in filenames.
-                #
-                inpath = inpath.replace('\\ ', ' ')
+        def submit(code: Optional[int], elapsed: datetime.timedelta):
+            self.queue.finishing()
+            self.retriever.submit(guarded, code, elapsed)
 
-                #
-                # Got to do the rule matching again.
-                # This time we narrow down the available profiles based on host definition
-                #
-                _profile: Profile = self.match_profile(job, self.name)
-                if _profile is None:
-                    continue
+        return submit
 
-                #
-                # calculate full input and output paths
-                #
-                remote_working_dir = self.props.working_dir
-                remote_inpath = os.path.join(remote_working_dir, os.path.basename(inpath))
-                remote_outpath = os.path.join(remote_working_dir, os.path.basename(inpath) + '.tmp')
+    def prepare(self, job: EncodeJob) -> Optional[Encode]:
+        pytranscoder.timings.record(job.inpath, 'queue', time.monotonic() - job.queued)
+        events = pytranscoder.job_events
+        events.emit('dispatched', path=job.inpath, queue=job.queue, host=self.hostname)
+        ssh_cmd = self.ssh_cmd()
 
-                #
-                # build remote commandline
-                #
-                oinput = _profile.input_options.as_shell_params()
-                ooutput = self._manager.config.output_from_profile(_profile, job.mixins)
-#                ooutput = _profile.output_options.as_shell_params()
-
-                processor = self.props.get_processor_by_name(_profile.processor)
-                if _profile.is_ffmpeg:
-                    if job.media_info.is_multistream() and self.configfile.automap and _profile.automap:
-                        ooutput = ooutput + job.media_info.ffmpeg_streams(_profile)
-                    cmd = ['-y', *oinput, '-i', self.converted_path(remote_inpath),
-                           *ooutput, self.converted_path(remote_outpath)]
-                else:
-                    cmd = ['-i', self.converted_path(remote_inpath), *oinput,
-                           *ooutput, '-o', self.converted_path(remote_outpath)]
-
-                cli = [*ssh_cmd, *cmd]
+        inpath = self.source_path(job)
 
-                #
-                # display useful information
-                #
-                self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
-                try:
-                    print('-' * 40)
-                    print(f'Host     : {self.hostname} (streaming)')
-                    print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
-                    print(f'Profile  : {job.profile_name}')
-                    print('ssh      : ' + ' '.join(cli) + '\n')
-                finally:
-                    self.lock.release()
+        #
+        # Got to do the rule matching again.
+        # This time we narrow down the available profiles based on host definition
+        #
+        _profile: Profile = self.match_profile(job, self.name)
+        if _profile is None:
+            return None
 
-                if pytranscoder.dry_run:
-                    continue
+        #
+        # calculate full input and output paths
+        #
+        remote_inpath = self.remote_source_path(job)
+        remote_outpath = remote_inpath + '.tmp'
+        local_outpath = os.path.join(gettempdir(), os.path.basename(remote_outpath))
 
-                #
-                # Copy source file to remote
-                #
-                target_dir = remote_working_dir
-                if self.props.is_windows():
-                    # trick to make scp work on the Windows side
-                    target_dir = '/' + remote_working_dir
+        #
+        # build remote commandline
+        #
+        template = self._manager.config.command_template(_profile, job.mixins)
+
+        processor = self.props.get_processor_by_name(_profile.processor)
+        streams = None
+        if _profile.is_ffmpeg:
+            if job.media_info.is_multistream() and self.configfile.automap and _profile.automap:
+                streams = job.media_info.ffmpeg_streams(_profile)
+        pipe = self.pipe_options(job, _profile)
+        if pipe is not None:
+            # media goes through the ssh connection, read from stdin and written to stdout
+            cmd = template.build('pipe:0', 'pipe:1', streams)
+            cmd = [*cmd[:-1], *pipe, cmd[-1]]
+        else:
+            cmd = template.build(self.converted_path(remote_inpath), self.converted_path(remote_outpath), streams)
 
-                scp = ['scp', inpath, self.props.user + '@' + self.props.ip + ':' + target_dir]
-                self.log(' '.join(scp))
+        cli = [*ssh_cmd, *cmd]
 
-                code, output = run(scp)
-                if code != 0:
-                    self.log(crayons.red('Unknown error copying source to remote - media skipped'))
-                    if self._manager.verbose:
-                        self.log(output)
-                    continue
-
-                basename = os.path.basename(job.inpath)
-
-                def log_callback(stats):
-                    pct_done, pct_comp = calculate_progress(job.media_info, stats)
-                    pytranscoder.status_queue.put({ 'host': self.hostname,
-                                                    'file': basename,
-                                                    'speed': stats['speed'],
-                                                    'comp': pct_comp,
-                                                    'done': pct_done})
-#                    self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
-                    if _profile.threshold_check < 100:
-                        if pct_done >= _profile.threshold_check and pct_comp < _profile.threshold:
-                            # compression goal (threshold) not met, kill the job and waste no more time...
-                            self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
-                            return True
-                    # continue
-                    return False
-
-                def hb_log_callback(stats):
-                    self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
-                    return False
+        #
+        # display useful information
+        #
+        self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
+        try:
+            print('-' * 40)
+            print(f'Host     : {self.hostname} (streaming{", piped" if pipe is not None else ""})')
+            print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
+            print(f'Profile  : {job.profile_name}')
+            self.print_estimate(_profile, job)
+            print('ssh      : ' + ' '.join(cli) + '\n')
+        finally:
+            self.lock.release()
 
-                #
-                # Start remote
-                #
-                job_start = datetime.datetime.now()
-                if processor.is_ffmpeg():
-                    code = processor.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd, log_callback)
-                else:
-                    code = processor.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd, hb_log_callback)
-                job_stop = datetime.datetime.now()
+        if pytranscoder.dry_run:
+            events.emit('planned', path=job.inpath, queue=job.queue, host=self.hostname, profile=_profile.name,
+                        mixins=job.mixins)
+            return None
+
+        #
+        # Copy source file to remote, unless done ahead already or piped
+        #
+        if pipe is None and not job.uploaded and not self.upload(job):
+            return None
+
+        basename = os.path.basename(job.inpath)
+
+        def log_callback(stats):
+            pct_done, pct_comp = calculate_progress(job.media_info, stats)
+            pytranscoder.status_board.put({'host': self.hostname,
+                                           'file': basename,
+                                           'speed': stats['speed'],
+                                           'comp': pct_comp,
+                                           'done': pct_done})
+            events.emit('progress', path=job.inpath, host=self.hostname, fps=stats['fps'], speed=stats['speed'],
+                        size=stats['size'], done=pct_done, comp=pct_comp)
+#            self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
+            if _profile.threshold_check < 100:
+                if pct_done >= _profile.threshold_check and pct_comp < _profile.threshold:
+                    # compression goal (threshold) not met, kill the job and waste no more time...
+                    self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
+                    return True
+            # continue
+            return False
 
-                if code != 0:
-                    self.log(crayons.red('Unknown error encoding on remote'))
-                    continue
+        def hb_log_callback(stats):
+            self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
+            events.emit('progress', path=job.inpath, host=self.hostname, fps=stats['fps'])
+            return False
 
-                #
-                # copy results back to local
-                #
-                retrieved_copy_name = os.path.join(gettempdir(), os.path.basename(remote_outpath))
-                cmd = ['scp', self.props.user + '@' + self.props.ip + ':' + remote_outpath, retrieved_copy_name]
+        def finish(code: Optional[int], elapsed: datetime.timedelta):
+            nonlocal remote_inpath, remote_outpath
+            pytranscoder.status_board.remove(self.hostname, basename)
+            pytranscoder.timings.record(inpath, 'encode', elapsed.total_seconds())
+            if code != 0 and pipe is not None and os.path.exists(local_outpath):
+                # partial output
+                os.remove(local_outpath)
+            if code is None:
+                events.emit('aborted', path=job.inpath, queue=job.queue, host=self.hostname, reason='threshold')
+                return
+            if code != 0:
+                events.emit('failed', path=job.inpath, queue=job.queue, host=self.hostname, code=code)
+                self.log(crayons.red('Unknown error encoding on remote'))
+                return
+
+            #
+            # copy results back to local, unless already streamed there
+            #
+            retrieved_copy_name = local_outpath
+            transfer = self.transfer
+            if pipe is None and transfer is not None:
+                self.log(f'copying {self.connection.remote(remote_outpath)} to {retrieved_copy_name}')
+                with pytranscoder.timings.measure(inpath, 'download'):
+                    code, output = transfer.download(remote_outpath, retrieved_copy_name)
+            elif pipe is None:
+                cmd = self.connection.scp(self.connection.remote(remote_outpath), retrieved_copy_name)
                 self.log(' '.join(cmd))
 
-                code, output = run(cmd)
+                with pytranscoder.timings.measure(inpath, 'download'):
+                    code, output = run(cmd)
 
-                #
-                # process completed, check results and finish
-                #
-                if code == 0:
-                    if not filter_threshold(_profile, inpath, retrieved_copy_name):
-                        self.log(
-                            f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(inpath, (job_stop - job_start).seconds)
-                        os.remove(retrieved_copy_name)
-                        continue
-                    self.complete(inpath, (job_stop - job_start).seconds)
-
-                    if not pytranscoder.keep_source:
+            #
+            # process completed, check results and finish
+            #
+            if code == 0:
+                with pytranscoder.timings.measure(inpath, 'threshold'):
+                    passed = filter_threshold(_profile, inpath, retrieved_copy_name)
+                size_in, size_out = file_size(inpath), file_size(retrieved_copy_name)
+                if not passed:
+                    events.emit('skipped', path=job.inpath, queue=job.queue, host=self.hostname,
+                                size_in=size_in, size_out=size_out)
+                    self.log(
+                        f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
+                    self.complete(inpath, elapsed.seconds)
+                    os.remove(retrieved_copy_name)
+                    return
+                self.complete(inpath, elapsed.seconds)
+
+                if not pytranscoder.keep_source:
+                    with pytranscoder.timings.measure(inpath, 'move'):
                         os.rename(retrieved_copy_name, retrieved_copy_name[0:-4])
                         retrieved_copy_name = retrieved_copy_name[0:-4]
                         if verbose:
                             self.log(f'moving media to {inpath}')
                         shutil.move(retrieved_copy_name, inpath)
-                    self.log(crayons.green(f'Finished {inpath}'))
-                elif code is not None:
-                    self.log(crayons.red(f'error during remote transcode of {inpath}'))
-                    self.log(f' Did not complete normally: {processor.last_command}')
-                    self.log(f'Output can be found in {processor.log_path}')
-
-                # self.log(f'Removing temporary media copies from {remote_working_dir}')
-                if self.props.is_windows():
-                    remote_outpath = self.converted_path(remote_outpath)
-                    remote_inpath = self.converted_path(remote_inpath)
-                    self.run_process([*ssh_cmd, f'"del {remote_outpath}"'])
-                    self.run_process([*ssh_cmd, f'"del {remote_inpath}"'])
-                else:
-                    self.run_process([*ssh_cmd, f'"rm {remote_outpath}"'])
-                    self.run_process([*ssh_cmd, f'"rm {remote_inpath}"'])
+                self.log(crayons.green(f'Finished {inpath}'))
+                events.emit('finished', path=job.inpath, queue=job.queue, host=self.hostname,
+                            size_in=size_in, size_out=size_out)
+            else:
+                events.emit('failed', path=job.inpath, queue=job.queue, host=self.hostname, code=code, reason='download')
+                self.log(crayons.red(f'error during remote transcode of {inpath}'))
+                self.log(f' Did not complete normally: {processor.last_command}')
+                self.log(f'Output can be found in {processor.log_path}')
+
+            # self.log(f'Removing temporary media copies from {remote_working_dir}')
+            if pipe is not None:
+                return
+            if self.props.is_windows():
+                remote_outpath = self.converted_path(remote_outpath)
+                remote_inpath = self.converted_path(remote_inpath)
+                self.run_process([*self.ssh_cmd(), f'del "{remote_outpath}" "{remote_inpath}"'])
+            else:
+                self.run_process([*self.ssh_cmd(), 'rm', '-f', shlex.quote(remote_outpath), shlex.quote(remote_inpath)])
 
-            finally:
-                self.queue.task_done()
+        events.emit('started', path=job.inpath, queue=job.queue, host=self.hostname, profile=_profile.name,
+                    mixins=job.mixins)
+        if self.retriever is not None:
+            finish = self.in_background(finish)
+        return Encode(processor, cmd, log_callback if processor.is_ffmpeg() else hb_log_callback, finish,
+                      remote=self.connection.command('-v'), source=inpath if pipe is not None else None,
+                      target=local_outpath, agent=self.agent if pipe is None else None)
 
 
 class MountedManagedHost(ManagedHost):
     """Implementation of a mounted host worker thread"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue, cluster):
+    def __init__(self, hostname, props: RemoteHostProperties, queue: JobQueue, cluster):
         super().__init__(hostname, props, queue, cluster)
 
     #
@@ -479,144 +710,155 @@ class MountedManagedHost(ManagedHost):
         if self.host_ok():
             self.go()
 
-    def go(self):
+    def prepare(self, job: EncodeJob) -> Optional[Encode]:
+        pytranscoder.timings.record(job.inpath, 'queue', time.monotonic() - job.queued)
+        events = pytranscoder.job_events
+        events.emit('dispatched', path=job.inpath, queue=job.queue, host=self.hostname)
+        inpath = job.inpath
 
-        while not self.queue.empty():
-            try:
-                job: EncodeJob = self.queue.get()
-                inpath = job.inpath
 
+        #
+        # Got to do the rule matching again.
+        # This time we narrow down the available profiles based on host definition
+        #
+        if pytranscoder.verbose:
+            self.log('matching ' + inpath)
 
-                #
-                # Got to do the rule matching again.
-                # This time we narrow down the available profiles based on host definition
-                #
-                if pytranscoder.verbose:
-                    self.log('matching ' + inpath)
+        _profile: Profile = self.match_profile(job, self.name)
+        if _profile is None:
+            return None
 
-                _profile: Profile = self.match_profile(job, self.name)
-                if _profile is None:
-                    continue
+        #
+        # calculate paths
+        #
+        outpath = inpath[0:inpath.rfind('.')] + _profile.extension + '.tmp'
+        remote_inpath = inpath
+        remote_outpath = outpath
+        if self.props.has_path_subst:
+            #
+            # fix the input path to match what the remote machine expects
+            #
+            remote_inpath, remote_outpath = self.props.substitute_paths(inpath, outpath)
 
-                #
-                # calculate paths
-                #
-                outpath = inpath[0:inpath.rfind('.')] + _profile.extension + '.tmp'
-                remote_inpath = inpath
-                remote_outpath = outpath
-                if self.props.has_path_subst:
-                    #
-                    # fix the input path to match what the remote machine expects
-                    #
-                    remote_inpath, remote_outpath = self.props.substitute_paths(inpath, outpath)
+        #
+        # build command line
+        #
 
-                #
-                # build command line
-                #
+        template = self._manager.config.command_template(_profile, job.mixins)
 
-                oinput = _profile.input_options.as_shell_params()
-                ooutput = self._manager.config.output_from_profile(_profile, job.mixins)
-#                ooutput = _profile.output_options.as_shell_params()
+        remote_inpath = self.converted_path(remote_inpath)
+        remote_outpath = self.converted_path(remote_outpath)
 
-                remote_inpath = self.converted_path(remote_inpath)
-                remote_outpath = self.converted_path(remote_outpath)
+        processor = self.props.get_processor_by_name(_profile.processor)
+        streams = None
+        if _profile.is_ffmpeg:
+            if job.media_info.is_multistream() and self.configfile.automap and _profile.automap:
+                streams = job.media_info.ffmpeg_streams(_profile)
+        agent = self.agent
+        if agent is not None:
+            # the agent runs the encoder without a shell, so paths go as they are
+            cmd = template.build(remote_inpath, remote_outpath, streams)
+        else:
+            cmd = template.build(f'"{remote_inpath}"', f'"{remote_outpath}"', streams)
 
-                processor = self.props.get_processor_by_name(_profile.processor)
-                if _profile.is_ffmpeg:
-                    if job.media_info.is_multistream() and self.configfile.automap and _profile.automap:
-                        ooutput = ooutput + job.media_info.ffmpeg_streams(_profile)
-                    cmd = ['-y', *oinput, '-i', f'"{remote_inpath}"', *ooutput, f'"{remote_outpath}"']
-                else:
-                    cmd = ['-i', f'"{remote_inpath}"', *oinput, *ooutput, '-o', f'"{remote_outpath}"']
+        #
+        # display useful information
+        #
+        self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
+        try:
+            print('-' * 40)
+            print(f'Host     : {self.hostname} (mounted)')
+            print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
+            print(f'Profile  : {_profile.name}')
+            self.print_estimate(_profile, job)
+            print('ssh      : ' + ' '.join(cmd) + '\n')
+        finally:
+            self.lock.release()
 
-                #
-                # display useful information
-                #
-                self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
-                try:
-                    print('-' * 40)
-                    print(f'Host     : {self.hostname} (mounted)')
-                    print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
-                    print(f'Profile  : {_profile.name}')
-                    print('ssh      : ' + ' '.join(cmd) + '\n')
-                finally:
-                    self.lock.release()
-
-                if pytranscoder.dry_run:
-                    continue
-
-                basename = os.path.basename(job.inpath)
-
-                def log_callback(stats):
-                    pct_done, pct_comp = calculate_progress(job.media_info, stats)
-                    pytranscoder.status_queue.put({ 'host': self.hostname,
-                                                    'file': basename,
-                                                    'speed': stats['speed'],
-                                                    'comp': pct_comp,
-                                                    'done': pct_done})
-
-#                    self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
-                    if _profile.threshold_check < 100:
-                        if pct_done >= _profile.threshold_check and pct_comp < _profile.threshold:
-                            # compression goal (threshold) not met, kill the job and waste no more time...
-                            self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
-                            return True
-                    # continue
-                    return False
-
-                def hb_log_callback(stats):
-                    self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
-                    return False
+        if pytranscoder.dry_run:
+            events.emit('planned', path=job.inpath, queue=job.queue, host=self.hostname, profile=_profile.name,
+                        mixins=job.mixins)
+            return None
+
+        basename = os.path.basename(job.inpath)
+
+        def log_callback(stats):
+            pct_done, pct_comp = calculate_progress(job.media_info, stats)
+            pytranscoder.status_board.put({'host': self.hostname,
+                                           'file': basename,
+                                           'speed': stats['speed'],
+                                           'comp': pct_comp,
+                                           'done': pct_done})
+            events.emit('progress', path=job.inpath, host=self.hostname, fps=stats['fps'], speed=stats['speed'],
+                        size=stats['size'], done=pct_done, comp=pct_comp)
+
+#            self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
+            if _profile.threshold_check < 100:
+                if pct_done >= _profile.threshold_check and pct_comp < _profile.threshold:
+                    # compression goal (threshold) not met, kill the job and waste no more time...
+                    self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
+                    return True
+            # continue
+            return False
 
-                #
-                # Start remote
-                #
-                job_start = datetime.datetime.now()
-                if processor.is_ffmpeg():
-                    code = processor.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd, log_callback)
-                else:
-                    code = processor.run_remote(self._manager.ssh, self.props.user, self.props.ip, cmd, hb_log_callback)
-                job_stop = datetime.datetime.now()
+        def hb_log_callback(stats):
+            self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
+            events.emit('progress', path=job.inpath, host=self.hostname, fps=stats['fps'])
+            return False
 
-                #
-                # process completed, check results and finish
-                #
-                if code == 0:
-                    if not filter_threshold(_profile, inpath, outpath):
-                        self.log(
-                            f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(inpath, (job_stop - job_start).seconds)
-                        os.remove(outpath)
-                        continue
-
-                    if not pytranscoder.keep_source:
+        def finish(code: Optional[int], elapsed: datetime.timedelta):
+            pytranscoder.status_board.remove(self.hostname, basename)
+            pytranscoder.timings.record(inpath, 'encode', elapsed.total_seconds())
+            #
+            # process completed, check results and finish
+            #
+            if code == 0:
+                with pytranscoder.timings.measure(inpath, 'threshold'):
+                    passed = filter_threshold(_profile, inpath, outpath)
+                size_in, size_out = file_size(inpath), file_size(outpath)
+                if not passed:
+                    events.emit('skipped', path=inpath, queue=job.queue, host=self.hostname,
+                                size_in=size_in, size_out=size_out)
+                    self.log(
+                        f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
+                    self.complete(inpath, elapsed.seconds)
+                    os.remove(outpath)
+                    return
+
+                if not pytranscoder.keep_source:
+                    with pytranscoder.timings.measure(inpath, 'move'):
                         if verbose:
                             self.log('removing ' + inpath)
                         os.remove(inpath)
                         if verbose:
                             self.log('renaming ' + outpath)
                         os.rename(outpath, outpath[0:-4])
-                        self.complete(inpath, (job_stop - job_start).seconds)
-                    self.log(crayons.green(f'Finished {job.inpath}'))
-                elif code is not None:
-                    self.log(f'Did not complete normally: {processor.last_command}')
-                    self.log(f'Output can be found in {processor.log_path}')
-                    try:
-                        os.remove(outpath)
-                    except:
-                        pass
+                    self.complete(inpath, elapsed.seconds)
+                self.log(crayons.green(f'Finished {job.inpath}'))
+                events.emit('finished', path=inpath, queue=job.queue, host=self.hostname,
+                            size_in=size_in, size_out=size_out)
+            elif code is None:
+                events.emit('aborted', path=inpath, queue=job.queue, host=self.hostname, reason='threshold')
+            else:
+                events.emit('failed', path=inpath, queue=job.queue, host=self.hostname, code=code)
+                self.log(f'Did not complete normally: {processor.last_command}')
+                self.log(f'Output can be found in {processor.log_path}')
+                try:
+                    os.remove(outpath)
+                except:
+                    pass
 
-            except Exception as ex:
-                self.log(ex)
-            finally:
-                self.queue.task_done()
+        events.emit('started', path=job.inpath, queue=job.queue, host=self.hostname, profile=_profile.name,
+                    mixins=job.mixins)
+        return Encode(processor, cmd, log_callback if processor.is_ffmpeg() else hb_log_callback, finish,
+                      remote=self.connection.command('-v'), agent=agent)
 
 
 class LocalHost(ManagedHost):
     """Implementation of a worker thread when the local machine is in the same cluster.
     Pretty much the same as the LocalHost class but without multiple dedicated queues"""
 
-    def __init__(self, hostname, props: RemoteHostProperties, queue: Queue, cluster):
+    def __init__(self, hostname, props: RemoteHostProperties, queue: JobQueue, cluster):
         super().__init__(hostname, props, queue, cluster)
 
     #
@@ -631,126 +873,139 @@ class LocalHost(ManagedHost):
     def run(self):
         self.go()
 
-    def go(self):
+    def ready(self) -> bool:
+        return True
 
-        while not self.queue.empty():
-            try:
-                job: EncodeJob = self.queue.get()
-                inpath = job.inpath
+    def prepare(self, job: EncodeJob) -> Optional[Encode]:
+        pytranscoder.timings.record(job.inpath, 'queue', time.monotonic() - job.queued)
+        events = pytranscoder.job_events
+        events.emit('dispatched', path=job.inpath, queue=job.queue, host=self.hostname)
+        inpath = job.inpath
 
-                #
-                # Got to do the rule matching again.
-                # This time we narrow down the available profiles based on host definition
-                #
-                if pytranscoder.verbose:
-                    self.log('matching ' + inpath)
+        #
+        # Got to do the rule matching again.
+        # This time we narrow down the available profiles based on host definition
+        #
+        if pytranscoder.verbose:
+            self.log('matching ' + inpath)
 
-                _profile: Profile = self.match_profile(job, self.name)
-                if _profile is None:
-                    continue
-                #
-                # calculate paths
-                #
-                outpath = inpath[0:inpath.rfind('.')] + _profile.extension + '.tmp'
+        _profile: Profile = self.match_profile(job, self.name)
+        if _profile is None:
+            return None
+        #
+        # calculate paths
+        #
+        outpath = inpath[0:inpath.rfind('.')] + _profile.extension + '.tmp'
 
-                #
-                # build command line
-                #
-                oinput = _profile.input_options.as_shell_params()
-                ooutput = self._manager.config.output_from_profile(_profile, job.mixins)
-#                ooutput = _profile.output_options.as_shell_params()
+        #
+        # build command line
+        #
+        template = self._manager.config.command_template(_profile, job.mixins)
 
-                remote_inpath = self.converted_path(inpath)
-                remote_outpath = self.converted_path(outpath)
+        remote_inpath = self.converted_path(inpath)
+        remote_outpath = self.converted_path(outpath)
 
-                processor = self.props.get_processor_by_name(_profile.processor)
-                if _profile.is_ffmpeg:
-                    if job.media_info.is_multistream() and self.configfile.automap and _profile.automap:
-                        ooutput = ooutput + job.media_info.ffmpeg_streams(_profile)
-                    cli = ['-y', *oinput, '-i', remote_inpath, *ooutput, remote_outpath]
-                else:
-                    cli = ['-i', remote_inpath, *oinput, *ooutput, '-o', remote_outpath]
+        processor = self.props.get_processor_by_name(_profile.processor)
+        streams = None
+        if _profile.is_ffmpeg:
+            if job.media_info.is_multistream() and self.configfile.automap and _profile.automap:
+                streams = job.media_info.ffmpeg_streams(_profile)
+        cli = template.build(remote_inpath, remote_outpath, streams)
 
-                #
-                # display useful information
-                #
-                self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
-                try:
-                    print('-' * 40)
-                    print(f'Host     : {self.hostname} (local)')
-                    print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
-                    print(f'Profile  : {_profile.name}')
-                    print('ffmpeg   : ' + ' '.join(cli) + '\n')
-                finally:
-                    self.lock.release()
-
-                if pytranscoder.dry_run:
-                    continue
-
-                basename = os.path.basename(job.inpath)
-
-                def log_callback(stats):
-                    pct_done, pct_comp = calculate_progress(job.media_info, stats)
-                    pytranscoder.status_queue.put({ 'host': 'local',
-                                                    'file': basename,
-                                                    'speed': stats['speed'],
-                                                    'comp': pct_comp,
-                                                    'done': pct_done})
-
-#                    self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
-                    if _profile.threshold_check < 100:
-                        if pct_done >= _profile.threshold_check and pct_comp < _profile.threshold:
-                            # compression goal (threshold) not met, kill the job and waste no more time...
-                            self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
-                            return True
-                    return False
-
-                def hb_log_callback(stats):
-                    self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
-                    return False
+        #
+        # display useful information
+        #
+        self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
+        try:
+            print('-' * 40)
+            print(f'Host     : {self.hostname} (local)')
+            print('Filename : ' + crayons.green(os.path.basename(remote_inpath)))
+            print(f'Profile  : {_profile.name}')
+            self.print_estimate(_profile, job)
+            print('ffmpeg   : ' + ' '.join(cli) + '\n')
+        finally:
+            self.lock.release()
 
-                #
-                # Start process
-                #
-                job_start = datetime.datetime.now()
-                if processor.is_ffmpeg():
-                    code = processor.run(cli, log_callback)
-                else:
-                    code = processor.run(cli, hb_log_callback)
-                job_stop = datetime.datetime.now()
+        if pytranscoder.dry_run:
+            events.emit('planned', path=job.inpath, queue=job.queue, host=self.hostname, profile=_profile.name,
+                        mixins=job.mixins)
+            return None
+
+        basename = os.path.basename(job.inpath)
+
+        def log_callback(stats):
+            pct_done, pct_comp = calculate_progress(job.media_info, stats)
+            pytranscoder.status_board.put({'host': 'local',
+                                           'file': basename,
+                                           'speed': stats['speed'],
+                                           'comp': pct_comp,
+                                           'done': pct_done})
+            events.emit('progress', path=job.inpath, host=self.hostname, fps=stats['fps'], speed=stats['speed'],
+                        size=stats['size'], done=pct_done, comp=pct_comp)
+
+#            self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
+            if _profile.threshold_check < 100:
+                if pct_done >= _profile.threshold_check and pct_comp < _profile.threshold:
+                    # compression goal (threshold) not met, kill the job and waste no more time...
+                    self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
+                    return True
+            return False
 
-                #
-                # process completed, check results and finish
-                #
-                if code == 0:
-                    if not filter_threshold(_profile, inpath, outpath):
-                        self.log(
-                            f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(inpath, (job_stop - job_start).seconds)
-                        os.remove(outpath)
-                        continue
-
-                    if not pytranscoder.keep_source:
+        def hb_log_callback(stats):
+            self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
+            events.emit('progress', path=job.inpath, host=self.hostname, fps=stats['fps'])
+            return False
+
+        def finish(code: Optional[int], elapsed: datetime.timedelta):
+            pytranscoder.status_board.remove('local', basename)
+            pytranscoder.timings.record(inpath, 'encode', elapsed.total_seconds())
+            usage = processor.last_usage
+            resources = usage.as_dict() if usage is not None else None
+            #
+            # process completed, check results and finish
+            #
+            if code == 0:
+                with pytranscoder.timings.measure(inpath, 'threshold'):
+                    passed = filter_threshold(_profile, inpath, outpath)
+                size_in, size_out = file_size(inpath), file_size(outpath)
+                if not passed:
+                    events.emit('skipped', path=inpath, queue=job.queue, host=self.hostname,
+                                size_in=size_in, size_out=size_out, usage=resources)
+                    self.log(
+                        f'Transcoded file {inpath} did not meet minimum savings threshold, skipped')
+                    self.complete(inpath, elapsed.seconds, usage)
+                    os.remove(outpath)
+                    return
+
+                if not pytranscoder.keep_source:
+                    with pytranscoder.timings.measure(inpath, 'move'):
                         if verbose:
                             self.log('removing ' + inpath)
                         os.remove(inpath)
                         if verbose:
                             self.log('renaming ' + outpath)
                         os.rename(outpath, outpath[0:-4])
-                        self.complete(inpath, (job_stop - job_start).seconds)
-                    self.log(crayons.green(f'Finished {job.inpath}'))
-                elif code is not None:
-                    self.log(f' Did not complete normally: {processor.last_command}')
-                    self.log(f'Output can be found in {processor.log_path}')
-                    try:
-                        os.remove(outpath)
-                    except:
-                        pass
+                    self.complete(inpath, elapsed.seconds, usage)
+                self.log(crayons.green(f'Finished {job.inpath}'))
+                events.emit('finished', path=inpath, queue=job.queue, host=self.hostname,
+                            size_in=size_in, size_out=size_out, usage=resources)
+            elif code is None:
+                events.emit('aborted', path=inpath, queue=job.queue, host=self.hostname, reason='threshold',
+                            usage=resources)
+            else:
+                events.emit('failed', path=inpath, queue=job.queue, host=self.hostname, code=code, usage=resources)
+                self.log(f' Did not complete normally: {processor.last_command}')
+                self.log(f'Output can be found in {processor.log_path}')
+                try:
+                    os.remove(outpath)
+                except:
+                    pass
 
-            except Exception as ex:
-                self.log(ex)
-            finally:
-                self.queue.task_done()
+        events.emit('started', path=job.inpath, queue=job.queue, host=self.hostname, profile=_profile.name,
+                    mixins=job.mixins)
+        return Encode(processor, cli, log_callback if processor.is_ffmpeg() else hb_log_callback, finish,
+                      claim=self.configfile.resource_pool.claim(_profile.resources),
+                      admission=self.configfile.admission_control, workdir=os.path.dirname(outpath))
 
 
 class Cluster(Thread):
@@ -758,18 +1013,22 @@ class Cluster(Thread):
 
     terminal_lock:  Lock = Lock()       # class-level
 
-    def __init__(self, name, configs: Dict, config: ConfigFile, ssh: str):
+    def __init__(self, name, configs: Dict, config: ConfigFile, ssh: str, history: Optional[SpeedHistory] = None):
         """
         :param name:        Cluster name, used only for thread naming
         :param configs:     The "clusters" section of the global config
         :param config:      The full configuration object
         :param ssh:         Path to local ssh
+        :param history:     Speeds of earlier jobs, to predict encode times with
         """
         super().__init__(name=name, group=None, daemon=True)
-        self.queues: Dict[str, Queue] = dict()
+        self.queues: Dict[str, JobQueue] = dict()
         self.ssh = ssh
+        self.connections = SshPool(ssh, config.ssh_multiplex)
+        self.agents = AgentPool()
         self.hosts: List[ManagedHost] = list()
         self.config = config
+        self.history = history
         self.verbose = verbose
 #        self.ffmpeg = FFmpeg(config.ffmpeg_path)
 #        self.hbcli = Handbrake(config.hbcli_path)
@@ -790,7 +1049,7 @@ class Cluster(Thread):
             if len(host_queues) > 0:
                 for host_queue in host_queues:
                     if host_queue not in self.queues:
-                        self.queues[host_queue] = Queue()
+                        self.queues[host_queue] = JobQueue(job_order(config.queue_order))
 
             _h = None
             if hosttype == 'local':
@@ -830,17 +1089,42 @@ class Cluster(Thread):
             else:
                 print(crayons.red(f'Unknown cluster host type "{hosttype}" - skipping'))
 
-    def enqueue(self, file, forced_profile: Optional[str]) -> (str, Optional[EncodeJob]):
+    def enqueue_files(self, files: List) -> None:
+        """Add several media files to this cluster queue, probing them concurrently.
+
+        :param files: list of (path, forced profile name) tuples
+        """
+        probe = MediaProbe.from_config(self.config)
+        details = probe.fetch_all([(self.info_processor, os.path.abspath(file)) for file, _ in files])
+        estimates = list()
+        for (file, forced_profile), media_info in zip(files, details):
+            queue_name, job = self.enqueue(file, forced_profile, media_info)
+            if job is not None and self.history is not None:
+                # the host isn't known yet, so go by the speed on any host
+                estimates.append((queue_name, self.history.predict(job.profile_name, media_info.vcodec,
+                                                                   media_info.res_height, media_info.runtime)))
+        if len(estimates) > 0:
+            slots = {name: sum(1 for host in self.hosts if host.source_queue is queue) for name, queue in self.queues.items()}
+            estimate = batch_estimate(estimates, slots)
+            if estimate is not None:
+                with self.lock:
+                    print(crayons.cyan(f'{self.name}: {estimate}'))
+
+    def enqueue(self, file, forced_profile: Optional[str],
+                media_info: Optional[MediaInfo] = None) -> (str, Optional[EncodeJob]):
         """Add a media file to this cluster queue.
            This is different than in local mode in that we only care about handling skips here.
            The profile will be selected once a host is assigned to the work
+
+        :param media_info:  Details of the file if already probed, otherwise fetched here
         """
 
         path = os.path.abspath(file)  # convert to full path so that rule filtering can work
         if pytranscoder.verbose:
             print('matching ' + path)
 
-        media_info = self.info_processor.fetch_details(path)
+        if media_info is None:
+            media_info = self.info_processor.fetch_details(path)
 
         if media_info is None:
             print(crayons.red(f'File not found: {path}'))
@@ -856,7 +1140,11 @@ class Cluster(Thread):
                 #
 
                 profile = None
-                rule = self.config.match_rule(media_info)
+                with pytranscoder.timings.measure(path, 'match'):
+                    rule = self.config.match_rule(media_info)
+                pytranscoder.job_events.emit('matched', path=path, rule=rule.name if rule else None,
+                                             profile=rule.profile if rule else None,
+                                             skip=rule is None or rule.is_skip())
                 if rule is None:
                     print(crayons.yellow(f'No matching profile found - skipped'))
                     return None, None
@@ -865,8 +1153,11 @@ class Cluster(Thread):
                     print(f'{basename}: Skipping due to profile rule - {rule.name}')
                     return None, None
                 profile = self.profiles[rule.profile]
+                priority = rule.priority
             else:
                 profile = self.profiles[forced_profile]
+                priority = 0
+                pytranscoder.job_events.emit('matched', path=path, rule=None, profile=forced_profile, skip=False)
 
             if pytranscoder.verbose:
                 print("Matched to profile {profile.name}")
@@ -877,14 +1168,23 @@ class Cluster(Thread):
                 print(crayons.red('Error: ') +
                       f'Queue "{queue_name}" referenced in profile "{profile.name}" not defined in any host')
                 exit(1)
-            job = EncodeJob(file, media_info, profile.name, None)
+            job = EncodeJob(file, media_info, profile.name, None, queue_name, priority)
             self.queues[queue_name].put(job)
+            pytranscoder.job_events.emit('queued', path=job.inpath, queue=queue_name)
             return queue_name, job
         return None, None
 
+    def close(self):
+        """All files have been enqueued, let hosts finish once the queues drain"""
+        for queue in self.queues.values():
+            queue.close()
+
     def testrun(self):
+        self.close()
         for host in self.hosts:
             host.testrun()
+        self.agents.close()
+        self.connections.close()
 
     def run(self):
         """Start all host threads and wait until queue is drained"""
@@ -893,20 +1193,31 @@ class Cluster(Thread):
             print(f'No hosts available in cluster "{self.name}"')
             return
 
-        for host in self.hosts:
-            host.start()
-
-        # all hosts running, wait for them to finish
-        for host in self.hosts:
-            host.join()
-            self.completed.extend(host.completed)
+        try:
+            if self.config.engine == 'asyncio':
+                # run every host slot from this thread instead of one thread each
+                Supervisor(self.name).run(self.hosts)
+                for host in self.hosts:
+                    self.completed.extend(host.completed)
+                return
+
+            for host in self.hosts:
+                host.start()
+
+            # all hosts running, wait for them to finish
+            for host in self.hosts:
+                host.join()
+                self.completed.extend(host.completed)
+        finally:
+            self.agents.close()
+            self.connections.close()
 
     @property
     def profiles(self):
         return self.config.profiles
 
 
-def manage_clusters(files, config: ConfigFile, testing=False) -> List:
+def manage_clusters(files, config: ConfigFile, testing=False, history: Optional[SpeedHistory] = None) -> List:
     """Main entry point for setup and execution of all clusters
 
         There is one thread per cluster, and each cluster manages multiple hosts, each having their own thread.
@@ -918,6 +1229,7 @@ def manage_clusters(files, config: ConfigFile, testing=False) -> List:
         print('Error: no clusters defined')
         return completed
     clusters = dict()
+    files_by_cluster = dict()
     for name, this_config in cluster_config.items():
         for item in files:
             filepath, target_cluster, profile_name, mixins = item
@@ -925,42 +1237,34 @@ def manage_clusters(files, config: ConfigFile, testing=False) -> List:
                 continue
             if target_cluster not in clusters:
                 clusters[target_cluster] = Cluster(target_cluster, this_config, config,
-                                                   config.ssh_path)
-            clusters[target_cluster].enqueue(filepath, profile_name)
+                                                   config.ssh_path, history)
+                files_by_cluster[target_cluster] = list()
+            files_by_cluster[target_cluster].append((filepath, profile_name))
 
     #
-    # Start clusters, which will start hosts too
+    # Start clusters, which will start hosts too, then feed them work as files are matched
     #
-    for _, cluster in clusters.items():
-        if testing:
-            cluster.testrun()
-        else:
+    renderer = None
+    if not testing:
+        renderer = StatusRenderer(pytranscoder.status_board, Cluster.terminal_lock, show_host=True)
+        renderer.start()
+        for _, cluster in clusters.items():
             cluster.start()
 
-    if not testing:
+    for name, cluster_files in files_by_cluster.items():
+        clusters[name].enqueue_files(cluster_files)
+        clusters[name].close()
 
-        busy = True
-        while busy:
-            try:
-                report = pytranscoder.status_queue.get(block=True, timeout=2)
-                host = report['host']
-                basename = report['file']
-                speed = report['speed']
-                comp = report['comp']
-                done = report['done']
-                print(f'{host:20}|{basename}: speed: {speed}x, comp: {comp}%, done: {done:3}%')
-                sys.stdout.flush()
-                pytranscoder.status_queue.task_done()
-            except Empty:
-                busy = False
-                for _, cluster in clusters.items():
-                    if cluster.is_alive():
-                        busy = True
+    if testing:
+        for _, cluster in clusters.items():
+            cluster.testrun()
 
+    if not testing:
         #
         # wait for each cluster thread to complete
         #
-#        for _, cluster in clusters.items():
-#            cluster.join()
+        for _, cluster in clusters.items():
+            cluster.join()
 #            completed.extend(cluster.completed)
+        renderer.stop()
     return completed
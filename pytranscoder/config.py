@@ -1,15 +1,19 @@
 import sys
 import os
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 
 import yaml
 
+from pytranscoder.admission import AdmissionControl
 from pytranscoder.ffmpeg import FFmpeg
 from pytranscoder.handbrake import Handbrake
+from pytranscoder.jobqueue import JOB_ORDERS
 from pytranscoder.media import MediaInfo
 from pytranscoder.processor import Processor
-from pytranscoder.profile import Profile
-from pytranscoder.rule import Rule
+from pytranscoder.profile import Profile, CommandTemplate
+from pytranscoder.resources import ResourcePool
+from pytranscoder.rule import Rule, PathMatcher, RuleIndex
+from pytranscoder.transfer import Bandwidth
 
 
 class ConfigFile:
@@ -17,12 +21,19 @@ class ConfigFile:
     queues:     Dict
     profiles:   Dict[str, Profile]
     rules:      Dict[str, Rule]
+    path_matcher: PathMatcher
+    rule_index: RuleIndex
+    templates:  Dict[Tuple, CommandTemplate]
+    resource_pool: ResourcePool
+    admission_control: Optional[AdmissionControl]
+    bandwidth: Bandwidth
 
     def __init__(self, configuration: Any):
         """load configuration file (defaults to $HOME/.transcode.yml)"""
 
         self.profiles = dict()
         self.rules = dict()
+        self.templates = dict()
         yml = None
         if configuration is not None:
             if isinstance(configuration, Dict):
@@ -44,13 +55,42 @@ class ConfigFile:
                     self.profiles[name].include(self.profiles[parent_name])
 
             for name, rule in yml['rules'].items():
-                self.rules[name] = Rule(name, rule)
+                try:
+                    self.rules[name] = Rule(name, rule)
+                except ValueError as ex:
+                    print(f'Rule error ({name}): {ex}')
+                    exit(1)
+
+            self.path_matcher = PathMatcher(self.rules.values())
+            self.rule_index = RuleIndex(self.rules.values())
 
             if 'queues' in self.settings:
                 self.queues = self.settings['queues']
             else:
                 self.queues = dict()
 
+            if self.engine == 'asyncio' and sys.version_info < (3, 8):
+                # child processes can't be watched from a loop outside the main thread before 3.8
+                print('The "asyncio" engine needs Python 3.8 or later')
+                exit(1)
+
+            if self.queue_order not in JOB_ORDERS:
+                print(f'Invalid queue_order "{self.queue_order}", must be one of {", ".join(JOB_ORDERS)}')
+                exit(1)
+
+            self.admission_control = AdmissionControl.from_config(self.admission)
+            self.resource_pool = ResourcePool(self.resources)
+            self.bandwidth = Bandwidth(self.transfer_bandwidth)
+            for name, profile in self.profiles.items():
+                for resource, count in profile.resources.items():
+                    if resource not in self.resource_pool.limits:
+                        print(f'Profile error ({name}): resource "{resource}" not defined')
+                        exit(1)
+                    if count > self.resource_pool.limits[resource]:
+                        print(f'Profile error ({name}): needs {count} of resource "{resource}" but only '
+                              f'{self.resource_pool.limits[resource]} defined')
+                        exit(1)
+
     def fls_path(self) -> str:
         return self.settings.get('fls_path', None)
 
@@ -77,10 +117,9 @@ class ConfigFile:
         return profiles
 
     def match_rule(self, media_info: MediaInfo, restrict_profiles=None) -> Optional[Rule]:
-        for rule in self.rules.values():
-            if restrict_profiles is not None and rule.profile not in restrict_profiles:
-                continue
-            if rule.match(media_info):
+        scan = self.path_matcher.scan(media_info.path)
+        for rule in self.rule_index.candidates(media_info, restrict_profiles):
+            if rule.match(media_info, scan):
                 if rule.is_skip():
                     return rule
                 if not self.has_profile(rule.profile):
@@ -103,7 +142,7 @@ class ConfigFile:
 
     def get_processor_by_name(self, name: str) -> Processor:
         if name == 'ffmpeg':
-            return FFmpeg(self.ffmpeg_path)
+            return FFmpeg(self.ffmpeg_path, self.ffmpeg_progress)
         if self.hbcli_path:
             return Handbrake(self.hbcli_path)
         print('Missing "ffmpeg" or "hbcli" path')
@@ -119,7 +158,20 @@ class ConfigFile:
                 return section.as_shell_params()
         return []
 
+    def command_template(self, profile: Profile, mixins: Optional[List[str]]) -> CommandTemplate:
+        """Get the (cached) encoder options for a profile with the given mixins applied"""
+        key = (profile.name, tuple(mixins) if mixins else ())
+        template = self.templates.get(key, None)
+        if template is None:
+            template = CommandTemplate(profile.is_ffmpeg, profile.input_options.as_shell_params(),
+                                       self.build_output_options(profile, mixins))
+            self.templates[key] = template
+        return template
+
     def output_from_profile(self, profile: Profile, mixins: List[str]) -> List[str]:
+        return list(self.command_template(profile, mixins).output_options)
+
+    def build_output_options(self, profile: Profile, mixins: List[str]) -> List[str]:
         # start with output_options (not mixable)
         output_opt = profile.output_options.as_shell_params()
         mixin_profiles = self.find_mixins(mixins)
@@ -139,6 +191,10 @@ class ConfigFile:
     def ffmpeg_path(self):
         return self.settings['ffmpeg']
 
+    @property
+    def ffmpeg_progress(self) -> bool:
+        return self.settings.get('ffmpeg_progress', False)
+
     @property
     def hbcli_path(self):
         return self.settings.get('hbcli', None)
@@ -147,6 +203,15 @@ class ConfigFile:
     def ssh_path(self):
         return self.settings.get('ssh', '/usr/bin/ssh')
 
+    @property
+    def ssh_multiplex(self) -> bool:
+        return self.settings.get('ssh_multiplex', False)
+
+    @property
+    def transfer_bandwidth(self) -> Optional[float]:
+        """MB per second shared by all resumable transfers to and from streaming hosts"""
+        return self.settings.get('transfer_bandwidth', None)
+
     @property
     def plex_server(self):
         return self.settings.get('plex_server', None)
@@ -157,7 +222,57 @@ class ConfigFile:
 
     def add_rule(self, name, rule: Rule):
         self.rules[name] = rule
+        self.path_matcher = PathMatcher(self.rules.values())
+        self.rule_index = RuleIndex(self.rules.values())
 
     @property
     def automap(self) -> bool:
         return self.settings.get('automap', True)
+
+    @property
+    def engine(self) -> str:
+        return self.settings.get('engine', 'thread')
+
+    @property
+    def queue_order(self) -> str:
+        return self.settings.get('queue_order', 'fifo')
+
+    @property
+    def admission(self) -> Optional[Dict[str, Any]]:
+        return self.settings.get('admission', None)
+
+    @property
+    def resources(self) -> Dict[str, int]:
+        return self.settings.get('resources', None) or dict()
+
+    @property
+    def probe_workers(self) -> int:
+        return int(self.settings.get('probe_workers', 1))
+
+    @property
+    def probe_pool(self) -> str:
+        return self.settings.get('probe_pool', 'thread')
+
+    @property
+    def probe_cache(self) -> Optional[str]:
+        return self.settings.get('probe_cache', None)
+
+    @property
+    def probe_cache_max(self) -> int:
+        return int(self.settings.get('probe_cache_max', 100000))
+
+    @property
+    def metrics_port(self) -> Optional[str]:
+        return self.settings.get('metrics_port', None)
+
+    @property
+    def metrics_file(self) -> Optional[str]:
+        return self.settings.get('metrics_file', None)
+
+    @property
+    def journal(self) -> Optional[str]:
+        return self.settings.get('journal', None)
+
+    @property
+    def speed_history(self) -> Optional[str]:
+        return self.settings.get('speed_history', None)
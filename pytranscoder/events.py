@@ -0,0 +1,54 @@
+"""
+    Job lifecycle events, passed on to whatever is listening (metrics, ...)
+"""
+import os
+from threading import Lock
+from typing import Callable, Dict, Any, List
+
+Listener = Callable[[str, Dict[str, Any]], None]
+
+# the last event of every job that got to run
+ENDED = ('finished', 'skipped', 'aborted', 'failed')
+
+
+class JobEvents:
+    """Fans out job events to registered listeners. Costs next to nothing when nobody listens.
+
+    Events, with their main fields:
+        probed      path, valid, vcodec, width, height, runtime, filesize_mb, fps
+        matched     path, rule, profile, skip   (host too when rematched by a cluster host)
+        queued      path, queue
+        dispatched  path, queue, host           (taken from the queue by a host)
+        started     path, queue, host, profile, mixins   (encoder about to run)
+        progress    path, host, fps, speed, size, done, comp
+        finished    path, queue, host, size_in, size_out
+        skipped     path, queue, host, size_in, size_out   (savings threshold not met)
+        aborted     path, queue, host, reason   (encode cancelled by the threshold check)
+        failed      path, queue, host, code     (and reason: upload or download when a copy failed, error when
+                                                 handling the job raised an exception)
+        planned     path, queue, host, profile, mixins   (dry run, in place of started and what follows)
+        phase       path, phase, seconds        (from Timings)
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.listeners: List[Listener] = list()
+
+    def listen(self, listener: Listener):
+        with self._lock:
+            self.listeners = [*self.listeners, listener]
+
+    def unlisten(self, listener: Listener):
+        with self._lock:
+            self.listeners = [l for l in self.listeners if l is not listener]
+
+    def emit(self, event: str, **fields):
+        for listener in self.listeners:
+            listener(event, fields)
+
+
+def file_size(path) -> int:
+    try:
+        return os.path.getsize(str(path))
+    except OSError:
+        return 0
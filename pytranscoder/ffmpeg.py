@@ -1,17 +1,14 @@
-import datetime
 import os
 import re
+import struct
 import subprocess
 import sys
-import threading
 from pathlib import PurePath
-from random import randint
-from tempfile import gettempdir
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple, TextIO
 import json
 
 from pytranscoder.media import MediaInfo
-from pytranscoder.processor import Processor
+from pytranscoder.processor import Processor, OutputParser
 
 status_re = re.compile(
     r'^.* fps=\s*(?P<fps>.+?) q=(?P<q>.+\.\d) size=\s*(?P<size>\d+?)kB time=(?P<time>\d\d:\d\d:\d\d\.\d\d) .*speed=(?P<speed>.*?)x')
@@ -19,11 +16,138 @@ status_re = re.compile(
 _CHARSET: str = sys.getdefaultencoding()
 
 
+def parse_progress(block: Dict[str, str]) -> Dict[str, Any]:
+    """Convert one block of ffmpeg -progress key=value output into the stats StatusParser reports"""
+
+    def number(key: str, convert=int, default=0):
+        try:
+            return convert(block.get(key, default))
+        except ValueError:
+            # ffmpeg reports N/A until the first frame is written
+            return default
+
+    # out_time_ms is really microseconds, kept for older ffmpeg versions
+    micros = number('out_time_us', default=number('out_time_ms'))
+    return {
+        'frame': number('frame'),
+        'fps': block.get('fps', '0'),
+        'q': block.get('stream_0_0_q', '0'),
+        'size': number('total_size'),
+        'time': micros // 1000000,
+        'speed': block.get('speed', '0').rstrip('x').strip(),
+    }
+
+
+# muxers able to write to a pipe, by the file extensions they are picked for
+PIPE_MUXERS = {
+    '.mkv': 'matroska', '.mka': 'matroska', '.webm': 'webm', '.ts': 'mpegts', '.m2ts': 'mpegts', '.nut': 'nut',
+    '.mp4': 'mp4', '.m4v': 'mp4', '.mov': 'mov',
+}
+# mp4 and mov need to be fragmented to be written front to back
+FRAGMENT_MOVFLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+
+def pipe_output_options(options: List[str], extension: str) -> Optional[List[str]]:
+    """Options to add for ffmpeg to write its output to stdout, None if the output can't be written as a stream
+
+    :param options:     Output options of the profile
+    :param extension:   Extension of the output file, for the format when not given with -f
+    """
+    options = list(options)
+    extra = list()
+    if '-f' in options[:-1]:
+        muxer = options[options.index('-f') + 1]
+    else:
+        muxer = PIPE_MUXERS.get(extension.lower(), None)
+        extra.extend(['-f', muxer])
+    if muxer not in PIPE_MUXERS.values():
+        return None
+    if muxer in ('mp4', 'mov'):
+        if '-movflags' not in options[:-1]:
+            extra.extend(['-movflags', FRAGMENT_MOVFLAGS])
+        elif 'empty_moov' not in options[options.index('-movflags') + 1]:
+            return None
+    return extra
+
+
+def streamable_source(path: str) -> bool:
+    """Whether ffmpeg can read a file from a pipe. MP4 and MOV files need their index (moov) ahead of the media."""
+    if os.path.splitext(path)[1].lower() not in ('.mp4', '.m4v', '.mov'):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = struct.unpack('>I4s', header)
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+                if size == 1:
+                    # 64 bit size follows the header
+                    size = struct.unpack('>Q', f.read(8))[0] - 8
+                elif size < 8:
+                    return False
+                f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+class StatusParser(OutputParser):
+    """Parses the status lines of the ffmpeg console output"""
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        match = status_re.match(line)
+        if match is not None and len(match.groups()) >= 5:
+            if self.due():
+                info: Dict[str, Any] = match.groupdict()
+
+                info['size'] = int(info['size'].strip()) * 1024
+                hh, mm, ss = info['time'].split(':')
+                ss = ss.split('.')[0]
+                info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
+                return info
+        return None
+
+
+class ProgressParser(OutputParser):
+    """Collects the key=value blocks written by ffmpeg -progress.
+
+    The console output goes straight to the transaction log, so only one short block per update is handled here.
+    """
+
+    logged = False
+
+    def __init__(self, interval: int):
+        super().__init__(interval)
+        self.block: Dict[str, str] = dict()
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            return None
+        if key != 'progress':
+            self.block[key] = value
+            return None
+        # "progress" closes each block
+        block = self.block
+        self.block = dict()
+        if value != 'end' and self.due():
+            return parse_progress(block)
+        return None
+
+
 class FFmpeg(Processor):
 
-    def __init__(self, ffmpeg_path: str):
+    def __init__(self, ffmpeg_path: str, progress: bool = False):
+        """
+        :param progress:    Monitor using the ffmpeg -progress pipe instead of parsing the console output
+        """
         super().__init__(ffmpeg_path)
         self.monitor_interval = 30
+        self.progress = progress
 
     def is_ffmpeg(self) -> bool:
         return True
@@ -57,42 +181,23 @@ class FFmpeg(Processor):
             info = json.loads(output)
             return MediaInfo.parse_ffmpeg_details_json(_path, info)
 
-    def monitor_ffmpeg(self, proc: subprocess.Popen):
-        diff = datetime.timedelta(seconds=self.monitor_interval)
-        event = datetime.datetime.now() + diff
-
-        #
-        # Create a transaction log for this run, to be left behind if an error is encountered.
-        #
-        suffix = randint(100, 999)
-        self.log_path: PurePath = PurePath(gettempdir(), 'pytranscoder-' + threading.current_thread().getName() + '-' +
-                                           str(suffix) + '.log')
-
-        with open(str(self.log_path), 'w') as logfile:
-            while proc.poll() is None:
-                line = proc.stdout.readline()
-                logfile.write(line)
-                logfile.flush()
-
-                match = status_re.match(line)
-                if match is not None and len(match.groups()) >= 5:
-                    if datetime.datetime.now() > event:
-                        event = datetime.datetime.now() + diff
-                        info: Dict[str, Any] = match.groupdict()
-
-                        info['size'] = int(info['size'].strip()) * 1024
-                        hh, mm, ss = info['time'].split(':')
-                        ss = ss.split('.')[0]
-                        info['time'] = (int(hh) * 3600) + (int(mm) * 60) + int(ss)
-                        yield info
-
-        if proc.returncode == 0:
-            # if we got here then everything went fine, so remove the transaction log
-            os.remove(str(self.log_path))
-            self.log_path = None
-
-    def run(self, params, event_callback) -> Optional[int]:
-        return self.execute_and_monitor(params, event_callback, self.monitor_ffmpeg)
-
-    def run_remote(self, sshcli: str, user: str, ip: str, params: list, event_callback) -> Optional[int]:
-        return self.remote_execute_and_monitor(sshcli, user, ip, params, event_callback, self.monitor_ffmpeg)
+    def prepare(self, params: List[str]) -> Tuple[List[str], OutputParser, Optional[TextIO]]:
+        if not self.progress:
+            self.open_log()
+            return params, StatusParser(self.monitor_interval), None
+        # ffmpeg writes its (now brief) console output to the log file itself
+        log = self.open_log(full=True)
+        return ['-progress', 'pipe:1', '-nostats', *params], ProgressParser(self.monitor_interval), log.file
+
+    def prepare_piped(self, params: List[str]) -> Tuple[List[str], OutputParser]:
+        # stdout is taken by the media, so progress comes from the console output
+        self.open_log()
+        return params, StatusParser(self.monitor_interval)
+
+    def prepare_agent(self, params: List[str]) -> Tuple[List[str], OutputParser, bool]:
+        # the agent collects the -progress blocks, the console output only goes to the log
+        self.open_log()
+        return ['-progress', 'pipe:1', '-nostats', *params], OutputParser(self.monitor_interval), True
+
+    def agent_stats(self, block: Dict[str, str]) -> Dict[str, Any]:
+        return parse_progress(block)
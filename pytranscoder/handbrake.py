@@ -1,23 +1,29 @@
-import datetime
-import os
 import re
 import subprocess
 import sys
-import threading
-from pathlib import PurePath
-from random import randint
-from tempfile import gettempdir
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Tuple, TextIO
 import json
 
 from pytranscoder.media import MediaInfo
-from pytranscoder.processor import Processor
+from pytranscoder.processor import Processor, OutputParser
 
 status_re = re.compile(r'^.*avg (?P<fps>.+?) fps.*ETA\s(?P<eta>.+?)\)')
 
 _CHARSET: str = sys.getdefaultencoding()
 
 
+class StatusParser(OutputParser):
+    """Parses the progress lines of the HandBrakeCLI output"""
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        match = status_re.match(line)
+        if match is not None and len(match.groups()) >= 2:
+            if self.due():
+                info: Dict[str, Any] = match.groupdict()
+                return info
+        return None
+
+
 class Handbrake(Processor):
 
     def __init__(self, cli_path: str):
@@ -40,38 +46,6 @@ class Handbrake(Processor):
                 return mi
         return MediaInfo(None)
 
-    def monitor_hbcli(self, proc: subprocess.Popen):
-        diff = datetime.timedelta(seconds=self.monitor_interval)
-        event = datetime.datetime.now() + diff
-
-        #
-        # Create a transaction log for this run, to be left behind if an error is encountered.
-        #
-        suffix = randint(100, 999)
-        self.log_path: PurePath = PurePath(gettempdir(), 'pytranscoder-' + threading.current_thread().getName() + '-' +
-                                           str(suffix) + '.log')
-
-        with open(str(self.log_path), 'w') as logfile:
-            while proc.poll() is None:
-                line = proc.stdout.readline()
-                logfile.write(line)
-                logfile.flush()
-
-                match = status_re.match(line)
-                if match is not None and len(match.groups()) >= 2:
-                    if datetime.datetime.now() > event:
-                        event = datetime.datetime.now() + diff
-                        info: Dict[str, Any] = match.groupdict()
-                        yield info
-
-        if proc.returncode == 0:
-            # if we got here then everything went fine, so remove the transaction log
-            os.remove(str(self.log_path))
-            self.log_path = None
-
-    def run(self, params, event_callback) -> Optional[int]:
-        return self.execute_and_monitor(params, event_callback, self.monitor_hbcli)
-
-    def run_remote(self, sshcli: str, user: str, ip: str, params: list, event_callback) -> Optional[int]:
-        return self.remote_execute_and_monitor(sshcli, user, ip, params, event_callback, self.monitor_hbcli)
-
+    def prepare(self, params: List[str]) -> Tuple[List[str], OutputParser, Optional[TextIO]]:
+        self.open_log()
+        return params, StatusParser(self.monitor_interval), None
@@ -0,0 +1,246 @@
+"""
+    Work queue shared by the encoding threads
+"""
+import asyncio
+import heapq
+import itertools
+from threading import Condition, RLock
+from typing import Any, Optional, List, Tuple, Callable, Iterator
+
+# queue ordering policies
+JOB_ORDERS = ('fifo', 'longest', 'shortest', 'priority')
+
+
+def job_order(order: str) -> Optional[Callable[[Any], Any]]:
+    """Sort key putting jobs in the order of a policy, lowest first. None for first in, first out.
+
+    Jobs are expected to have a `work` estimate (runtime times frame size) and a `priority` (higher first).
+    """
+    if order == 'longest':
+        return lambda job: -job.work
+    if order == 'shortest':
+        return lambda job: job.work
+    if order == 'priority':
+        return lambda job: -job.priority
+    return None
+
+
+def in_order(heap: List) -> Iterator:
+    """Entries of a heap lowest first, only walking it as far as they are taken"""
+    if not heap:
+        return
+    # the entries next in line are always children of ones already given
+    frontier = [(heap[0], 0)]
+    while frontier:
+        entry, index = heapq.heappop(frontier)
+        yield entry
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+
+
+class JobQueue:
+    """Thread-safe queue of pending jobs which can be consumed while it is still being filled.
+
+    Workers block in get() until a job arrives. Once the producer calls close() and the
+    remaining jobs are taken, get() returns None to tell the workers there is nothing more to do.
+
+    Jobs are handed out first in, first out unless a sort key is given. Since the order only means something
+    once all jobs are known, an ordered queue holds on to its jobs until it is closed.
+    """
+
+    def __init__(self, key: Optional[Callable[[Any], Any]] = None):
+        """
+        :param key: Sort key of jobs, lowest first, equal keys in order of arrival
+        """
+        self._jobs: List[Tuple[Any, int, Any]] = list()     # heap of (sort key, arrival, job)
+        self._key = key
+        self._arrivals = itertools.count()
+        self._closed = False
+        self._unfinished = 0
+        self._lock = RLock()
+        self._cond = Condition(self._lock)
+        # coroutines waiting for a job, with the test of the jobs they may take (None for any)
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future, Optional[Callable[[Any], bool]]]] = \
+            list()
+        # workers of other queues watching this one, likewise
+        self._watchers: List[Tuple[Condition, Optional[Callable[[Any], bool]]]] = list()
+        self._linked = False
+
+    @staticmethod
+    def link(queues: List['JobQueue']):
+        """Have the queues share one lock, for workers that watch several. Call before any is used"""
+        lock = queues[0]._lock
+        for queue in queues:
+            queue._lock = lock
+            queue._cond = Condition(lock)
+            queue._linked = True
+
+    def put(self, job: Any):
+        with self._cond:
+            if self._closed:
+                raise ValueError('put() on a closed JobQueue')
+            heapq.heappush(self._jobs, (self._key(job) if self._key is not None else 0, next(self._arrivals), job))
+            self._unfinished += 1
+            self._cond.notify()
+            if self._linked:
+                # the job may also be taken by workers of other queues, wake those that could
+                for cond, accepts in self._watchers:
+                    if accepts is None or accepts(job):
+                        cond.notify_all()
+                self._wake_waiters(job)
+            else:
+                self._wake_waiters(job, only_one=True)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Optional[Any]:
+        """Take the next job, waiting for one if needed.
+
+        :param block:   If False, return None immediately when no job is waiting
+        :param timeout: Maximum seconds to wait when blocking
+        :return:        The next job, or None if closed and drained (or nothing arrived in time)
+        """
+        with self._cond:
+            if block:
+                self._cond.wait_for(lambda: self._ready() or self._closed, timeout)
+            if self._ready():
+                return heapq.heappop(self._jobs)[2]
+            return None
+
+    async def get_async(self) -> Optional[Any]:
+        """Same as a blocking get(), for workers running as coroutines in an event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._ready():
+                    return heapq.heappop(self._jobs)[2]
+                if self._closed:
+                    return None
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter, None))
+            await waiter
+
+    def _ready(self) -> bool:
+        return len(self._jobs) > 0 and (self._key is None or self._closed)
+
+    def _wake_waiters(self, job: Any = None, only_one: bool = False):
+        """Release the coroutines that could take job, all of them if None"""
+        # called with the lock held, possibly from another thread than the loop of a waiter
+        remaining = list()
+        released = False
+        for loop, waiter, accepts in self._waiters:
+            if waiter.done():
+                continue
+            if (only_one and released) or not (job is None or accepts is None or accepts(job)):
+                remaining.append((loop, waiter, accepts))
+                continue
+            loop.call_soon_threadsafe(_release, waiter)
+            released = True
+        self._waiters[:] = remaining
+
+    def close(self):
+        """No more jobs will be added, release any waiting workers once drained"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            for cond, _ in self._watchers:
+                cond.notify_all()
+            self._wake_waiters()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def task_done(self):
+        with self._cond:
+            self._unfinished -= 1
+            self._cond.notify_all()
+
+    def join(self):
+        """Wait until every job put on the queue has been processed"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._unfinished <= 0)
+
+    def qsize(self) -> int:
+        return len(self._jobs)
+
+    def empty(self) -> bool:
+        return len(self._jobs) == 0
+
+
+class StealingQueue:
+    """The view of one worker on its own queue, taking jobs it is eligible for from other queues when idle.
+
+    Offers the same get()/get_async()/task_done() interface as a JobQueue. All queues involved must be linked
+    with JobQueue.link() first. A job arriving on another queue only wakes the worker if it is eligible for it.
+    """
+
+    def __init__(self, own: JobQueue, others: List[JobQueue], eligible: Callable[[Any], bool]):
+        """
+        :param own:         Queue of the worker, always served first
+        :param others:      Queues to take from when the own queue has nothing ready
+        :param eligible:    Tells whether a job from another queue may run on this worker
+        """
+        self.own = own
+        self.others = others
+        self.eligible = eligible
+        self._cond = Condition(own._lock)
+        self._taken = own       # queue the current job came from
+        with self._cond:
+            own._watchers.append((self._cond, None))
+            for other in others:
+                other._watchers.append((self._cond, eligible))
+
+    def _pick(self) -> Tuple[Optional[JobQueue], Optional[Tuple[Any, int, Any]]]:
+        if self.own._ready():
+            return self.own, self.own._jobs[0]
+        for other in self.others:
+            if other._ready():
+                for entry in in_order(other._jobs):
+                    if self.eligible(entry[2]):
+                        return other, entry
+        return None, None
+
+    def _finished(self) -> bool:
+        return self.own._closed and all(other._closed for other in self.others)
+
+    def _pop(self) -> Optional[Any]:
+        queue, entry = self._pick()
+        if queue is None:
+            return None
+        if queue is self.own:
+            heapq.heappop(queue._jobs)
+        else:
+            queue._jobs.remove(entry)
+            heapq.heapify(queue._jobs)
+        self._taken = queue
+        return entry[2]
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Optional[Any]:
+        """Take the next job of the own queue, else an eligible one of another queue, waiting for one if needed"""
+        with self._cond:
+            if block:
+                self._cond.wait_for(lambda: self._pick()[0] is not None or self._finished(), timeout)
+            return self._pop()
+
+    async def get_async(self) -> Optional[Any]:
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                job = self._pop()
+                if job is not None:
+                    return job
+                if self._finished():
+                    return None
+                waiter = loop.create_future()
+                self.own._waiters.append((loop, waiter, None))
+                for other in self.others:
+                    other._waiters.append((loop, waiter, self.eligible))
+            await waiter
+
+    def task_done(self):
+        self._taken.task_done()
+
+
+def _release(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
@@ -0,0 +1,66 @@
+"""
+    Journal of job events as JSON lines, for analysis after the fact
+"""
+import json
+import time
+from threading import Lock
+from typing import Dict, Any, Optional
+
+from pytranscoder.events import JobEvents, ENDED
+
+
+class Journal:
+    """Appends one JSON object per job event to a file.
+
+    Phase times are not written as they come in but gathered per file and added to the last event of the job,
+    along with the profile and mixins it ran with, so every outcome can be analyzed from a single line. Dry runs
+    end with a planned event, with the profile and mixins that would have been used.
+    """
+
+    def __init__(self, path: str):
+        self._lock = Lock()
+        self.path = path
+        self.file = open(path, 'a', encoding='utf-8')
+        self.jobs: Dict[str, Dict[str, Any]] = dict()       # path -> details of jobs in flight
+
+    @staticmethod
+    def from_config(configfile, events: JobEvents) -> Optional['Journal']:
+        """Open the configured journal and start listening to job events, if any"""
+        if configfile.journal is None:
+            return None
+        journal = Journal(configfile.journal)
+        events.listen(journal)
+        return journal
+
+    def __call__(self, event: str, fields: Dict[str, Any]):
+        path = str(fields['path'])
+        with self._lock:
+            if self.file.closed:
+                return
+            job = self.jobs.get(path)
+            if job is None:
+                job = self.jobs[path] = {'phases': dict()}
+            if event == 'phase':
+                phases = job['phases']
+                phases[fields['phase']] = round(phases.get(fields['phase'], 0.0) + fields['seconds'], 3)
+                return
+
+            record = {'time': round(time.time(), 3), 'event': event, **fields, 'path': path}
+            if event == 'started':
+                job['profile'] = fields.get('profile')
+                job['mixins'] = fields.get('mixins')
+            elif event in ENDED or event == 'planned' or (event == 'matched' and fields.get('skip')) or \
+                    (event == 'probed' and not fields.get('valid')):
+                # nothing more will happen to this file
+                del self.jobs[path]
+                record.setdefault('profile', job.get('profile'))
+                record.setdefault('mixins', job.get('mixins'))
+                record['phases'] = job['phases']
+
+            self.file.write(json.dumps(record, default=str) + '\n')
+            if event in ENDED or event == 'planned':
+                self.file.flush()
+
+    def close(self):
+        with self._lock:
+            self.file.close()
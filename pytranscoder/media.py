@@ -4,8 +4,6 @@ import re
 from datetime import timedelta
 from typing import Dict, Optional, List
 
-from pytranscoder import verbose
-
 #video_re = re.compile(r'^.*Duration: (\d+):(\d+):.* Stream .*: Video: (\w+).*, (\w+)[(,].* (\d+)x(\d+).* (\d+)(\.\d.)? fps,.*$',
 #                      re.DOTALL)
 from pytranscoder.profile import Profile
@@ -35,6 +33,28 @@ class MediaInfo:
         self.audio = info['audio']
         self.subtitle = info['subtitle']
 
+    def as_dict(self) -> Dict:
+        """Return the parsed details in the same form accepted by the constructor"""
+        return {
+            'path': self.path,
+            'vcodec': self.vcodec,
+            'stream': self.stream,
+            'res_height': self.res_height,
+            'res_width': self.res_width,
+            'runtime': self.runtime,
+            'filesize_mb': self.filesize_mb,
+            'fps': self.fps,
+            'colorspace': self.colorspace,
+            'audio': self.audio,
+            'subtitle': self.subtitle
+        }
+
+    @property
+    def work(self) -> float:
+        """Rough measure of the effort to encode this video, pixels over the whole runtime, else its size"""
+        pixels = int(self.runtime or 0) * int(self.res_width or 0) * int(self.res_height or 0)
+        return float(pixels) if pixels > 0 else float(self.filesize_mb or 0)
+
     def __str__(self):
         runtime = "{:0>8}".format(str(timedelta(seconds=self.runtime)))
         audios = [a['stream'] + ':' + a['lang'] + ':' + a['format'] + ':' + a['default'] for a in self.audio]
@@ -112,54 +132,6 @@ class MediaInfo:
         subtitle_streams = self._map_streams("s", self.subtitle, excl_subtitle, incl_subtitle, defl_subtitle)
         return seq_list + audio_streams + subtitle_streams
 
-    def eval_numeric(self, rulename: str, pred: str, value: str) -> bool:
-        attr = self.__dict__.get(pred, None)
-        if attr is None:
-            print(f'Error: Rule "{rulename}" unknown attribute: {pred} ')
-            raise ValueError(value)
-
-        if '-' in value:
-            # this is a range expression
-            parts = value.split('-')
-            if len(parts) != 2:
-                print(f'Error: Rule "{rulename}" bad range expression: {value} ')
-                raise ValueError(value)
-            rangelow, rangehigh = parts
-
-            if pred == 'runtime':
-                rangelow = str(int(rangelow) * 60)
-                rangehigh = str(int(rangehigh) * 60)
-
-            expr = f'{rangelow} <= {attr} <= {rangehigh}'
-
-        elif value.isnumeric():
-            # simple numeric equality test
-
-            if pred == 'runtime':
-                # convert to seconds
-                value = str(int(value) * 60)
-
-            expr = f'{attr} == {value}'
-
-        elif value[0] in '<>':
-            op = value[0]
-            value = value[1:]
-
-            if pred == 'runtime':
-                value = str(int(value) * 60)
-
-            expr = f'{attr} {op} {value}'
-
-        else:
-            print(f'Error: Rule "{rulename}" valid value: {value}')
-            return False
-
-        if not eval(expr):
-            if verbose:
-                print(f'  >> predicate {pred} ("{value}") did not match {attr}')
-            return False
-        return True
-
     @staticmethod
     def parse_ffmpeg_details(_path, output):
 
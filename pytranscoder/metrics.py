@@ -0,0 +1,248 @@
+"""
+    Live metrics of a batch in Prometheus text format, served over http or written to a file
+"""
+import os
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread, Event
+from typing import Dict, Any, List, Optional, Tuple
+
+from pytranscoder.events import JobEvents, ENDED
+
+# phase latency histogram buckets, in seconds
+BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400)
+
+
+def _float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _labels(**labels) -> str:
+    text = ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                    for name, value in labels.items())
+    return '{' + text + '}'
+
+
+class Metrics:
+    """Aggregates job events into counters, gauges and histograms.
+
+    Register an instance as a JobEvents listener. Only totals and the state of running jobs are kept,
+    so memory use doesn't grow with the length of a batch.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.queued: Dict[str, int] = dict()                        # queue -> waiting jobs
+        self.active: Dict[str, Tuple[str, str]] = dict()            # path -> (host, queue) of running jobs
+        self.rates: Dict[str, Tuple[float, float]] = dict()         # path -> latest (fps, speed)
+        self.outcomes: Dict[Tuple[str, str, str], int] = dict()     # (host, queue, outcome) -> jobs
+        self.bytes_in: Dict[str, int] = dict()                      # host -> source bytes of completed jobs
+        self.bytes_out: Dict[str, int] = dict()                     # host -> output bytes of completed jobs
+        self.cpu: Dict[str, float] = dict()                         # host -> encoder cpu seconds, local jobs only
+        self.phases: Dict[str, List[float]] = dict()                # phase -> bucket counts, then sum and count
+
+    def __call__(self, event: str, fields: Dict[str, Any]):
+        with self._lock:
+            if event == 'queued':
+                queue = fields['queue']
+                self.queued[queue] = self.queued.get(queue, 0) + 1
+            elif event == 'dispatched':
+                queue = fields['queue']
+                self.queued[queue] = max(0, self.queued.get(queue, 0) - 1)
+            elif event == 'started':
+                self.active[str(fields['path'])] = (fields['host'], fields['queue'])
+            elif event == 'progress':
+                path = str(fields['path'])
+                if path in self.active:
+                    self.rates[path] = (_float(fields.get('fps')), _float(fields.get('speed')))
+            elif event == 'phase':
+                self._observe(fields['phase'], fields['seconds'])
+            elif event in ENDED:
+                self._end(event, fields)
+
+    def _end(self, event: str, fields: Dict[str, Any]):
+        path = str(fields['path'])
+        host, queue = fields['host'], fields['queue']
+        self.active.pop(path, None)
+        self.rates.pop(path, None)
+        outcome = {'finished': 'completed', 'aborted': 'skipped'}.get(event, event)
+        key = (host, queue, outcome)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+        usage = fields.get('usage')
+        if usage is not None:
+            self.cpu[host] = self.cpu.get(host, 0.0) + usage['user_time'] + usage['system_time']
+        if event == 'finished':
+            self.bytes_in[host] = self.bytes_in.get(host, 0) + fields.get('size_in', 0)
+            self.bytes_out[host] = self.bytes_out.get(host, 0) + fields.get('size_out', 0)
+
+    def _observe(self, phase: str, seconds: float):
+        histogram = self.phases.get(phase)
+        if histogram is None:
+            histogram = self.phases[phase] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def render(self) -> str:
+        """Current values in the Prometheus text exposition format"""
+        out = list()
+
+        def family(name: str, kind: str, text: str):
+            out.append(f'# HELP {name} {text}')
+            out.append(f'# TYPE {name} {kind}')
+
+        with self._lock:
+            family('pytranscoder_jobs_queued', 'gauge', 'Jobs waiting in a queue')
+            for queue, count in sorted(self.queued.items()):
+                out.append(f'pytranscoder_jobs_queued{_labels(queue=queue)} {count}')
+
+            running: Dict[Tuple[str, str], int] = dict()
+            fps: Dict[str, float] = dict()
+            speed: Dict[str, float] = dict()
+            for path, (host, queue) in self.active.items():
+                running[(host, queue)] = running.get((host, queue), 0) + 1
+                job_fps, job_speed = self.rates.get(path, (0.0, 0.0))
+                fps[host] = fps.get(host, 0.0) + job_fps
+                speed[host] = speed.get(host, 0.0) + job_speed
+            for host, queue, _ in self.outcomes:
+                running.setdefault((host, queue), 0)
+
+            family('pytranscoder_jobs_running', 'gauge', 'Jobs being encoded')
+            for (host, queue), count in sorted(running.items()):
+                out.append(f'pytranscoder_jobs_running{_labels(host=host, queue=queue)} {count}')
+
+            for outcome, text in (('completed', 'Jobs encoded and kept'),
+                                  ('failed', 'Jobs that failed to encode or transfer'),
+                                  ('skipped', 'Jobs discarded for not meeting the savings threshold')):
+                name = f'pytranscoder_jobs_{outcome}_total'
+                family(name, 'counter', text)
+                for (host, queue), _ in sorted(running.items()):
+                    count = self.outcomes.get((host, queue, outcome), 0)
+                    out.append(f'{name}{_labels(host=host, queue=queue)} {count}')
+
+            hosts = sorted({host for host, _ in running} | set(fps))
+            family('pytranscoder_encode_fps', 'gauge', 'Frames per second of all running encodes')
+            for host in hosts:
+                out.append(f'pytranscoder_encode_fps{_labels(host=host)} {fps.get(host, 0.0):g}')
+            family('pytranscoder_encode_speed', 'gauge', 'Sum of the realtime speed factors of all running encodes')
+            for host in hosts:
+                out.append(f'pytranscoder_encode_speed{_labels(host=host)} {speed.get(host, 0.0):g}')
+
+            family('pytranscoder_bytes_in_total', 'counter', 'Size of the sources of completed jobs')
+            for host in hosts:
+                out.append(f'pytranscoder_bytes_in_total{_labels(host=host)} {self.bytes_in.get(host, 0)}')
+            family('pytranscoder_bytes_out_total', 'counter', 'Size of the outputs of completed jobs')
+            for host in hosts:
+                out.append(f'pytranscoder_bytes_out_total{_labels(host=host)} {self.bytes_out.get(host, 0)}')
+            family('pytranscoder_compression_ratio', 'gauge', 'Output to source size of completed jobs')
+            for host in hosts:
+                size_in = self.bytes_in.get(host, 0)
+                ratio = self.bytes_out.get(host, 0) / size_in if size_in else 0.0
+                out.append(f'pytranscoder_compression_ratio{_labels(host=host)} {ratio:.4f}')
+
+            family('pytranscoder_encode_cpu_seconds_total', 'counter', 'CPU time used by finished local encoders')
+            for host in sorted(self.cpu):
+                out.append(f'pytranscoder_encode_cpu_seconds_total{_labels(host=host)} {self.cpu[host]:.3f}')
+
+            family('pytranscoder_phase_seconds', 'histogram', 'Time spent per job phase')
+            for phase, histogram in self.phases.items():
+                for bound, count in zip(BUCKETS, histogram):
+                    out.append(f'pytranscoder_phase_seconds_bucket{_labels(phase=phase, le=f"{bound:g}")} {count}')
+                out.append(f'pytranscoder_phase_seconds_bucket{_labels(phase=phase, le="+Inf")} {histogram[-1]}')
+                out.append(f'pytranscoder_phase_seconds_sum{_labels(phase=phase)} {histogram[-2]:.3f}')
+                out.append(f'pytranscoder_phase_seconds_count{_labels(phase=phase)} {histogram[-1]}')
+
+        return '\n'.join(out) + '\n'
+
+
+class MetricsExporter:
+    """Publishes Metrics while a batch runs, at an http endpoint and/or as a node_exporter textfile"""
+
+    INTERVAL = 15.0
+
+    def __init__(self, metrics: Metrics, listen: Optional[str] = None, path: Optional[str] = None,
+                 interval: float = INTERVAL):
+        """
+        :param listen:  Port, or address:port, to serve /metrics on
+        :param path:    File to rewrite every interval seconds
+        """
+        self.metrics = metrics
+        self.listen = listen
+        self.path = path
+        self.interval = interval
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.threads: List[Thread] = list()
+        self._done = Event()
+
+    @staticmethod
+    def from_config(configfile, events: JobEvents) -> Optional['MetricsExporter']:
+        """Set up an exporter listening to job events, if metrics are configured"""
+        if configfile.metrics_port is None and configfile.metrics_file is None:
+            return None
+        metrics = Metrics()
+        events.listen(metrics)
+        return MetricsExporter(metrics, configfile.metrics_port, configfile.metrics_file)
+
+    def start(self):
+        if self.listen is not None:
+            address, _, port = str(self.listen).rpartition(':')
+            self.server = ThreadingHTTPServer((address or '127.0.0.1', int(port)), self._handler())
+            self.server.daemon_threads = True
+            self.threads.append(Thread(name='metrics-http', target=self.server.serve_forever, daemon=True))
+        if self.path is not None:
+            self.threads.append(Thread(name='metrics-file', target=self._refresh, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """Stop publishing, leaving the final values in the textfile"""
+        self._done.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.path is not None:
+            self.write()
+
+    def write(self):
+        """Replace the textfile atomically, so a collector never reads it half written"""
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.metrics.render())
+            f.write('# HELP pytranscoder_last_update_seconds Unix time the textfile was last written\n'
+                    '# TYPE pytranscoder_last_update_seconds gauge\n'
+                    f'pytranscoder_last_update_seconds {time.time():.0f}\n')
+        os.replace(tmp, self.path)
+
+    def _refresh(self):
+        while True:
+            self.write()
+            if self._done.wait(self.interval):
+                break
+
+    def _handler(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # keep scrapes off the console
+                pass
+
+        return Handler
@@ -0,0 +1,172 @@
+"""
+    Encode time predictions from the speed of earlier jobs
+"""
+import datetime
+import heapq
+import json
+import os
+from threading import Lock
+from typing import Dict, Any, List, Optional, Tuple
+
+from pytranscoder.events import JobEvents, ENDED
+
+
+def resolution(height: int) -> str:
+    """Resolution bucket of a video, as speeds are similar within one"""
+    if height < 720:
+        return 'sd'
+    if height < 1080:
+        return '720p'
+    if height < 2160:
+        return '1080p'
+    return '2160p'
+
+
+def format_duration(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+class SpeedHistory:
+    """Encode speed (media seconds per wall clock second) learned from finished jobs and kept on disk.
+
+    Speeds are tracked per profile, source video codec, resolution bucket and host. Register an instance as
+    a JobEvents listener and it learns from every successful encode.
+    """
+
+    # after this many jobs, older ones gradually count less
+    WINDOW = 10
+
+    def __init__(self, path: Optional[str] = None):
+        self._lock = Lock()
+        self.path = path
+        self.speeds: Dict[str, Dict[str, float]] = dict()     # key -> {'speed', 'jobs'}
+        self.pending: Dict[str, Dict[str, Any]] = dict()      # path -> what is known about a running job
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.speeds = json.load(f).get('speeds', dict())
+            except (OSError, ValueError):
+                print(f'Ignoring unreadable speed history {path}')
+
+    @staticmethod
+    def from_config(configfile, events: JobEvents) -> Optional['SpeedHistory']:
+        if configfile.speed_history is None:
+            return None
+        history = SpeedHistory(configfile.speed_history)
+        events.listen(history)
+        return history
+
+    @staticmethod
+    def key(profile: str, vcodec: str, height: int, host: str) -> str:
+        return '|'.join([profile, vcodec, resolution(height), host])
+
+    def learn(self, profile: str, vcodec: str, height: int, host: str, speed: float):
+        key = SpeedHistory.key(profile, vcodec, height, host)
+        with self._lock:
+            entry = self.speeds.setdefault(key, {'speed': speed, 'jobs': 0})
+            entry['jobs'] += 1
+            # a plain average at first, then a moving one that follows changes in hardware or settings
+            entry['speed'] += (speed - entry['speed']) / min(entry['jobs'], SpeedHistory.WINDOW)
+
+    def speed(self, profile: str, vcodec: str, height: int, host: Optional[str] = None) -> Optional[Tuple[float, int]]:
+        """Expected speed and the number of jobs it is based on.
+
+        Falls back to other hosts, then to other source codecs of the same resolution, if there's no exact match.
+        """
+        bucket = resolution(height)
+        with self._lock:
+            if host is not None:
+                entry = self.speeds.get(SpeedHistory.key(profile, vcodec, height, host))
+                if entry is not None:
+                    return entry['speed'], int(entry['jobs'])
+            for wanted in ([profile, vcodec, bucket], [profile, None, bucket]):
+                total = jobs = 0
+                for key, entry in self.speeds.items():
+                    parts = key.split('|')
+                    if parts[0] == wanted[0] and parts[2] == wanted[2] and wanted[1] in (None, parts[1]):
+                        total += entry['speed'] * entry['jobs']
+                        jobs += entry['jobs']
+                if jobs > 0:
+                    return total / jobs, int(jobs)
+        return None
+
+    def predict(self, profile: str, vcodec: str, height: int, runtime: float,
+                host: Optional[str] = None) -> Optional[float]:
+        """Expected encode time in seconds, or None without any history to go on"""
+        expected = self.speed(profile, vcodec, height, host)
+        if expected is None or expected[0] <= 0:
+            return None
+        return runtime / expected[0]
+
+    def describe(self, profile: str, info, host: Optional[str] = None) -> Optional[str]:
+        """Expected encode time of a media file as shown to the user, None without history"""
+        expected = self.speed(profile, info.vcodec, info.res_height, host)
+        if expected is None or expected[0] <= 0:
+            return None
+        speed, jobs = expected
+        return f'{format_duration(info.runtime / speed)} at {speed:.2f}x (from {jobs} jobs)'
+
+    def __call__(self, event: str, fields: Dict[str, Any]):
+        path = str(fields['path'])
+        job = None
+        with self._lock:
+            if event == 'probed':
+                if fields.get('valid'):
+                    self.pending[path] = {'vcodec': fields['vcodec'], 'height': fields['height'],
+                                          'runtime': fields['runtime']}
+            elif event == 'started':
+                if path in self.pending:
+                    self.pending[path].update(profile=fields['profile'], host=fields['host'])
+            elif event == 'phase':
+                if fields['phase'] == 'encode' and path in self.pending:
+                    self.pending[path]['encode'] = fields['seconds']
+            elif event in ENDED or event == 'planned' or (event == 'matched' and fields.get('skip')):
+                job = self.pending.pop(path, None)
+        # skipped jobs did encode in full, just not small enough
+        if event in ('finished', 'skipped') and job is not None and job.get('encode', 0) > 0 \
+                and job['runtime'] > 0 and 'profile' in job:
+            self.learn(job['profile'], job['vcodec'], job['height'], job['host'], job['runtime'] / job['encode'])
+
+    def save(self):
+        """Write the learned speeds, replacing the file atomically"""
+        if self.path is None:
+            return
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with self._lock:
+            with open(tmp, 'w') as f:
+                json.dump({'speeds': self.speeds}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def makespan(jobs: List[Tuple[str, float]], slots: Dict[str, int]) -> float:
+    """Estimated wall clock time to run all jobs, given the concurrent slots of each queue.
+
+    Each queue hands its jobs to the first free slot, modelled by assigning the longest jobs first.
+
+    :param jobs:    (queue name, expected seconds) of every job
+    """
+    by_queue: Dict[str, List[float]] = dict()
+    for queue, seconds in jobs:
+        by_queue.setdefault(queue, list()).append(seconds)
+    longest = 0.0
+    for queue, durations in by_queue.items():
+        loads = [0.0] * max(1, slots.get(queue, 1))
+        for seconds in sorted(durations, reverse=True):
+            heapq.heapreplace(loads, loads[0] + seconds)
+        longest = max(longest, max(loads))
+    return longest
+
+
+def batch_estimate(jobs: List[Tuple[str, Optional[float]]], slots: Dict[str, int]) -> Optional[str]:
+    """Summary line of the expected batch duration and finish time, or None if nothing could be predicted"""
+    known = [(queue, seconds) for queue, seconds in jobs if seconds is not None]
+    if len(known) == 0:
+        return None
+    seconds = makespan(known, slots)
+    finish = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    text = f'Estimated encoding time for {len(known)} files: {format_duration(seconds)}, ' \
+           f'done around {finish:%Y-%m-%d %H:%M}'
+    unknown = len(jobs) - len(known)
+    if unknown > 0:
+        text += f' ({unknown} more files without speed history)'
+    return text
@@ -0,0 +1,111 @@
+"""
+    Getting the next jobs of a slot ready while the current one encodes
+"""
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Optional
+
+from pytranscoder.jobqueue import JobQueue
+
+
+class Prefetcher:
+    """The view of one slot on its queue, staging jobs (like copying the source to a remote host) ahead of time.
+
+    A background thread takes up to `depth` jobs from the queue ahead of the slot and stages them, so the slot
+    finds its next job ready the moment the current one is done. Offers the get()/get_async()/task_done()
+    interface of a JobQueue.
+    """
+
+    def __init__(self, queue: JobQueue, stage: Callable[[Any], bool], depth: int = 1,
+                 room: Optional[Callable[[Any], bool]] = None, wait: float = 10):
+        """
+        :param queue:   Queue to take the jobs from
+        :param stage:   Gets a job ready, False if it failed and the job is to be dropped
+        :param depth:   Number of jobs to stage ahead of the slot
+        :param room:    Tells whether there is space to stage a job now. While there isn't, staging waits for
+                        jobs ahead, in progress or still finishing to be done, and goes ahead once there are none.
+        :param wait:    Seconds between checks of room while waiting
+        """
+        self.queue = queue
+        self.stage = stage
+        self.depth = depth
+        self.room = room
+        self.wait = wait
+        self.staged = JobQueue()
+        self._cond = Condition()
+        self._ahead = 0         # jobs staged or being staged, not yet taken by the slot
+        self._busy = 0          # jobs taken by the slot and not yet done
+        self._finishing = 0     # jobs done by the slot, with their wrap up (ie. retrieving results) still going on
+        self._thread: Optional[Thread] = None
+        self._start_lock = Lock()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='prefetch', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._ahead < self.depth)
+            job = self.queue.get()
+            if job is None:
+                break
+            if self.room is not None:
+                while not self.room(job):
+                    with self._cond:
+                        if self._ahead == 0 and self._busy == 0 and self._finishing == 0:
+                            # nothing to wait for that would free up space, try anyway
+                            break
+                        self._cond.wait(self.wait)
+            with self._cond:
+                self._ahead += 1
+            try:
+                staged = self.stage(job)
+            except Exception as ex:
+                print(ex)
+                staged = False
+            if staged:
+                self.staged.put(job)
+            else:
+                with self._cond:
+                    self._ahead -= 1
+                    self._cond.notify_all()
+                self.queue.task_done()
+        self.staged.close()
+
+    def _taken(self):
+        with self._cond:
+            self._ahead -= 1
+            self._busy += 1
+            self._cond.notify_all()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Optional[Any]:
+        self._start()
+        job = self.staged.get(block, timeout)
+        if job is not None:
+            self._taken()
+        return job
+
+    async def get_async(self) -> Optional[Any]:
+        self._start()
+        job = await self.staged.get_async()
+        if job is not None:
+            self._taken()
+        return job
+
+    def task_done(self):
+        with self._cond:
+            self._busy -= 1
+            self._cond.notify_all()
+        self.queue.task_done()
+
+    def finishing(self):
+        """A job is handed off to be wrapped up in the background, taking up room until finished()"""
+        with self._cond:
+            self._finishing += 1
+
+    def finished(self):
+        with self._cond:
+            self._finishing -= 1
+            self._cond.notify_all()
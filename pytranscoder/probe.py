@@ -0,0 +1,225 @@
+"""
+    Concurrent media probing, with an optional persistent cache of results
+"""
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from functools import partial
+from threading import Lock
+from typing import Iterator, List, Tuple, Optional
+
+import pytranscoder
+from pytranscoder.media import MediaInfo
+from pytranscoder.processor import Processor
+
+
+class ProbeCache:
+    """Persistent (sqlite) store of parsed media details.
+
+    Entries are keyed on the absolute path and are only valid while the file size and modification time
+    are unchanged. Least recently used entries are evicted once the cache grows beyond max_entries.
+    """
+
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        """
+        :param path:        Location of the cache database
+        :param max_entries: Maximum number of media files remembered
+        """
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        self._lock = Lock()
+        self._pending = 0
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS probes '
+                         '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, info TEXT, accessed REAL)')
+        self._db.commit()
+
+    @staticmethod
+    def _key(path: str) -> Optional[Tuple[str, int, int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+    def get(self, path: str) -> Optional[MediaInfo]:
+        key = self._key(path)
+        if key is None:
+            return None
+        abspath, size, mtime = key
+        with self._lock:
+            row = self._db.execute('SELECT info FROM probes WHERE path=? AND size=? AND mtime=?',
+                                   (abspath, size, mtime)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute('UPDATE probes SET accessed=? WHERE path=?', (time.time(), abspath))
+            self._changed()
+        info = json.loads(row[0])
+        info['path'] = path
+        return MediaInfo(info)
+
+    def put(self, path: str, media_info: MediaInfo):
+        if media_info is None or not media_info.valid:
+            return
+        key = self._key(path)
+        if key is None:
+            return
+        abspath, size, mtime = key
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO probes (path, size, mtime, info, accessed) VALUES (?,?,?,?,?)',
+                             (abspath, size, mtime, json.dumps(media_info.as_dict()), time.time()))
+            self._changed()
+
+    def _changed(self):
+        self._pending += 1
+        if self._pending >= ProbeCache.COMMIT_INTERVAL:
+            self._db.commit()
+            self._pending = 0
+
+    def evict(self):
+        """Drop least recently used entries beyond the size limit"""
+        with self._lock:
+            count = self._db.execute('SELECT COUNT(*) FROM probes').fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute('DELETE FROM probes WHERE path IN '
+                                 '(SELECT path FROM probes ORDER BY accessed LIMIT ?)', (count - self.max_entries,))
+            self._db.commit()
+            self._pending = 0
+
+    def purge(self):
+        with self._lock:
+            self._db.execute('DELETE FROM probes')
+            self._db.commit()
+            self._db.execute('VACUUM')
+            self._pending = 0
+
+    def close(self):
+        self.evict()
+        self._db.close()
+
+
+class MediaProbe:
+    """Fetch media details for many files at once using a pool of workers.
+
+    Each probe is a blocking ffmpeg/HandBrakeCLI subprocess, so running several at once keeps
+    the machine busy while waiting on slow (network) storage. Results are always returned in input order.
+    """
+
+    def __init__(self, workers: int = 1, pool: str = 'thread', cache: Optional[ProbeCache] = None):
+        """
+        :param workers: Maximum number of concurrent probes
+        :param pool:    Type of worker pool, either "thread" or "process"
+        :param cache:   Optional persistent cache consulted before probing
+        """
+        self.workers = max(1, workers)
+        self.pool = pool
+        self.cache = cache
+        self._lock = Lock()        # guards the cache against probes still finishing while it is closed
+
+    @staticmethod
+    def from_config(configfile) -> 'MediaProbe':
+        cache = None
+        if configfile.probe_cache is not None and pytranscoder.use_probe_cache:
+            cache = ProbeCache(configfile.probe_cache, configfile.probe_cache_max)
+        return MediaProbe(configfile.probe_workers, configfile.probe_pool, cache)
+
+    def fetch_all(self, requests: List[Tuple[Processor, str]]) -> Iterator[MediaInfo]:
+        """Probe all requested files, yielding each MediaInfo in input order as soon as it is available
+
+        :param requests:    list of (processor, path) tuples
+        """
+        try:
+            if self.workers == 1 or len(requests) < 2:
+                for processor, path in requests:
+                    yield self._probed(path, self.fetch(processor, path))
+                return
+
+            if self.pool == 'process':
+                # workers can't share the cache, so answer what we can from it up front
+                executor = ProcessPoolExecutor(max_workers=min(self.workers, len(requests)))
+                futures = list()
+                for processor, path in requests:
+                    with pytranscoder.timings.measure(path, 'probe'):
+                        info = self._cached(path)
+                    if info is not None:
+                        future = Future()
+                        future.set_result((info, 0.0))
+                    else:
+                        future = executor.submit(_timed_fetch, processor, path)
+                        future.add_done_callback(partial(self._store, path))
+                    futures.append(future)
+            else:
+                executor = ThreadPoolExecutor(max_workers=min(self.workers, len(requests)),
+                                              thread_name_prefix='probe')
+                futures = [executor.submit(self.fetch, processor, path) for processor, path in requests]
+            try:
+                for (_, path), future in zip(requests, futures):
+                    if self.pool == 'process':
+                        # (media info, seconds) from _timed_fetch
+                        yield self._probed(path, future.result()[0])
+                    else:
+                        yield self._probed(path, future.result())
+            finally:
+                # don't wait on probes nobody will consume (ie. early exit)
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+        finally:
+            # probes cut short by an early exit may still be storing results, so they must see the cache gone
+            with self._lock:
+                cache, self.cache = self.cache, None
+                if cache is not None:
+                    if pytranscoder.verbose:
+                        print(f'probe cache: {cache.hits} hits, {cache.misses} misses')
+                    cache.close()
+
+    def fetch(self, processor: Processor, path: str) -> MediaInfo:
+        """Probe a single file, consulting the cache first"""
+        with pytranscoder.timings.measure(path, 'probe'):
+            info = self._cached(path)
+            if info is not None:
+                return info
+            info = processor.fetch_details(path)
+            self._remember(path, info)
+            return info
+
+    def _cached(self, path: str) -> Optional[MediaInfo]:
+        with self._lock:
+            return self.cache.get(path) if self.cache is not None else None
+
+    def _remember(self, path: str, info: MediaInfo):
+        with self._lock:
+            if self.cache is not None:
+                self.cache.put(path, info)
+
+    @staticmethod
+    def _probed(path: str, info: Optional[MediaInfo]) -> Optional[MediaInfo]:
+        path = os.path.abspath(path)
+        if info is not None and info.valid:
+            pytranscoder.job_events.emit('probed', path=path, valid=True, vcodec=info.vcodec,
+                                         width=info.res_width, height=info.res_height, runtime=info.runtime,
+                                         filesize_mb=info.filesize_mb, fps=info.fps)
+        else:
+            pytranscoder.job_events.emit('probed', path=path, valid=False)
+        return info
+
+    def _store(self, path: str, future: Future):
+        if not future.cancelled() and future.exception() is None:
+            info, seconds = future.result()
+            pytranscoder.timings.record(path, 'probe', seconds)
+            self._remember(path, info)
+
+
+def _timed_fetch(processor: Processor, path: str) -> Tuple[MediaInfo, float]:
+    # runs in a worker process, so the time is passed back with the result
+    start = time.perf_counter()
+    info = processor.fetch_details(path)
+    return info, time.perf_counter() - start
@@ -1,8 +1,143 @@
+import datetime
+import itertools
+import os
 import subprocess
+import sys
+import threading
+from collections import deque
 from pathlib import PurePath
-from typing import Optional
+from tempfile import gettempdir
+from typing import Optional, Dict, Any, List, Tuple, TextIO, Callable
 
+import pytranscoder
+from pytranscoder.admission import AdmissionControl
+from pytranscoder.agentclient import AgentClient
 from pytranscoder.media import MediaInfo
+from pytranscoder.resources import ResourceClaim
+
+
+# numbers the transaction logs of this process
+_log_ids = itertools.count(1)
+
+
+class TransactionLog:
+    """Encoder output for one run, left behind on disk only if the run fails or is aborted.
+
+    Normally just the last few hundred lines are held in memory. In full mode every line is written
+    straight through to the log file instead, as it arrives.
+    """
+
+    LINES = 500
+
+    def __init__(self, path: PurePath, full: bool = False):
+        self.path = path
+        self.lines = deque(maxlen=TransactionLog.LINES)
+        self.file = open(str(path), 'w') if full else None
+
+    def write(self, line: str):
+        if self.file is not None:
+            self.file.write(line)
+            self.file.flush()
+        else:
+            self.lines.append(line)
+
+    def keep(self):
+        if self.file is not None:
+            self.file.close()
+        else:
+            with open(str(self.path), 'w') as logfile:
+                logfile.writelines(self.lines)
+
+    def discard(self):
+        if self.file is not None:
+            self.file.close()
+            os.remove(str(self.path))
+        self.lines.clear()
+
+
+class ResourceUsage:
+    """What an encoder process cost: CPU seconds, peak memory and bytes read/written through system calls"""
+
+    def __init__(self, user_time: float = 0.0, system_time: float = 0.0, max_rss: int = 0,
+                 read_bytes: int = 0, write_bytes: int = 0):
+        self.user_time = user_time
+        self.system_time = system_time
+        self.max_rss = max_rss                  # bytes
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_time + self.system_time
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'user_time': round(self.user_time, 3),
+            'system_time': round(self.system_time, 3),
+            'max_rss': self.max_rss,
+            'read_bytes': self.read_bytes,
+            'write_bytes': self.write_bytes,
+        }
+
+    @staticmethod
+    def read_io(pid: int) -> Tuple[int, int]:
+        """Bytes read and written so far by a process (Linux only, 0 elsewhere)"""
+        read_bytes = write_bytes = 0
+        try:
+            with open(f'/proc/{pid}/io') as f:
+                for line in f:
+                    name, _, value = line.partition(':')
+                    if name == 'rchar':
+                        read_bytes = int(value)
+                    elif name == 'wchar':
+                        write_bytes = int(value)
+        except (OSError, ValueError):
+            pass
+        return read_bytes, write_bytes
+
+    @staticmethod
+    def sample(pid: int) -> Optional['ResourceUsage']:
+        """Usage of a running (or not yet reaped) process so far, from /proc. None if not available"""
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # skip past the command name, which may contain spaces
+                fields = f.read().rpartition(')')[2].split()
+            ticks = os.sysconf('SC_CLK_TCK')
+            max_rss = 0
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        max_rss = int(line.split()[1]) * 1024
+                        break
+        except (OSError, ValueError, IndexError):
+            return None
+        return ResourceUsage(int(fields[11]) / ticks, int(fields[12]) / ticks, max_rss, *ResourceUsage.read_io(pid))
+
+    def __str__(self):
+        return f'cpu {self.user_time:.1f}s user {self.system_time:.1f}s sys, ' \
+               f'peak {self.max_rss / 1048576:.0f} MB, read {self.read_bytes / 1048576:.0f} MB, ' \
+               f'write {self.write_bytes / 1048576:.0f} MB'
+
+
+class OutputParser:
+    """Picks progress stats out of encoder output, one line at a time, at most once per interval"""
+
+    # lines are copied to the transaction log
+    logged = True
+
+    def __init__(self, interval: int):
+        self.diff = datetime.timedelta(seconds=interval)
+        self.event = datetime.datetime.now() + self.diff
+
+    def due(self) -> bool:
+        now = datetime.datetime.now()
+        if now > self.event:
+            self.event = now + self.diff
+            return True
+        return False
+
+    def feed(self, line: str) -> Optional[Dict[str, Any]]:
+        return None
 
 
 class Processor:
@@ -10,7 +145,10 @@ class Processor:
     def __init__(self, path: str):
         self.path = path
         self.log_path: PurePath = None
+        self.transaction_log: Optional[TransactionLog] = None
         self.last_command = ''
+        self.last_usage: Optional[ResourceUsage] = None
+        self.monitor_interval = 30
 
     @property
     def is_available(self) -> bool:
@@ -25,44 +163,280 @@ class Processor:
     def fetch_details(self, _path: str) -> MediaInfo:
         return None
 
+    def prepare(self, params: List[str]) -> Tuple[List[str], OutputParser, Optional[TextIO]]:
+        """Open the transaction log and decide how the encoder is run and monitored.
+
+        :param params:  Encoder command line parameters
+        :return:        Final parameters, parser for the stdout lines, and where stderr goes (None to merge into stdout)
+        """
+        self.open_log()
+        return params, OutputParser(self.monitor_interval), None
+
+    def prepare_piped(self, params: List[str]) -> Tuple[List[str], OutputParser]:
+        """Same as prepare(), for runs where stdout carries the media and the output is read from stderr"""
+        self.open_log()
+        return params, OutputParser(self.monitor_interval)
+
+    def prepare_agent(self, params: List[str]) -> Tuple[List[str], OutputParser, bool]:
+        """Same as prepare(), for runs by a host agent. The flag tells whether the agent is to send progress records"""
+        params, parser, _ = self.prepare(params)
+        return params, parser, False
+
+    def agent_stats(self, block: Dict[str, str]) -> Dict[str, Any]:
+        """Progress stats from a progress record sent by a host agent"""
+        return block
+
+    def remote_command(self, ssh: List[str], params: List[str]) -> List[str]:
+        return [*ssh, self.path, *params]
+
+    def monitor(self, proc: subprocess.Popen, parser: OutputParser, stream: Optional[TextIO] = None,
+                usage: bool = True):
+        """
+        :param stream:  Where the encoder output is read from, stdout if not given
+        :param usage:   Record the resource usage of proc, see reap()
+        """
+        for line in stream or proc.stdout:
+            if parser.logged and self.transaction_log is not None:
+                self.transaction_log.write(line)
+            stats = parser.feed(line)
+            if stats is not None:
+                yield stats
+        self.reap(proc, usage)
+
+    def reap(self, proc: subprocess.Popen, usage: bool = True) -> int:
+        """Wait for the encoder to exit and record its resource usage, where the platform reports it
+
+        :param usage:   False if proc is not the encoder itself, like ssh running it on another host
+        """
+        self.last_usage = None
+        if not usage or not hasattr(os, 'wait4') or proc.returncode is not None:
+            return proc.wait()
+        if hasattr(os, 'waitid'):
+            # wait for the exit without reaping, the I/O counters are gone once reaped
+            os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        read_bytes, write_bytes = ResourceUsage.read_io(proc.pid)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        # ru_maxrss is in kilobytes, except on macOS
+        max_rss = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+        self.last_usage = ResourceUsage(rusage.ru_utime, rusage.ru_stime, max_rss, read_bytes, write_bytes)
+        return proc.returncode
+
     def run(self, params, event_callback) -> Optional[int]:
-        return None
+        params, parser, stderr = self.prepare(params)
+        return self.execute_and_monitor(params, event_callback, lambda proc: self.monitor(proc, parser),
+                                        stderr=stderr or subprocess.STDOUT)
 
-    def run_remote(self, sshcli: str, user: str, ip: str, params: list, event_callback) -> Optional[int]:
-        return None
+    def run_remote(self, ssh: List[str], params: list, event_callback) -> Optional[int]:
+        params, parser, stderr = self.prepare(params)
+        # the usage of ssh says nothing about the encoder on the host
+        return self.remote_execute_and_monitor(ssh, params, event_callback,
+                                               lambda proc: self.monitor(proc, parser, usage=False),
+                                               stderr=stderr or subprocess.STDOUT)
 
-    def execute_and_monitor(self, params, event_callback, monitor) -> Optional[int]:
+    def run_piped(self, ssh: List[str], params: list, event_callback, source: str, target: str) -> Optional[int]:
+        """Run on another host with the media passed through the ssh connection.
+
+        :param source:  Local file fed to the encoder on stdin
+        :param target:  Local file the encoder output (its stdout) is written to
+        """
+        params, parser = self.prepare_piped(params)
+        cli = self.remote_command(ssh, params)
+        self.last_command = ' '.join(cli)
+        code = None
+        try:
+            with open(source, 'rb') as stdin, open(target, 'wb') as stdout, \
+                    subprocess.Popen(cli,
+                                     stdin=stdin,
+                                     stdout=stdout,
+                                     stderr=subprocess.PIPE,
+                                     universal_newlines=True,
+                                     shell=False) as p:
+                try:
+                    for stats in self.monitor(p, parser, p.stderr, usage=False):
+                        if event_callback is not None:
+                            veto = event_callback(stats)
+                            if veto:
+                                p.kill()
+                                return None
+                    code = p.returncode
+                    return code
+                except KeyboardInterrupt:
+                    p.kill()
+        finally:
+            self.close_log(code)
+
+    def run_agent(self, agent: AgentClient, params: list, event_callback) -> Optional[int]:
+        """Run on another host by the agent resident there, which sends back progress and exit as records"""
+        params, parser, progress = self.prepare_agent(params)
         self.last_command = ' '.join([self.path, *params])
-        with subprocess.Popen([self.path,
-                               *params],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True,
-                              shell=False) as p:
-
-            for stats in monitor(p):
-                if event_callback is not None:
+        code = None
+        try:
+            job = agent.run([self.path, *params], progress)
+            for record in job:
+                if record['event'] == 'exit':
+                    code = record['code']
+                    return code
+                stats = self.read_agent_record(record, parser)
+                if stats is not None and event_callback is not None:
                     veto = event_callback(stats)
                     if veto:
-                        p.kill()
+                        job.kill()
+                        for _ in job:
+                            pass
                         return None
-            return p.returncode
+        finally:
+            self.close_log(code)
+
+    def read_agent_record(self, record: Dict[str, Any], parser: OutputParser) -> Optional[Dict[str, Any]]:
+        """Progress stats in a record sent by a host agent, if any, logging the output it carries"""
+        if record['event'] == 'output':
+            if parser.logged and self.transaction_log is not None:
+                self.transaction_log.write(record['line'])
+            return parser.feed(record['line'])
+        if record['event'] == 'progress' and parser.due():
+            return self.agent_stats(record['stats'])
+        return None
+
+    def open_log(self, full: bool = False) -> TransactionLog:
+        """Start the transaction log for a run, to be left behind if an error is encountered"""
+        # slots of the asyncio engine share a thread, so the thread name alone doesn't tell their logs apart
+        self.log_path = PurePath(gettempdir(), f'pytranscoder-{threading.current_thread().name}-{os.getpid()}-'
+                                               f'{next(_log_ids)}.log')
+        self.transaction_log = TransactionLog(self.log_path, full or pytranscoder.full_log)
+        return self.transaction_log
+
+    def close_log(self, code: Optional[int]):
+        if self.transaction_log is None:
+            return
+        if code == 0:
+            # everything went fine, so no need for the transaction log
+            self.transaction_log.discard()
+            self.log_path = None
+        else:
+            self.transaction_log.keep()
+        self.transaction_log = None
+
+    def execute_and_monitor(self, params, event_callback, monitor, stderr=subprocess.STDOUT) -> Optional[int]:
+        self.last_command = ' '.join([self.path, *params])
+        code = None
+        try:
+            with subprocess.Popen([self.path,
+                                   *params],
+                                  stdout=subprocess.PIPE,
+                                  stderr=stderr,
+                                  universal_newlines=True,
+                                  shell=False) as p:
 
-    def remote_execute_and_monitor(self, sshcli: str, user: str, ip: str, params: list, event_callback, monitor) -> Optional[int]:
-        cli = [sshcli, '-v', user + '@' + ip, self.path, *params]
-        self.last_command = ' '.join(cli)
-        with subprocess.Popen(cli,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.STDOUT,
-                              universal_newlines=True,
-                              shell=False) as p:
-            try:
                 for stats in monitor(p):
                     if event_callback is not None:
                         veto = event_callback(stats)
                         if veto:
                             p.kill()
+                            self.reap(p)
                             return None
-                return p.returncode
-            except KeyboardInterrupt:
-                p.kill()
+                code = p.returncode
+                return code
+        finally:
+            self.close_log(code)
+
+    def remote_execute_and_monitor(self, ssh: List[str], params: list, event_callback, monitor,
+                                   stderr=subprocess.STDOUT) -> Optional[int]:
+        """
+        :param ssh: ssh command line to reach the host, the remote command is added to it
+        """
+        cli = self.remote_command(ssh, params)
+        self.last_command = ' '.join(cli)
+        code = None
+        try:
+            with subprocess.Popen(cli,
+                                  stdout=subprocess.PIPE,
+                                  stderr=stderr,
+                                  universal_newlines=True,
+                                  shell=False) as p:
+                try:
+                    for stats in monitor(p):
+                        if event_callback is not None:
+                            veto = event_callback(stats)
+                            if veto:
+                                p.kill()
+                                return None
+                    code = p.returncode
+                    return code
+                except KeyboardInterrupt:
+                    p.kill()
+        finally:
+            self.close_log(code)
+
+
+class Encode:
+    """One prepared encoder run - the part of a job spent waiting on a child process.
+
+    Built by a host with everything needed to run the encoder, plus what to do with the result.
+    """
+
+    def __init__(self, processor: Processor, params: List[str], event_callback: Callable,
+                 finish: Callable[[Optional[int], datetime.timedelta], None],
+                 remote: Optional[List[str]] = None, claim: Optional[ResourceClaim] = None,
+                 admission: Optional[AdmissionControl] = None, workdir: Optional[str] = None,
+                 source: Optional[str] = None, target: Optional[str] = None, agent: Optional[AgentClient] = None):
+        """
+        :param finish:      Called with the exit code (None if cancelled) and elapsed time once the encoder is done
+        :param remote:      ssh command line to reach the host when the encoder is run on another one
+        :param claim:       Shared resources to hold while the encoder runs, waiting for them before it starts
+        :param admission:   Checks the machine has room for another encoder before it starts
+        :param workdir:     Directory the encoder writes to, for the free disk space check of admission
+        :param source:      Local file to feed the remote encoder on stdin, instead of it reading a copy of its own
+        :param target:      Local file to write the remote encoder stdout to, when given a source
+        :param agent:       Agent on the remote host to run the encoder, instead of starting it over ssh
+        """
+        self.processor = processor
+        self.params = params
+        self.event_callback = event_callback
+        self.remote = remote
+        self.claim = claim
+        self.admission = admission
+        self.workdir = workdir
+        self.source = source
+        self.target = target
+        self.agent = agent
+        self._finish = finish
+        self.started: Optional[datetime.datetime] = None
+        self.stopped: Optional[datetime.datetime] = None
+
+    @property
+    def piped(self) -> bool:
+        return self.remote is not None and self.source is not None
+
+    @property
+    def elapsed(self) -> datetime.timedelta:
+        if self.started is None or self.stopped is None:
+            return datetime.timedelta()
+        return self.stopped - self.started
+
+    def run(self) -> Optional[int]:
+        """Run the encoder in the calling thread"""
+        if self.admission is not None:
+            self.admission.admit(self.workdir)
+        if self.claim is not None:
+            self.claim.acquire()
+        self.started = datetime.datetime.now()
+        try:
+            if self.piped:
+                return self.processor.run_piped(self.remote, self.params, self.event_callback, self.source,
+                                                self.target)
+            if self.agent is not None:
+                return self.processor.run_agent(self.agent, self.params, self.event_callback)
+            if self.remote is not None:
+                return self.processor.run_remote(self.remote, self.params, self.event_callback)
+            return self.processor.run(self.params, self.event_callback)
+        finally:
+            self.stopped = datetime.datetime.now()
+            if self.claim is not None:
+                self.claim.release()
+
+    def finish(self, code: Optional[int]):
+        self._finish(code, self.elapsed)
@@ -1,6 +1,6 @@
 
 from __future__ import annotations
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 
 
 class Options:
@@ -61,6 +61,27 @@ class Options:
         return z
 
 
+class CommandTemplate:
+    """Prebuilt, immutable encoder options for a profile and mixins combination.
+
+    Only the input/output paths and stream mappings are filled in per job.
+    """
+    __slots__ = ('is_ffmpeg', 'input_options', 'output_options')
+
+    def __init__(self, is_ffmpeg: bool, input_options: List[str], output_options: List[str]):
+        self.is_ffmpeg = is_ffmpeg
+        self.input_options: Tuple[str, ...] = tuple(input_options)
+        self.output_options: Tuple[str, ...] = tuple(output_options)
+
+    def build(self, inpath: str, outpath: str, streams: Optional[List[str]] = None) -> List[str]:
+        """Make the command line parameters (sans the processor path itself) for one job"""
+        if self.is_ffmpeg:
+            if streams:
+                return ['-y', *self.input_options, '-i', inpath, *self.output_options, *streams, outpath]
+            return ['-y', *self.input_options, '-i', inpath, *self.output_options, outpath]
+        return ['-i', inpath, *self.input_options, *self.output_options, '-o', outpath]
+
+
 class Profile:
     def __init__(self, name: str, profile: Optional[Dict] = None):
         self.profile: Dict[str, Any] = profile
@@ -132,6 +153,19 @@ class Profile:
     def queue_name(self, name: str):
         self.profile["queue"] = name
 
+    @property
+    def fallback_queues(self) -> List[str]:
+        """Other queues allowed to run this profile when they have idle slots"""
+        return self.profile.get('fallback_queues', None) or list()
+
+    @property
+    def resources(self) -> Dict[str, int]:
+        """Tokens taken from the shared resource pools while encoding, a list meaning one of each"""
+        resources = self.profile.get('resources', None) or dict()
+        if isinstance(resources, list):
+            return {name: 1 for name in resources}
+        return {name: int(count) for name, count in resources.items()}
+
     @property
     def threshold(self) -> int:
         return self.profile.get('threshold', 0)
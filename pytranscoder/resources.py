@@ -0,0 +1,91 @@
+"""
+    Pools of shared hardware, like encoder sessions or cpu cores, that jobs draw from before they start
+"""
+import asyncio
+from threading import Condition
+from typing import Dict, List, Optional, Tuple
+
+
+class ResourcePool:
+    """Named counts of tokens shared by every encoding slot of this process, whatever queue it serves.
+
+    A job takes all the tokens it needs at once or waits until it can, so a job needing several pools
+    never holds on to some while waiting for others.
+    """
+
+    def __init__(self, limits: Optional[Dict[str, int]] = None):
+        self.limits: Dict[str, int] = {name: int(count) for name, count in (limits or dict()).items()}
+        self.available: Dict[str, int] = dict(self.limits)
+        self._cond = Condition()
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = list()
+
+    def _fits(self, needs: Dict[str, int]) -> bool:
+        return all(self.available.get(name, 0) >= count for name, count in needs.items())
+
+    def _take(self, needs: Dict[str, int]):
+        for name, count in needs.items():
+            self.available[name] -= count
+
+    def acquire(self, needs: Dict[str, int], timeout: Optional[float] = None) -> bool:
+        """Take the tokens, waiting until all are available. False if that did not happen in time"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fits(needs), timeout):
+                return False
+            self._take(needs)
+            return True
+
+    async def acquire_async(self, needs: Dict[str, int]):
+        """Same as acquire(), for slots running as coroutines in an event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self._fits(needs):
+                    self._take(needs)
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(self, needs: Dict[str, int]):
+        with self._cond:
+            for name, count in needs.items():
+                self.available[name] += count
+            self._cond.notify_all()
+            # any of the waiters may fit now, let them all check
+            while self._waiters:
+                loop, waiter = self._waiters.pop(0)
+                if not waiter.cancelled():
+                    loop.call_soon_threadsafe(_release, waiter)
+
+    def claim(self, needs: Dict[str, int]) -> Optional['ResourceClaim']:
+        """The tokens one job needs, to be taken right before its encoder starts. None if it needs none"""
+        if len(needs) == 0:
+            return None
+        return ResourceClaim(self, needs)
+
+
+class ResourceClaim:
+    """Tokens of a pool needed by one encode, which it holds from acquire() until release()"""
+
+    def __init__(self, pool: ResourcePool, needs: Dict[str, int]):
+        self.pool = pool
+        self.needs = needs
+        self.held = False
+
+    def acquire(self):
+        self.pool.acquire(self.needs)
+        self.held = True
+
+    async def acquire_async(self):
+        await self.pool.acquire_async(self.needs)
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.pool.release(self.needs)
+
+
+def _release(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
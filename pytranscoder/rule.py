@@ -1,5 +1,6 @@
+import operator
 import re
-from typing import Dict
+from typing import Dict, Callable, List, Optional, Pattern, Iterable, Tuple
 
 from pytranscoder import verbose
 from pytranscoder.media import MediaInfo
@@ -7,68 +8,257 @@ from pytranscoder.media import MediaInfo
 valid_predicates = ['vcodec', 'res_height', 'res_width', 'runtime', 'filesize_mb', 'fps', 'path']
 numeric_predicates = ['res_height', 'res_width', 'runtime', 'filesize_mb', 'fps']
 
+# criteria used to bucket rules in a RuleIndex
+indexed_predicates = ['vcodec', 'res_height']
+
+# numbered back-reference or conditional group in a regex pattern
+backref_re = re.compile(r'\\[1-9]|\(\?\(')
+
+Predicate = Callable[[MediaInfo, Optional['PathScan']], bool]
+
+
+def compile_numeric(pred: str, value) -> Callable[[float], bool]:
+    """Parse a numeric criteria expression (ex. "<500", "720-1081", "24") into a test function.
+
+    :raises ValueError: if the expression cannot be parsed
+    """
+    value = str(value).strip()
+    # runtime criteria are given in minutes but compared against seconds
+    scale = 60 if pred == 'runtime' else 1
+
+    try:
+        if '-' in value:
+            # this is a range expression
+            parts = value.split('-')
+            if len(parts) != 2:
+                raise ValueError(value)
+            rangelow = float(parts[0]) * scale
+            rangehigh = float(parts[1]) * scale
+            return lambda attr: rangelow <= attr <= rangehigh
+
+        if len(value) > 0 and value[0] in '<>':
+            op = operator.lt if value[0] == '<' else operator.gt
+            bound = float(value[1:]) * scale
+            return lambda attr: op(attr, bound)
+
+        # simple numeric equality test
+        target = float(value) * scale
+        return lambda attr: attr == target
+
+    except ValueError:
+        raise ValueError(f'bad numeric expression for {pred}: {value}') from None
+
+
+class PathMatcher:
+    """Screens a media path against the path regexes of all rules in one pass.
+
+    Patterns without back-references are joined into a single alternation. If that finds nothing in a path
+    then none of those patterns can match, so individual patterns only run for paths that hit.
+    """
+
+    def __init__(self, rules: Iterable['Rule']):
+        self.slots: Dict[Pattern, int] = dict()
+        self.patterns: List[Pattern] = list()
+        alternatives = list()
+        combinable = list()
+        for rule in rules:
+            rule.path_matcher = self
+            rule.path_slots = list()
+            for regex in rule.path_patterns:
+                if regex in self.slots:
+                    rule.path_slots.append(self.slots[regex])
+                    continue
+                self.slots[regex] = len(self.patterns)
+                rule.path_slots.append(len(self.patterns))
+                self.patterns.append(regex)
+                if regex.groupindex or backref_re.search(regex.pattern):
+                    # group back-references would be renumbered (or names duplicated) if combined
+                    combinable.append(False)
+                    continue
+                try:
+                    re.compile(f'(?:{regex.pattern})', regex.flags)
+                except re.error:
+                    # ie. global inline flags, only valid at the start of a pattern
+                    combinable.append(False)
+                    continue
+                combinable.append(True)
+                alternatives.append(f'(?:{regex.pattern})')
+        self.combined = re.compile('|'.join(alternatives)) if alternatives else None
+        # starting results for a path the combined pattern did not match
+        self.missed = [False if c else None for c in combinable]
+
+    def scan(self, path: str) -> 'PathScan':
+        return PathScan(self, path)
+
+
+class PathScan:
+    """Path regex results for one media path, evaluated lazily and remembered"""
+
+    def __init__(self, matcher: PathMatcher, path: str):
+        self.matcher = matcher
+        self.path = path
+        self.results: Optional[List[Optional[bool]]] = None
+
+    def search(self, slot: int) -> bool:
+        if self.results is None:
+            matcher = self.matcher
+            if matcher.combined is not None and matcher.combined.search(self.path) is None:
+                self.results = list(matcher.missed)
+            else:
+                self.results = [None] * len(matcher.patterns)
+        hit = self.results[slot]
+        if hit is None:
+            hit = self.matcher.patterns[slot].search(self.path) is not None
+            self.results[slot] = hit
+        return hit
+
 
 class Rule:
     def __init__(self, name: str, rule: Dict):
+        """
+        :raises ValueError: if the criteria contain an unknown predicate or an expression that can't be parsed
+        """
         self.name = name
         self.profile = rule['profile']
-        if 'criteria' in rule:
-            self.criteria = rule['criteria']
-        else:
-            self.criteria = None
+        self.priority = int(rule.get('priority', 0))
+        self.criteria = None
+        if 'criteria' in rule and rule['criteria'] is not None:
+            criteria = rule['criteria']
+            if isinstance(criteria, list):
+                # tolerate criteria written as a yaml list of single-entry mappings
+                criteria = {k: v for item in criteria for k, v in item.items()}
+            self.criteria = criteria
+        self.path_patterns: List[Pattern] = list()
+        self.path_matcher: Optional[PathMatcher] = None     # set once bound by a PathMatcher
+        self.path_slots: List[int] = list()
+        self.index_predicates: List[Predicate] = list()
+        self.predicates: List[Predicate] = self.compile()
 
     def is_skip(self):
         return self.profile.upper() == 'SKIP'
 
-    def match(self, media_info: MediaInfo) -> bool:
-        if verbose:
-            print(f' > evaluating "{self.name}"')
-
+    def compile(self) -> List[Predicate]:
+        """Turn the criteria into a list of predicate functions, evaluated in order, that all must be true"""
+        predicates = list()
         if self.criteria is None:
-            # no criteria section, match by default
-            if verbose:
-                print(f'  >> rule {self.name} selected by default (no criteria)')
-            return True
+            return predicates
 
         for pred, value in self.criteria.items():
             inverted = False
             if pred not in valid_predicates:
-                print(f'Invalid predicate {pred} in rule {self.name}')
-                exit(1)
+                raise ValueError(f'Invalid predicate {pred}')
             if isinstance(value, str) and len(value) > 1 and value[0] == '!':
                 inverted = True
                 value = value[1:]
-            if pred == 'vcodec' and not inverted and media_info.vcodec != value:
+
+            if pred == 'vcodec':
+                predicate = self._compile_vcodec(value, inverted)
+            elif pred == 'path':
+                predicate = self._compile_path(value, inverted)
+            else:
+                predicate = self._compile_numeric(pred, value, inverted)
+            predicates.append(predicate)
+            if pred in indexed_predicates:
+                self.index_predicates.append(predicate)
+        return predicates
+
+    def could_match(self, media_info: MediaInfo) -> bool:
+        """Check only the indexed criteria, used to prune rules that can never match"""
+        for predicate in self.index_predicates:
+            if not predicate(media_info, None):
+                return False
+        return True
+
+    @staticmethod
+    def _compile_vcodec(value: str, inverted: bool) -> Predicate:
+        def predicate(media_info: MediaInfo, scan: Optional[PathScan]) -> bool:
+            if (media_info.vcodec == value) == inverted:
                 if verbose:
-                    print(f'  >> predicate vcodec ("{value}") did not match {media_info.vcodec}')
-                break
-            if pred == 'vcodec' and inverted and media_info.vcodec == value:
+                    print(f'  >> predicate vcodec ("{"!" if inverted else ""}{value}") did not match {media_info.vcodec}')
+                return False
+            return True
+        return predicate
+
+    def _compile_path(self, value: str, inverted: bool) -> Predicate:
+        try:
+            regex = re.compile(value)
+        except re.error as ex:
+            raise ValueError(f'invalid regex {value}: {ex}') from None
+        index = len(self.path_patterns)
+        self.path_patterns.append(regex)
+
+        def predicate(media_info: MediaInfo, scan: Optional[PathScan]) -> bool:
+            if scan is not None and scan.matcher is self.path_matcher:
+                hit = scan.search(self.path_slots[index])
+            else:
+                hit = regex.search(media_info.path) is not None
+            if hit == inverted:
                 if verbose:
-                    print(f'  >> predicate vcodec ("{value}") matched {media_info.vcodec}')
-                break
-            if pred == 'path':
-                try:
-                    match = re.search(value, media_info.path)
-                    if match is None:
-                        if verbose:
-                            print(f'  >> predicate path ("{value}") did not match {media_info.path}')
-                        break
-                except Exception as ex:
-                    print(f'invalid regex {media_info.path} in rule {self.name}')
-                    if verbose:
-                        print(str(ex))
-                    exit(0)
-
-            if pred in numeric_predicates:
-                comp = media_info.eval_numeric(self.name, pred, value)
-                if not comp and not inverted:
-                    # mismatch
-                    break
-                if comp and inverted:
-                    # mismatch
-                    break
-        else:
-            # didn't bail out on any predicates, have a match
+                    print(f'  >> predicate path ("{value}") did not match {media_info.path}')
+                return False
+            return True
+        return predicate
+
+    @staticmethod
+    def _compile_numeric(pred: str, value, inverted: bool) -> Predicate:
+        test = compile_numeric(pred, value)
+
+        def predicate(media_info: MediaInfo, scan: Optional[PathScan]) -> bool:
+            attr = getattr(media_info, pred, None)
+            if attr is None:
+                if verbose:
+                    print(f'  >> predicate {pred} ("{value}") has no media attribute to match')
+                return False
+            if test(float(attr)) == inverted:
+                if verbose:
+                    print(f'  >> predicate {pred} ("{value}") did not match {attr}')
+                return False
+            return True
+        return predicate
+
+    def match(self, media_info: MediaInfo, scan: Optional[PathScan] = None) -> bool:
+        """Check if all criteria match the media
+
+        :param scan:    Shared path regex results for this media, if evaluating many rules
+        """
+        if verbose:
+            print(f' > evaluating "{self.name}"')
+
+        if self.criteria is None:
+            # no criteria section, match by default
+            if verbose:
+                print(f'  >> rule {self.name} selected by default (no criteria)')
             return True
 
-        return False
+        for predicate in self.predicates:
+            if not predicate(media_info, scan):
+                return False
+
+        # didn't bail out on any predicates, have a match
+        return True
+
+
+class RuleIndex:
+    """Pre-selects the rules that could match a media file while keeping their original order.
+
+    Rules are bucketed on the video codec and height of the media, and on the profiles a cluster host
+    is restricted to. Each bucket is built on first use and reused for all similar media.
+    """
+
+    MAX_BUCKETS = 4096
+
+    def __init__(self, rules: Iterable[Rule]):
+        self.rules: List[Rule] = list(rules)
+        self.buckets: Dict[Tuple, Tuple[Rule, ...]] = dict()
+
+    def candidates(self, media_info: MediaInfo, restrict_profiles=None) -> Tuple[Rule, ...]:
+        restrict = tuple(restrict_profiles) if restrict_profiles is not None else None
+        key = (media_info.vcodec, media_info.res_height, restrict)
+        bucket = self.buckets.get(key, None)
+        if bucket is None:
+            bucket = tuple(rule for rule in self.rules
+                           if (restrict is None or rule.profile in restrict) and rule.could_match(media_info))
+            if len(self.buckets) >= RuleIndex.MAX_BUCKETS:
+                self.buckets.clear()
+            self.buckets[key] = bucket
+        return bucket
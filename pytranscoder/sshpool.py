@@ -0,0 +1,151 @@
+"""
+    Shared ssh connections to cluster hosts
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from threading import Lock
+from typing import Dict, List, Optional
+
+
+class SshConnection:
+    """One ssh connection to a host, shared by every command and copy sent its way.
+
+    With multiplexing on, a master connection is started in the background the first time the host is used,
+    and later ssh and scp runs go through its control socket instead of doing their own handshake. A master
+    that died (dropped network, rebooted host) is noticed before the next use and replaced. Without it, every
+    command opens its own connection as before, which is also what happens for a while after a master failed
+    to start.
+    """
+
+    # seconds a healthy master is trusted before checking on it again, and a failed one before trying again
+    CHECK_INTERVAL = 10
+    # seconds to wait for a new master to be up
+    CONNECT_TIMEOUT = 30
+
+    def __init__(self, ssh: str, user: str, ip: str, control_dir: Optional[str] = None, persist: int = 300):
+        """
+        :param ssh:         Path to local ssh
+        :param control_dir: Where to keep the control socket, None to not multiplex
+        :param persist:     Seconds an idle master stays up
+        """
+        self.ssh = ssh
+        self.target = f'{user}@{ip}'
+        self.persist = persist
+        self.multiplex = control_dir is not None and os.name != 'nt'
+        self.control_path = None
+        if self.multiplex:
+            # socket paths are limited to ~100 characters, so keep the name short
+            self.control_path = os.path.join(control_dir, 'cm-' + hashlib.sha1(self.target.encode()).hexdigest()[:16])
+        self._lock = Lock()
+        self._checked = 0.0
+        self._failed: Optional[float] = None      # time.monotonic() the last master failed to start
+
+    def _backing_off(self) -> bool:
+        return self._failed is not None and time.monotonic() - self._failed < SshConnection.CHECK_INTERVAL
+
+    def options(self) -> List[str]:
+        """ssh/scp options to go through the master connection, none while there is no master to go through"""
+        if not self.multiplex or self._backing_off():
+            return []
+        return self._control_options()
+
+    def _control_options(self) -> List[str]:
+        return ['-o', f'ControlPath={self.control_path}', '-o', 'ControlMaster=no']
+
+    def alive(self) -> bool:
+        if not self.multiplex or not os.path.exists(self.control_path):
+            return False
+        check = subprocess.run([self.ssh, '-O', 'check', *self._control_options(), self.target],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return check.returncode == 0
+
+    def connect(self) -> bool:
+        """Make sure there is a working master connection, starting a new one if needed.
+
+        :return: False if no master could be started. Commands still work then, just without reuse.
+        """
+        if not self.multiplex:
+            return True
+        with self._lock:
+            if self._backing_off():
+                # don't have every command wait on another failing attempt
+                return False
+            if time.monotonic() - self._checked < SshConnection.CHECK_INTERVAL:
+                return True
+            if not self.alive():
+                try:
+                    # left behind by a master that died
+                    os.remove(self.control_path)
+                except OSError:
+                    pass
+                try:
+                    # -f only returns once authenticated, leaving the master running in the background
+                    master = subprocess.run([self.ssh, '-f', '-N', '-o', 'ControlMaster=yes',
+                                             '-o', f'ControlPath={self.control_path}',
+                                             '-o', f'ControlPersist={self.persist}',
+                                             '-o', 'ServerAliveInterval=15', '-o', 'ServerAliveCountMax=3',
+                                             '-o', 'BatchMode=yes', self.target],
+                                            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL, timeout=SshConnection.CONNECT_TIMEOUT)
+                    started = master.returncode == 0
+                except subprocess.TimeoutExpired:
+                    started = False
+                if not started:
+                    self._failed = time.monotonic()
+                    return False
+            self._failed = None
+            self._checked = time.monotonic()
+            return True
+
+    def command(self, *ssh_options: str) -> List[str]:
+        """Command line up to the remote command, to which the caller adds the remote command and arguments"""
+        self.connect()
+        return [self.ssh, *ssh_options, *self.options(), self.target]
+
+    def scp(self, source: str, target: str) -> List[str]:
+        """scp command line, with remote paths given as host:path (see remote())"""
+        self.connect()
+        return ['scp', *self.options(), source, target]
+
+    def remote(self, path: str) -> str:
+        return f'{self.target}:{path}'
+
+    def close(self):
+        """Stop the master connection, if there is one"""
+        if self.alive():
+            subprocess.run([self.ssh, '-O', 'exit', *self._control_options(), self.target],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class SshPool:
+    """The connections to all hosts of a run, one per user and host however many slots use it"""
+
+    def __init__(self, ssh: str, multiplex: bool = False, persist: int = 300):
+        self.ssh = ssh
+        self.multiplex = multiplex
+        self.persist = persist
+        self.connections: Dict[str, SshConnection] = dict()
+        self.control_dir: Optional[str] = None
+        self._lock = Lock()
+
+    def get(self, user: str, ip: str) -> SshConnection:
+        with self._lock:
+            key = f'{user}@{ip}'
+            if key not in self.connections:
+                if self.multiplex and self.control_dir is None:
+                    self.control_dir = tempfile.mkdtemp(prefix='pytranscoder-ssh-')
+                self.connections[key] = SshConnection(self.ssh, user, ip, self.control_dir, self.persist)
+            return self.connections[key]
+
+    def close(self):
+        with self._lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+            if self.control_dir is not None:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
+                self.control_dir = None
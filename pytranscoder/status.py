@@ -0,0 +1,154 @@
+"""
+    Progress reporting of running encodes
+"""
+import sys
+from threading import Lock, Thread, Event
+from typing import Dict, Any, List, Tuple, Optional, TextIO
+
+
+class StatusBoard:
+    """Latest progress report of every running encode, keyed on host and file.
+
+    Encoding threads overwrite their own entry with each sample, so memory use only depends on the
+    number of running jobs. A StatusRenderer periodically shows the board.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries: Dict[Tuple[str, str], Dict[str, Any]] = dict()
+        self._updated: Dict[Tuple[str, str], int] = dict()
+        self._version = 0
+
+    def put(self, report: Dict[str, Any]):
+        """Record a progress report, a dict with host, file, speed, comp and done keys"""
+        key = (report['host'], report['file'])
+        with self._lock:
+            self._version += 1
+            self._entries[key] = report
+            self._updated[key] = self._version
+
+    def remove(self, host: str, file: str):
+        """Drop the entry of a finished encode"""
+        with self._lock:
+            if self._entries.pop((host, file), None) is not None:
+                del self._updated[(host, file)]
+                self._version += 1
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def snapshot(self, since: int = 0) -> Tuple[int, List[Dict[str, Any]]]:
+        """Get the current version and the reports updated after version `since`, in order of first appearance"""
+        with self._lock:
+            return self._version, [report for key, report in self._entries.items() if self._updated[key] > since]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _TrackedOutput:
+    """Stands in for sys.stdout to notice when anything else was printed after the status table"""
+
+    def __init__(self, stream: TextIO):
+        self.stream = stream
+        self.dirty = True
+
+    def write(self, text: str):
+        self.dirty = True
+        return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class StatusRenderer(Thread):
+    """Shows a StatusBoard at a fixed rate, no matter how many jobs report or how often.
+
+    On a terminal the board is drawn as a table, redrawn in place unless other output came in between.
+    Otherwise only the entries that changed since the last round are printed, one line each.
+    """
+
+    INTERVAL = 2.0
+
+    def __init__(self, board: StatusBoard, lock: Lock, show_host: bool = False,
+                 stream: Optional[TextIO] = None, interval: float = INTERVAL):
+        """
+        :param lock:        Lock shared by everything printing to the terminal
+        :param show_host:   Include the host column, for clusters
+        """
+        super().__init__(name='status', daemon=True)
+        self.board = board
+        self.lock = lock
+        self.show_host = show_host
+        self.stream = stream
+        self.interval = interval
+        self.seen = 0
+        self.drawn = 0                  # lines in the last table drawn
+        self._done = Event()
+        self._tracked: Optional[_TrackedOutput] = None
+
+    def start(self):
+        stream = self.stream or sys.stdout
+        if stream.isatty():
+            self._tracked = _TrackedOutput(stream)
+            if self.stream is None:
+                sys.stdout = self._tracked
+        super().start()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.render()
+
+    def stop(self):
+        """Stop rendering, after showing what's left on the board"""
+        self._done.set()
+        if self.is_alive():
+            self.join()
+        self.render()
+        if self._tracked is not None and sys.stdout is self._tracked:
+            sys.stdout = self._tracked.stream
+
+    def render(self):
+        if self.board.version == self.seen:
+            return
+        with self.lock:
+            if self._tracked is not None:
+                self.seen, reports = self.board.snapshot()
+                self._draw_table(reports)
+            else:
+                self.seen, reports = self.board.snapshot(self.seen)
+                stream = self.stream or sys.stdout
+                for report in reports:
+                    stream.write(self.format_line(report) + '\n')
+                stream.flush()
+
+    def format_line(self, report: Dict[str, Any]) -> str:
+        line = f'{report["file"]}: speed: {report["speed"]}x, comp: {report["comp"]}%, done: {report["done"]:3}%'
+        if self.show_host:
+            return f'{report["host"]:20}|{line}'
+        return line
+
+    def _draw_table(self, reports: List[Dict[str, Any]]):
+        tracked = self._tracked
+        out = []
+        if not tracked.dirty and self.drawn > 0:
+            # nothing else printed since the last table, so draw over it
+            out.append(f'\x1b[{self.drawn}F\x1b[J')
+        lines = list()
+        if reports:
+            width = max(len(report['file']) for report in reports)
+            header = f'{"file":{width}}   speed   comp   done'
+            if self.show_host:
+                header = f'{"host":20} ' + header
+            lines.append(header)
+            for report in reports:
+                line = f'{report["file"]:{width}}  {report["speed"]:>5}x  {report["comp"]:4}%  {report["done"]:4}%'
+                if self.show_host:
+                    line = f'{report["host"]:20} ' + line
+                lines.append(line)
+        out.extend(line + '\n' for line in lines)
+        tracked.stream.write(''.join(out))
+        tracked.stream.flush()
+        tracked.dirty = False
+        self.drawn = len(lines)
@@ -0,0 +1,254 @@
+"""
+    Event loop engine reading the output of every encoder of a host or cluster in a single thread
+"""
+import asyncio
+import codecs
+import datetime
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional, List, AsyncIterator
+
+from pytranscoder.processor import Encode, ResourceUsage
+
+# ffmpeg rewrites its status line in place using carriage returns
+newline_re = re.compile(r'\r\n|\r|\n')
+
+_watcher_lock = Lock()
+_watching = False
+
+
+def watch_children():
+    """Have asyncio wait on its child processes through pidfds where it can, instead of with a thread for each.
+
+    Python 3.12 does so by itself. Before that it is up to us, the watcher being shared by the whole process.
+    """
+    if sys.version_info < (3, 9) or sys.version_info >= (3, 12) or not hasattr(asyncio, 'PidfdChildWatcher'):
+        return
+    global _watching
+    with _watcher_lock:
+        if _watching:
+            return
+        try:
+            # needs Linux 5.3 or later
+            os.close(os.pidfd_open(os.getpid()))
+        except (OSError, AttributeError):
+            return
+        asyncio.get_event_loop_policy().set_child_watcher(asyncio.PidfdChildWatcher())
+        _watching = True
+
+
+async def read_lines(stream: asyncio.StreamReader) -> AsyncIterator[str]:
+    """Yield decoded output lines split on any line ending, as text mode pipes do"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        text = pending + decoder.decode(chunk)
+        # a trailing \r may be the first half of a \r\n
+        held = text.endswith('\r')
+        if held:
+            text = text[:-1]
+        lines = newline_re.split(text)
+        pending = lines.pop() + ('\r' if held else '')
+        for line in lines:
+            yield line + '\n'
+    pending = (pending + decoder.decode(b'', final=True)).rstrip('\r')
+    if pending:
+        yield pending + '\n'
+
+
+def sample_usage(pid: int, previous: Optional[ResourceUsage]) -> Optional[ResourceUsage]:
+    """Latest resource usage of a child, keeping the peak memory of earlier samples.
+
+    The child is reaped by asyncio, so usage can only be sampled along the way. An exited child that is not
+    reaped yet still reports its cpu time and I/O, but no longer its memory.
+    """
+    usage = ResourceUsage.sample(pid)
+    if usage is None:
+        return previous
+    if previous is not None:
+        usage.max_rss = max(usage.max_rss, previous.max_rss)
+    return usage
+
+
+class Supervisor:
+    """Runs the job slots of one or more hosts as coroutines instead of one thread each.
+
+    Encoders (and the ssh sessions running them remotely) are started with asyncio and all of their
+    output is read in one event loop. Some threads remain:
+
+    - the blocking steps of a job, like matching, moving files and the copies to and from streaming hosts,
+      run on a pool of at most THREADS threads. Beyond that many at once, slots wait for a turn.
+    - progress callbacks, which write to the terminal, journal and metrics, run on a thread of their own so
+      they don't hold up the loop.
+    - before Python 3.12, ended encoders are noticed through pidfds on Linux 5.3 and later. Elsewhere asyncio
+      watches each running encoder with a thread.
+    """
+
+    # most blocking job steps run at once
+    THREADS = 16
+
+    def __init__(self, name: str = 'supervisor'):
+        self.name = name
+        self.callbacks: Optional[ThreadPoolExecutor] = None
+
+    def run(self, workers: List) -> None:
+        """Process jobs until the queues of all workers are closed and drained.
+
+        :param workers: Objects with the same prepare()/queue/log interface as the threaded hosts
+        """
+        asyncio.run(self._run(workers))
+
+    async def _run(self, workers: List) -> None:
+        watch_children()
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=max(1, min(len(workers), Supervisor.THREADS)),
+                               thread_name_prefix=self.name))
+        self.callbacks = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{self.name}-callbacks')
+        try:
+            await asyncio.gather(*[self.work(worker) for worker in workers])
+        finally:
+            self.callbacks.shutdown()
+
+    async def vetoed(self, encode: Encode, stats) -> bool:
+        """Pass progress to the callback of the encode, True if it asks for the encode to be stopped"""
+        if encode.event_callback is None:
+            return False
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.callbacks, encode.event_callback, stats)
+
+    async def work(self, worker) -> None:
+        """One job slot, the event loop equivalent of the go() loop of a host thread"""
+        loop = asyncio.get_running_loop()
+        ready = getattr(worker, 'ready', None)
+        if ready is not None and not await loop.run_in_executor(None, ready):
+            return
+
+        while True:
+            job = await worker.queue.get_async()
+            if job is None:
+                # queue closed and drained, all done
+                break
+            try:
+                encode: Optional[Encode] = await loop.run_in_executor(None, worker.prepare, job)
+                if encode is not None:
+                    code = await self.execute(encode)
+                    await loop.run_in_executor(None, encode.finish, code)
+            except Exception as ex:
+                failed = getattr(worker, 'failed', None)
+                if failed is not None:
+                    await loop.run_in_executor(None, failed, job, ex)
+                else:
+                    worker.log(ex)
+            finally:
+                worker.queue.task_done()
+        drain = getattr(worker, 'drain', None)
+        if drain is not None:
+            await loop.run_in_executor(None, drain)
+
+    async def execute(self, encode: Encode) -> Optional[int]:
+        """Run one encoder, passing progress to its callback. Returns None if the callback vetoed the job"""
+        if encode.agent is not None and not encode.piped:
+            return await self.execute_agent(encode)
+        processor = encode.processor
+        if encode.piped:
+            params, parser = processor.prepare_piped(encode.params)
+            stderr = asyncio.subprocess.PIPE
+        else:
+            params, parser, stderr = processor.prepare(encode.params)
+        if encode.remote is not None:
+            cli = processor.remote_command(encode.remote, params)
+        else:
+            cli = [processor.path, *params]
+        processor.last_command = ' '.join(cli)
+
+        code = None
+        processor.last_usage = None
+        # the usage of ssh says nothing about the encoder on the host
+        local = encode.remote is None
+        if encode.admission is not None:
+            await encode.admission.admit_async(encode.workdir)
+        if encode.claim is not None:
+            await encode.claim.acquire_async()
+        encode.started = datetime.datetime.now()
+        stdin = stdout = None
+        try:
+            if encode.piped:
+                # media goes through the ssh connection both ways
+                stdin, stdout = open(encode.source, 'rb'), open(encode.target, 'wb')
+            proc = await asyncio.create_subprocess_exec(*cli, stdin=stdin, stdout=stdout or asyncio.subprocess.PIPE,
+                                                        stderr=stderr or asyncio.subprocess.STDOUT)
+            try:
+                async for line in read_lines(proc.stderr if encode.piped else proc.stdout):
+                    if parser.logged:
+                        processor.transaction_log.write(line)
+                    stats = parser.feed(line)
+                    if stats is not None:
+                        if local:
+                            processor.last_usage = sample_usage(proc.pid, processor.last_usage)
+                        if await self.vetoed(encode, stats):
+                            proc.kill()
+                            await proc.wait()
+                            return None
+                if local:
+                    processor.last_usage = sample_usage(proc.pid, processor.last_usage)
+                code = await proc.wait()
+                return code
+            except asyncio.CancelledError:
+                proc.kill()
+                raise
+        finally:
+            for f in (stdin, stdout):
+                if f is not None:
+                    f.close()
+            encode.stopped = datetime.datetime.now()
+            if encode.claim is not None:
+                encode.claim.release()
+            processor.close_log(code)
+
+
+    async def execute_agent(self, encode: Encode) -> Optional[int]:
+        """Run one encoder by the agent on its host, taking the records it sends back on the event loop"""
+        loop = asyncio.get_running_loop()
+        processor = encode.processor
+        params, parser, progress = processor.prepare_agent(encode.params)
+        cmd = [processor.path, *params]
+        processor.last_command = ' '.join(cmd)
+
+        code = None
+        processor.last_usage = None
+        if encode.admission is not None:
+            await encode.admission.admit_async(encode.workdir)
+        if encode.claim is not None:
+            await encode.claim.acquire_async()
+        encode.started = datetime.datetime.now()
+        try:
+            records: asyncio.Queue = asyncio.Queue()
+            # starting a new agent can take a while, the records come in from its reader thread
+            job = await loop.run_in_executor(None, encode.agent.run, cmd, progress,
+                                             lambda record: loop.call_soon_threadsafe(records.put_nowait, record))
+            try:
+                while True:
+                    record = await records.get()
+                    if record['event'] == 'exit':
+                        code = record['code']
+                        return code
+                    stats = processor.read_agent_record(record, parser)
+                    if stats is not None and await self.vetoed(encode, stats):
+                        job.kill()
+                        while record['event'] != 'exit':
+                            record = await records.get()
+                        return None
+            except asyncio.CancelledError:
+                job.kill()
+                raise
+        finally:
+            encode.stopped = datetime.datetime.now()
+            if encode.claim is not None:
+                encode.claim.release()
+            processor.close_log(code)
@@ -0,0 +1,82 @@
+"""
+    Wall time spent in each phase of every job, for tuning
+"""
+import json
+import math
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Dict, List, Optional
+
+from pytranscoder.events import JobEvents
+
+# in the order a job goes through them
+PHASES = ['probe', 'match', 'queue', 'upload', 'encode', 'download', 'threshold', 'move']
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(values)))
+    return values[rank - 1]
+
+
+class Timings:
+    """Collects the seconds spent per phase of each media file, from any thread"""
+
+    def __init__(self, events: Optional[JobEvents] = None):
+        """
+        :param events:  Also report every recorded time as a phase event
+        """
+        self._lock = Lock()
+        self.jobs: Dict[str, Dict[str, float]] = dict()
+        self.events = events
+
+    def record(self, path, phase: str, seconds: float):
+        path = os.path.abspath(str(path))
+        with self._lock:
+            phases = self.jobs.setdefault(path, dict())
+            phases[phase] = phases.get(phase, 0.0) + seconds
+        if self.events is not None:
+            self.events.emit('phase', path=path, phase=phase, seconds=seconds)
+
+    @contextmanager
+    def measure(self, path, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(path, phase, time.perf_counter() - start)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Per phase totals and percentiles over all jobs that went through that phase"""
+        with self._lock:
+            samples: Dict[str, List[float]] = dict()
+            for phases in self.jobs.values():
+                for phase, seconds in phases.items():
+                    samples.setdefault(phase, list()).append(seconds)
+
+        result = dict()
+        for phase in sorted(samples, key=lambda p: PHASES.index(p) if p in PHASES else len(PHASES)):
+            values = sorted(samples[phase])
+            result[phase] = {
+                'count': len(values),
+                'total': sum(values),
+                'p50': percentile(values, 50),
+                'p90': percentile(values, 90),
+                'p99': percentile(values, 99),
+                'max': values[-1],
+            }
+        return result
+
+    def save(self, path: str):
+        """Write per-job phases and the summary as JSON, for offline analysis"""
+        with self._lock:
+            jobs = {name: dict(phases) for name, phases in self.jobs.items()}
+        with open(path, 'w') as f:
+            json.dump({'jobs': jobs, 'summary': self.summary()}, f, indent=2)
+
+    def __len__(self):
+        return len(self.jobs)
@@ -4,10 +4,10 @@ import glob
 import os
 import shutil
 import sys
+import time
 from pathlib import Path, PurePath
 from typing import Set, List, Optional
 
-from queue import Queue, Empty
 from threading import Thread, Lock
 import crayons
 
@@ -16,7 +16,16 @@ import pytranscoder
 from pytranscoder import __version__
 from pytranscoder.cluster import manage_clusters
 from pytranscoder.config import ConfigFile
+from pytranscoder.events import file_size
+from pytranscoder.jobqueue import JobQueue, StealingQueue, job_order
+from pytranscoder.journal import Journal
 from pytranscoder.media import MediaInfo
+from pytranscoder.metrics import MetricsExporter
+from pytranscoder.predict import SpeedHistory, batch_estimate
+from pytranscoder.probe import MediaProbe, ProbeCache
+from pytranscoder.processor import Encode, ResourceUsage
+from pytranscoder.status import StatusRenderer
+from pytranscoder.supervisor import Supervisor
 from pytranscoder.profile import Profile
 from pytranscoder.utils import filter_threshold, files_from_file, calculate_progress, dump_stats
 
@@ -26,17 +35,24 @@ DEFAULT_CONFIG = os.path.expanduser('~/.transcode.yml')
 class LocalJob:
     """One file with matched profile to be encoded"""
 
-    def __init__(self, inpath: str, profile: Profile, mixins: List[str], info: MediaInfo):
+    def __init__(self, inpath: str, profile: Profile, mixins: List[str], info: MediaInfo, priority: int = 0):
         self.inpath = Path(os.path.abspath(inpath))
         self.profile = profile
         self.info = info
         self.mixins = mixins
+        self.priority = priority
+        self.queue = profile.queue_name or '_default_'
+        self.queued = time.monotonic()
+
+    @property
+    def work(self) -> float:
+        return self.info.work
 
 
 class QueueThread(Thread):
     """One transcoding thread associated to a queue"""
 
-    def __init__(self, queuename, queue: Queue, configfile: ConfigFile, manager):
+    def __init__(self, queuename, queue: JobQueue, configfile: ConfigFile, manager):
         """
         :param queuename:   Name of the queue, for thread naming purposes only
         :param queue:       Thread-safe queue containing files to be encoded
@@ -52,8 +68,8 @@ class QueueThread(Thread):
     def lock(self):
         return self._manager.lock
 
-    def complete(self, path: Path, elapsed_seconds):
-        self._manager.complete.append((str(path), elapsed_seconds))
+    def complete(self, path: Path, elapsed_seconds, usage: Optional[ResourceUsage] = None):
+        self._manager.complete.append((str(path), elapsed_seconds, usage))
 
     def start_test(self):
         self.go()
@@ -69,87 +85,126 @@ class QueueThread(Thread):
 
     def go(self):
 
-        while not self.queue.empty():
+        while True:
+            job: LocalJob = self.queue.get()
+            if job is None:
+                # queue closed and drained, all done
+                break
             try:
-                job: LocalJob = self.queue.get()
-                input_opt = job.profile.input_options.as_shell_params()
-                output_opt = self.config.output_from_profile(job.profile, job.mixins)
-
-                fls = False
-                if self.config.fls_path():
-                    # lets write output to local storage, for efficiency
-                    outpath = PurePath(self.config.fls_path(), job.inpath.with_suffix(job.profile.extension).name)
-                    fls = True
-                else:
-                    outpath = job.inpath.with_suffix(job.profile.extension + '.tmp')
-
-                #
-                # check if we need to exclude any streams
-                #
-                processor = self.config.get_processor_by_name(job.profile.processor)
-                if job.profile.is_ffmpeg:
-                    if job.info.is_multistream() and self.config.automap and job.profile.automap:
-                        output_opt = output_opt + job.info.ffmpeg_streams(job.profile)
-                    cli = ['-y', *input_opt, '-i', str(job.inpath), *output_opt, str(outpath)]
-                else:
-                    cli = ['-i', str(job.inpath), *input_opt, *output_opt, '-o', str(outpath)]
+                encode = self.prepare(job)
+                if encode is not None:
+                    encode.finish(encode.run())
+            except Exception as ex:
+                self.failed(job, ex)
+            finally:
+                self.queue.task_done()
 
-                #
-                # display useful information
-                #
-                self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
-                try:
-                    print('-' * 40)
-                    print('Filename : ' + crayons.green(os.path.basename(str(job.inpath))))
-                    print(f'Profile  : {job.profile.name}')
-                    print('{:<6}   : '.format(job.profile.processor) + ' '.join(cli) + '\n')
-                finally:
-                    self.lock.release()
-
-                if pytranscoder.dry_run:
-                    continue
-
-                basename = job.inpath.name
-
-                def log_callback(stats):
-                    pct_done, pct_comp = calculate_progress(job.info, stats)
-                    pytranscoder.status_queue.put({ 'host': 'local',
-                                                    'file': basename,
-                                                    'speed': stats['speed'],
-                                                    'comp': pct_comp,
-                                                    'done': pct_done})
-                    #self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
-                    if job.profile.threshold_check < 100:
-                        if pct_done >= job.profile.threshold_check and pct_comp < job.profile.threshold:
-                            # compression goal (threshold) not met, kill the job and waste no more time...
-                            self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
-                            return True
-                    return False
-
-                def hbcli_callback(stats):
-                    self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
-                    return False
-
-                job_start = datetime.datetime.now()
-                if processor.is_ffmpeg():
-                    code = processor.run(cli, log_callback)
-                else:
-                    code = processor.run(cli, hbcli_callback)
-                job_stop = datetime.datetime.now()
-                elapsed = job_stop - job_start
-
-                if code == 0:
-                    if not filter_threshold(job.profile, str(job.inpath), outpath):
-                        # oops, this transcode didn't do so well, lets keep the original and scrap this attempt
-                        self.log(f'Transcoded file {job.inpath} did not meet minimum savings threshold, skipped')
-                        self.complete(job.inpath, (job_stop - job_start).seconds)
-                        os.unlink(str(outpath))
-                        continue
+    def failed(self, job: LocalJob, ex: Exception):
+        """Handling the job raised an exception, it gets no further"""
+        self.log(ex)
+        pytranscoder.job_events.emit('failed', path=str(job.inpath), queue=job.queue, host='local', code=None,
+                                     reason='error')
 
-                    self.complete(job.inpath, elapsed.seconds)
-                    if not pytranscoder.keep_source:
-                        if pytranscoder.verbose:
-                            self.log(f'replacing {job.inpath} with {outpath}')
+    def prepare(self, job: LocalJob) -> Optional[Encode]:
+        """Work out the encoder command line for a job, and how to wrap up once it's done.
+
+        :return: The encode to run, or None if there is nothing to run (ie. dry run)
+        """
+        pytranscoder.timings.record(job.inpath, 'queue', time.monotonic() - job.queued)
+        if job.queue != self.name:
+            if pytranscoder.verbose:
+                self.log(f'{job.inpath.name}: moved from queue {job.queue} to idle queue {self.name}')
+            job.queue = self.name
+        events = pytranscoder.job_events
+        events.emit('dispatched', path=str(job.inpath), queue=job.queue, host='local')
+        template = self.config.command_template(job.profile, job.mixins)
+
+        fls = False
+        if self.config.fls_path():
+            # lets write output to local storage, for efficiency
+            outpath = PurePath(self.config.fls_path(), job.inpath.with_suffix(job.profile.extension).name)
+            fls = True
+        else:
+            outpath = job.inpath.with_suffix(job.profile.extension + '.tmp')
+
+        #
+        # check if we need to exclude any streams
+        #
+        processor = self.config.get_processor_by_name(job.profile.processor)
+        streams = None
+        if job.profile.is_ffmpeg:
+            if job.info.is_multistream() and self.config.automap and job.profile.automap:
+                streams = job.info.ffmpeg_streams(job.profile)
+        cli = template.build(str(job.inpath), str(outpath), streams)
+
+        #
+        # display useful information
+        #
+        self.lock.acquire()  # used to synchronize threads so multiple threads don't create a jumble of output
+        try:
+            print('-' * 40)
+            print('Filename : ' + crayons.green(os.path.basename(str(job.inpath))))
+            print(f'Profile  : {job.profile.name}')
+            if self._manager.history is not None:
+                estimate = self._manager.history.describe(job.profile.name, job.info, 'local')
+                if estimate is not None:
+                    print(f'Estimate : {estimate}')
+            print('{:<6}   : '.format(job.profile.processor) + ' '.join(cli) + '\n')
+        finally:
+            self.lock.release()
+
+        if pytranscoder.dry_run:
+            events.emit('planned', path=str(job.inpath), queue=job.queue, host='local', profile=job.profile.name,
+                        mixins=job.mixins)
+            return None
+
+        basename = job.inpath.name
+
+        def log_callback(stats):
+            pct_done, pct_comp = calculate_progress(job.info, stats)
+            pytranscoder.status_board.put({'host': 'local',
+                                           'file': basename,
+                                           'speed': stats['speed'],
+                                           'comp': pct_comp,
+                                           'done': pct_done})
+            events.emit('progress', path=str(job.inpath), host='local', fps=stats['fps'], speed=stats['speed'],
+                        size=stats['size'], done=pct_done, comp=pct_comp)
+            #self.log(f'{basename}: speed: {stats["speed"]}x, comp: {pct_comp}%, done: {pct_done:3}%')
+            if job.profile.threshold_check < 100:
+                if pct_done >= job.profile.threshold_check and pct_comp < job.profile.threshold:
+                    # compression goal (threshold) not met, kill the job and waste no more time...
+                    self.log(f'Encoding of {basename} cancelled and skipped due to threshold not met')
+                    return True
+            return False
+
+        def hbcli_callback(stats):
+            self.log(f'{basename}: avg fps: {stats["fps"]}, ETA: {stats["eta"]}')
+            events.emit('progress', path=str(job.inpath), host='local', fps=stats['fps'])
+            return False
+
+        def finish(code: Optional[int], elapsed: datetime.timedelta):
+            pytranscoder.status_board.remove('local', basename)
+            pytranscoder.timings.record(job.inpath, 'encode', elapsed.total_seconds())
+            usage = processor.last_usage
+            resources = usage.as_dict() if usage is not None else None
+            if code == 0:
+                with pytranscoder.timings.measure(job.inpath, 'threshold'):
+                    passed = filter_threshold(job.profile, str(job.inpath), outpath)
+                size_in, size_out = file_size(job.inpath), file_size(outpath)
+                if not passed:
+                    events.emit('skipped', path=str(job.inpath), queue=job.queue, host='local',
+                                size_in=size_in, size_out=size_out, usage=resources)
+                    # oops, this transcode didn't do so well, lets keep the original and scrap this attempt
+                    self.log(f'Transcoded file {job.inpath} did not meet minimum savings threshold, skipped')
+                    self.complete(job.inpath, elapsed.seconds, usage)
+                    os.unlink(str(outpath))
+                    return
+
+                self.complete(job.inpath, elapsed.seconds, usage)
+                if not pytranscoder.keep_source:
+                    if pytranscoder.verbose:
+                        self.log(f'replacing {job.inpath} with {outpath}')
+                    with pytranscoder.timings.measure(job.inpath, 'move'):
                         job.inpath.unlink()
 
                         if fls:
@@ -157,18 +212,29 @@ class QueueThread(Thread):
                         else:
                             outpath.rename(job.inpath.with_suffix(job.profile.extension))
 
-                        self.log(crayons.green(f'Finished {job.inpath}'))
-                    else:
-                        self.log(crayons.yellow(f'Finished {outpath}, original file unchanged'))
-                elif code is not None:
-                    self.log(f' Did not complete normally: {processor.last_command}')
-                    self.log(f'Output can be found in {processor.log_path}')
-                    try:
-                        outpath.unlink()
-                    except:
-                        pass
-            finally:
-                self.queue.task_done()
+                    self.log(crayons.green(f'Finished {job.inpath}'))
+                else:
+                    self.log(crayons.yellow(f'Finished {outpath}, original file unchanged'))
+                events.emit('finished', path=str(job.inpath), queue=job.queue, host='local',
+                            size_in=size_in, size_out=size_out, usage=resources)
+            elif code is None:
+                events.emit('aborted', path=str(job.inpath), queue=job.queue, host='local', reason='threshold',
+                            usage=resources)
+            else:
+                events.emit('failed', path=str(job.inpath), queue=job.queue, host='local', code=code,
+                            usage=resources)
+                self.log(f' Did not complete normally: {processor.last_command}')
+                self.log(f'Output can be found in {processor.log_path}')
+                try:
+                    outpath.unlink()
+                except:
+                    pass
+
+        events.emit('started', path=str(job.inpath), queue=job.queue, host='local', profile=job.profile.name,
+                    mixins=job.mixins)
+        return Encode(processor, cli, log_callback if processor.is_ffmpeg() else hbcli_callback, finish,
+                      claim=self.config.resource_pool.claim(job.profile.resources),
+                      admission=self.config.admission_control, workdir=str(PurePath(outpath).parent))
 
 
 class LocalHost:
@@ -177,63 +243,74 @@ class LocalHost:
     lock:       Lock = Lock()
     complete:   List = list()            # list of completed files, shared across threads
 
-    def __init__(self, configfile: ConfigFile):
+    def __init__(self, configfile: ConfigFile, history: Optional[SpeedHistory] = None):
+        """
+        :param history: Speeds of earlier jobs, to predict encode times with
+        """
         self.queues = dict()
         self.configfile = configfile
+        self.history = history
+        self.jobs: List[Thread] = list()
+        self.monitor: Optional[StatusRenderer] = None
 
         #
         # initialize the queues
         #
-        self.queues['_default_'] = Queue()
+        order = job_order(configfile.queue_order)
+        self.queues['_default_'] = JobQueue(order)
         for qname in configfile.queues.keys():
-            self.queues[qname] = Queue()
+            self.queues[qname] = JobQueue(order)
 
     def start(self):
-        """After initialization this is where processing begins"""
-        #
-        # all files are listed in the queues so start the threads
-        #
-        jobs = list()
+        """After initialization this is where processing begins.
+
+        Encoding threads are started right away and pick up work as soon as files are enqueued.
+        """
+        workers = list()
+        stealing = any(profile.fallback_queues for profile in self.configfile.profiles.values())
+        if stealing:
+            JobQueue.link(list(self.queues.values()))
         for name, queue in self.queues.items():
 
-            # determine the number of threads to allocate for each queue, minimum of defined max and queued jobs
+            # determine the number of threads to allocate for each queue
 
             if name == '_default_':
                 concurrent_max = 1
             else:
-                concurrent_max = min(self.configfile.queues[name], queue.qsize())
+                concurrent_max = self.configfile.queues[name]
 
             #
-            # Create (n) threads and assign them a queue
+            # Create (n) workers and assign them a queue
             #
             for _ in range(concurrent_max):
-                t = QueueThread(name, queue, self.configfile, self)
-                jobs.append(t)
-                t.start()
-
-        busy = True
-        while busy:
-            try:
-                report = pytranscoder.status_queue.get(block=True, timeout=2)
-                basename = report['file']
-                speed = report['speed']
-                comp = report['comp']
-                done = report['done']
-
-                self.lock.acquire()
-                print(f'{basename}: speed: {speed}x, comp: {comp}%, done: {done:3}%')
-                sys.stdout.flush()
-                self.lock.release()
-                pytranscoder.status_queue.task_done()
-            except Empty:
-                busy = False
-                for job in jobs:
-                    if job.is_alive():
-                        busy = True
-
-        # wait for all queues to drain and all jobs to complete
-#        for _, queue in self.queues.items():
-#            queue.join()
+                worker_queue = queue
+                if stealing:
+                    # idle slots help out with jobs of profiles that list this queue as a fallback
+                    others = [other for other in self.queues.values() if other is not queue]
+                    worker_queue = StealingQueue(queue, others,
+                                                 lambda job, qname=name: qname in job.profile.fallback_queues)
+                workers.append(QueueThread(name, worker_queue, self.configfile, self))
+
+        if self.configfile.engine == 'asyncio':
+            # all workers share one thread running an event loop
+            supervisor = Supervisor()
+            self.jobs.append(Thread(name='supervisor', target=supervisor.run, args=(workers,), daemon=True))
+        else:
+            self.jobs.extend(workers)
+        for job in self.jobs:
+            job.start()
+
+        self.monitor = StatusRenderer(pytranscoder.status_board, self.lock)
+        self.monitor.start()
+
+    def wait(self):
+        """Signal that all files are enqueued and wait for all jobs to complete"""
+        for queue in self.queues.values():
+            queue.close()
+        for job in self.jobs:
+            job.join()
+        if self.monitor is not None:
+            self.monitor.stop()
 
     def enqueue_files(self, files: list):
         """Add requested files to the appropriate queue
@@ -242,6 +319,7 @@ class LocalHost:
         :return:
         """
 
+        pending = list()
         for path, forced_profile, mixins in files:
             #
             # do some prechecks...
@@ -265,7 +343,16 @@ class LocalHost:
                     processor_name = 'hbcli'
 
             processor = self.configfile.get_processor_by_name(processor_name)
-            media_info = processor.fetch_details(path)
+            pending.append((path, forced_profile, mixins, processor))
+
+        #
+        # probe all files concurrently, results come back in the original order
+        #
+        probe = MediaProbe.from_config(self.configfile)
+        details = probe.fetch_all([(processor, path) for path, _, _, processor in pending])
+
+        estimates = list()
+        for (path, forced_profile, mixins, _), media_info in zip(pending, details):
 
             if media_info is None:
                 print(crayons.red(f'File not found: {path}'))
@@ -277,25 +364,44 @@ class LocalHost:
                     print(str(media_info))
 
                 if forced_profile is None:
-                    rule = self.configfile.match_rule(media_info)
+                    with pytranscoder.timings.measure(path, 'match'):
+                        rule = self.configfile.match_rule(media_info)
+                    pytranscoder.job_events.emit('matched', path=os.path.abspath(path),
+                                                 rule=rule.name if rule else None,
+                                                 profile=rule.profile if rule else None,
+                                                 skip=rule is None or rule.is_skip())
                     if rule is None:
                         print(crayons.green(os.path.basename(path)), crayons.yellow(f'No matching profile found - skipped'))
                         continue
                     if rule.is_skip():
                         print(crayons.green(os.path.basename(path)), f'SKIPPED ({rule.name})')
-                        self.complete.append((path, 0))
+                        self.complete.append((path, 0, None))
                         continue
                     profile_name = rule.profile
+                    priority = rule.priority
                 else:
                     #
                     # looks good, add this file to the thread queue
                     #
                     profile_name = forced_profile
+                    priority = 0
+                    pytranscoder.job_events.emit('matched', path=os.path.abspath(path), rule=None,
+                                                 profile=forced_profile, skip=False)
 
                 the_profile = self.configfile.get_profile(profile_name)
                 qname = the_profile.queue_name
+                if self.history is not None:
+                    estimates.append((qname or '_default_',
+                                      self.history.predict(profile_name, media_info.vcodec, media_info.res_height,
+                                                           media_info.runtime, 'local')))
                 if pytranscoder.verbose:
                     print('Matched with profile {profile_name}')
+                for fallback in the_profile.fallback_queues:
+                    if not self.configfile.has_queue(fallback):
+                        print(crayons.red(
+                            f'Profile "{profile_name}" indicated fallback queue "{fallback}" that has not been defined')
+                        )
+                        sys.exit(1)
                 if qname is not None:
                     if not self.configfile.has_queue(the_profile.queue_name):
                         print(crayons.red(
@@ -303,11 +409,19 @@ class LocalHost:
                         )
                         sys.exit(1)
                     else:
-                        self.queues[qname].put(LocalJob(path, the_profile, mixins, media_info))
+                        self.queues[qname].put(LocalJob(path, the_profile, mixins, media_info, priority))
+                        pytranscoder.job_events.emit('queued', path=os.path.abspath(path), queue=qname)
                         if pytranscoder.verbose:
                             print('Added to queue {qname}')
                 else:
-                    self.queues['_default_'].put(LocalJob(path, the_profile, mixins, media_info))
+                    self.queues['_default_'].put(LocalJob(path, the_profile, mixins, media_info, priority))
+                    pytranscoder.job_events.emit('queued', path=os.path.abspath(path), queue='_default_')
+
+        if len(estimates) > 0:
+            estimate = batch_estimate(estimates, {'_default_': 1, **self.configfile.queues})
+            if estimate is not None:
+                with self.lock:
+                    print(crayons.cyan(estimate))
 
 
 def cleanup_queuefile(queue_path: str, completed: Set):
@@ -366,6 +480,10 @@ def start():
         print('  -y <file>  Full path to configuration file.  Default is ~/.transcode.yml')
         print('  -p         profile to use. If used with --from-file, applies to all listed media in <filename>')
         print('  -m         Add mixins to profile. Separate multiples with a comma')
+        print('  --no-cache     Ignore the probe cache (if configured) and probe every file again')
+        print('  --purge-cache  Empty the probe cache (if configured) before processing')
+        print('  --timings <file>  Save the time spent in each phase of every job to a JSON file')
+        print('  --full-log     Write all encoder output to the transaction log as it arrives, not just the end of failed jobs')
         print('\n** PyPi Repo: https://pypi.org/project/pytranscoder-ffmpeg/')
         print('** Read the docs at https://pytranscoder.readthedocs.io/en/latest/')
         sys.exit(0)
@@ -378,6 +496,8 @@ def start():
     cluster = None
     configfile: Optional[ConfigFile] = None
     host_override = None
+    purge_cache = False
+    timings_path = None
     if len(sys.argv) > 1:
         files = []
         arg = 1
@@ -400,6 +520,15 @@ def start():
                 pytranscoder.keep_source = True
             elif sys.argv[arg] == '--dry-run':
                 pytranscoder.dry_run = True
+            elif sys.argv[arg] == '--no-cache':         # bypass the probe cache
+                pytranscoder.use_probe_cache = False
+            elif sys.argv[arg] == '--purge-cache':      # empty the probe cache
+                purge_cache = True
+            elif sys.argv[arg] == '--timings':          # save phase timings as json
+                timings_path = sys.argv[arg + 1]
+                arg += 1
+            elif sys.argv[arg] == '--full-log':         # debug, write through every line of encoder output
+                pytranscoder.full_log = True
             elif sys.argv[arg] == '--host':             # run all cluster encodes on specific host
                 host_override = sys.argv[arg + 1]
                 arg += 1
@@ -431,6 +560,11 @@ def start():
     else:
         crayons.enable()
 
+    if purge_cache and configfile.probe_cache is not None:
+        cache = ProbeCache(configfile.probe_cache)
+        cache.purge()
+        cache.close()
+
     if len(files) == 0 and queue_path is None and configfile.default_queue_file is not None:
         #
         # load from list of files
@@ -446,6 +580,12 @@ def start():
         print(crayons.yellow(f'Nothing to do'))
         sys.exit(0)
 
+    exporter = MetricsExporter.from_config(configfile, pytranscoder.job_events)
+    if exporter is not None:
+        exporter.start()
+    journal = Journal.from_config(configfile, pytranscoder.job_events)
+    history = SpeedHistory.from_config(configfile, pytranscoder.job_events)
+
     if cluster is not None:
         if host_override is not None:
             # disable all other hosts in-memory only - to force encodes to the designated host
@@ -454,24 +594,41 @@ def start():
                 for name, this_config in cluster.items():
                     if name != host_override:
                         this_config['status'] = 'disabled'
-        completed: List = manage_clusters(files, configfile)
+        completed: List = manage_clusters(files, configfile, history=history)
         if len(completed) > 0:
             qpath = queue_path if queue_path is not None else configfile.default_queue_file
-            pathlist = [p for p, _ in completed]
+            pathlist = [p for p, *_ in completed]
             cleanup_queuefile(qpath, set(pathlist))
-            dump_stats(completed)
+        if exporter is not None:
+            exporter.stop()
+        if journal is not None:
+            journal.close()
+        if history is not None and not pytranscoder.dry_run:
+            history.save()
+        dump_stats(completed)
+        if timings_path is not None:
+            pytranscoder.timings.save(timings_path)
         sys.exit(0)
 
-    host = LocalHost(configfile)
-    host.enqueue_files(files)
+    host = LocalHost(configfile, history)
     #
-    # start all threads and wait for work to complete
+    # start all threads, feed them work as files are matched, and wait for work to complete
     #
     host.start()
+    host.enqueue_files(files)
+    host.wait()
     if len(host.complete) > 0:
-        completed_paths = [p for p, _ in host.complete]
+        completed_paths = [p for p, *_ in host.complete]
         cleanup_queuefile(queue_path, set(completed_paths))
-        dump_stats(host.complete)
+    if exporter is not None:
+        exporter.stop()
+    if journal is not None:
+        journal.close()
+    if history is not None and not pytranscoder.dry_run:
+        history.save()
+    dump_stats(host.complete)
+    if timings_path is not None:
+        pytranscoder.timings.save(timings_path)
 
     os.system("stty sane")
 
@@ -0,0 +1,198 @@
+"""
+    Copying media to and from streaming hosts
+"""
+import hashlib
+import os
+import shlex
+import subprocess
+import time
+from threading import Lock
+from typing import Optional, Tuple, BinaryIO
+
+from pytranscoder.sshpool import SshConnection
+
+TRANSFERS = ('scp', 'resumable')
+
+# bytes sent or received at a time
+CHUNK = 1024 * 1024
+
+
+class Bandwidth:
+    """Transfer rate budget shared by every copy in flight, whatever host and slot it is for.
+
+    Each chunk books the next free stretch of time on one shared clock and waits for it, so parallel copies
+    get turns in the order they asked and together stay under the rate.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        """
+        :param rate:    MB per second for all copies together, None for no limit
+        """
+        self.rate = float(rate) * 1024 * 1024 if rate else None
+        self._lock = Lock()
+        self._next = 0.0
+
+    def take(self, count: int):
+        """Wait for the turn to move count bytes"""
+        if self.rate is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + count / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def checksum(f: BinaryIO, length: Optional[int] = None) -> 'hashlib._Hash':
+    """sha256 of the first length bytes of an open file (all of it if None), leaving the file positioned after them"""
+    digest = hashlib.sha256()
+    remaining = length
+    while remaining is None or remaining > 0:
+        chunk = f.read(CHUNK if remaining is None else min(CHUNK, remaining))
+        if not chunk:
+            break
+        digest.update(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    return digest
+
+
+def file_checksum(path: str) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            return checksum(f).hexdigest()
+    except OSError:
+        return None
+
+
+class ResumableTransfer:
+    """Copies files over the ssh connection of a host, picking up where an interrupted copy left off.
+
+    Data is streamed through ssh into a .part file next to the target, which gets its final name only once
+    the sha256 of both sides agree. A target already in place with the right checksum is not copied again.
+    Needs a POSIX shell on the host, with sha256sum or shasum to verify copies.
+    """
+
+    # tries per copy, each resuming from what the ones before left behind
+    ATTEMPTS = 3
+
+    def __init__(self, connection: SshConnection, bandwidth: Optional[Bandwidth] = None):
+        self.connection = connection
+        self.bandwidth = bandwidth or Bandwidth()
+
+    def remote(self, command: str) -> Tuple[int, str]:
+        """Run a shell command on the host, returning its exit code and output"""
+        proc = subprocess.run([*self.connection.command(), command], stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        return proc.returncode, proc.stdout
+
+    def remote_size(self, path: str) -> Optional[int]:
+        code, output = self.remote(f'wc -c < {shlex.quote(path)}')
+        try:
+            return int(output.split()[0]) if code == 0 else None
+        except (ValueError, IndexError):
+            return None
+
+    def remote_checksum(self, path: str) -> Optional[str]:
+        quoted = shlex.quote(path)
+        code, output = self.remote(f'sha256sum {quoted} 2>/dev/null || shasum -a 256 {quoted}')
+        if code != 0 or not output.strip():
+            return None
+        return output.split()[0]
+
+    def verified(self, path: str, size: int, digest: str) -> bool:
+        """Whether a file on the host matches, by checksum or by size where the host can't tell the checksum"""
+        remote_digest = self.remote_checksum(path)
+        if remote_digest is not None:
+            return remote_digest == digest
+        return self.remote_size(path) == size
+
+    def upload(self, source: str, target: str) -> Tuple[int, str]:
+        """Copy a local file to a full path on the host
+
+        :return: exit code (0 if copied or already there) and output of the last failed step
+        """
+        size = os.path.getsize(source)
+        # only read the whole source up front if there is a copy on the host to compare it to
+        if self.remote_size(target) == size and self.verified(target, size, file_checksum(source)):
+            return 0, 'already present'
+
+        part = target + '.part'
+        output = ''
+        for _ in range(ResumableTransfer.ATTEMPTS):
+            offset = self.remote_size(part) or 0
+            if offset > size:
+                offset = 0
+            with open(source, 'rb') as f:
+                # checksum the part already on the host, and add to it what is sent
+                digest = checksum(f, offset)
+                redirect = '>>' if offset > 0 else '>'
+                with subprocess.Popen([*self.connection.command(), f'cat {redirect} {shlex.quote(part)}'],
+                                      stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE) as proc:
+                    try:
+                        for chunk in iter(lambda: f.read(CHUNK), b''):
+                            self.bandwidth.take(len(chunk))
+                            proc.stdin.write(chunk)
+                            digest.update(chunk)
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        # connection dropped, the next attempt resumes
+                        pass
+                    output = proc.stderr.read().decode(errors='replace')
+                    code = proc.wait()
+            if code != 0:
+                continue
+            if self.verified(part, size, digest.hexdigest()):
+                return self.remote(f'mv -f {shlex.quote(part)} {shlex.quote(target)}')
+            # corrupted, start over
+            output = f'checksum mismatch copying {source}'
+            self.remote(f'rm -f {shlex.quote(part)}')
+        return 1, output
+
+    def download(self, source: str, target: str) -> Tuple[int, str]:
+        """Copy a file on the host to a full local path
+
+        :return: exit code (0 if copied or already there) and output of the last failed step
+        """
+        size = self.remote_size(source)
+        if size is None:
+            return 1, f'{source} not found on host'
+        remote_digest = self.remote_checksum(source)
+
+        def matches(digest: str, length: int) -> bool:
+            return digest == remote_digest if remote_digest is not None else length == size
+
+        if os.path.exists(target) and os.path.getsize(target) == size and matches(file_checksum(target), size):
+            return 0, 'already present'
+
+        part = target + '.part'
+        output = ''
+        for _ in range(ResumableTransfer.ATTEMPTS):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            if offset > size:
+                offset = 0
+            with open(part, 'r+b' if offset > 0 else 'wb') as f:
+                # checksum the part already here, and add to it
+                digest = checksum(f, offset)
+                f.truncate(offset)
+                with subprocess.Popen([*self.connection.command(), f'tail -c +{offset + 1} {shlex.quote(source)}'],
+                                      stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE) as proc:
+                    for chunk in iter(lambda: proc.stdout.read(CHUNK), b''):
+                        self.bandwidth.take(len(chunk))
+                        f.write(chunk)
+                        digest.update(chunk)
+                    output = proc.stderr.read().decode(errors='replace')
+                    code = proc.wait()
+                length = f.tell()
+            if code != 0:
+                continue
+            if matches(digest.hexdigest(), length):
+                os.replace(part, target)
+                return 0, ''
+            # corrupted, start over
+            output = f'checksum mismatch copying {source}'
+            os.remove(part)
+        return 1, output
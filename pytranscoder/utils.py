@@ -68,12 +68,30 @@ def dump_stats(completed):
     if pytranscoder.dry_run:
         return
 
-    paths = [p for p, _ in completed]
-    max_width = len(max(paths, key=len))
-    print("-" * (max_width + 9))
-    for path, elapsed in completed:
-        pathname = path.rjust(max_width)
-        _min = int(elapsed / 60)
-        _sec = int(elapsed % 60)
-        print(f"{pathname}  ({_min:3}m {_sec:2}s)")
-    print()
+    if len(completed) > 0:
+        paths = [p for p, *_ in completed]
+        max_width = len(max(paths, key=len))
+        print("-" * (max_width + 9))
+        for path, elapsed, usage in completed:
+            pathname = path.rjust(max_width)
+            _min = int(elapsed / 60)
+            _sec = int(elapsed % 60)
+            if usage is not None:
+                print(f"{pathname}  ({_min:3}m {_sec:2}s)  {usage}")
+            else:
+                print(f"{pathname}  ({_min:3}m {_sec:2}s)")
+        measured = [(elapsed, usage) for _, elapsed, usage in completed if usage is not None and elapsed > 0]
+        if len(measured) > 0:
+            # what a job costs on average, to size queue concurrency with
+            cores = sum(usage.cpu_time for _, usage in measured) / sum(elapsed for elapsed, _ in measured)
+            peak = max(usage.max_rss for _, usage in measured)
+            print(f"encoders kept {cores:.1f} cores busy per job on average, peak memory {peak / 1048576:.0f} MB")
+        print()
+
+    summary = pytranscoder.timings.summary()
+    if len(summary) > 0:
+        print(f"{'phase':10} {'jobs':>5} {'total':>10} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for phase, stats in summary.items():
+            print(f"{phase:10} {stats['count']:5} {stats['total']:9.1f}s {stats['p50']:8.2f}s {stats['p90']:8.2f}s "
+                  f"{stats['p99']:8.2f}s {stats['max']:8.2f}s")
+        print()
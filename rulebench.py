@@ -0,0 +1,82 @@
+"""
+    Micro-benchmark of rule matching cost per media file.
+
+    usage: python3 rulebench.py [number of rules] [number of files]
+"""
+import random
+import sys
+import timeit
+
+from pytranscoder.config import ConfigFile
+from pytranscoder.media import MediaInfo
+
+CODECS = ['h264', 'hevc', 'mpeg4', 'vc1', 'vp9', 'av1']
+
+
+def make_setup(rule_count: int) -> dict:
+    rules = dict()
+    for i in range(rule_count - 1):
+        criteria = {
+            'filesize_mb': random.choice(['<500', '>2500', '1000-4000', '!<700']),
+            'res_height': random.choice(['<700', '720-1081', '>1100']),
+            'runtime': random.choice(['<31', '30-65', '>90']),
+        }
+        if i % 2 == 0:
+            criteria['vcodec'] = random.choice(CODECS)
+        if i % 5 == 0:
+            criteria['path'] = f'/media/(tv|movies)/show{i}/.*'
+        rules[f'rule {i}'] = {'profile': random.choice(['SKIP', 'hevc', 'qsv']), 'criteria': criteria}
+    rules['default'] = {'profile': 'hevc', 'criteria': {'vcodec': '!hevc'}}
+
+    return {
+        'config': {'ffmpeg': '/usr/bin/ffmpeg'},
+        'profiles': {'hevc': {'output_options': ['-c:v hevc'], 'extension': '.mkv'},
+                     'qsv': {'output_options': ['-c:v hevc_qsv'], 'extension': '.mkv'}},
+        'rules': rules,
+    }
+
+
+def make_media(count: int) -> list:
+    media = list()
+    for i in range(count):
+        media.append(MediaInfo({
+            'path': f'/media/tv/show{random.randint(0, 500)}/episode{i}.mp4',
+            'vcodec': random.choice(CODECS),
+            'stream': '0',
+            'res_width': 1920,
+            'res_height': random.choice([480, 720, 1080, 2160]),
+            'runtime': random.randint(20, 180) * 60,
+            'filesize_mb': random.randint(100, 8000),
+            'fps': random.choice([24, 25, 30, 60]),
+            'colorspace': 'yuv420p',
+            'audio': [],
+            'subtitle': [],
+        }))
+    return media
+
+
+def main():
+    rule_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    file_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+
+    random.seed(1)
+    config = ConfigFile(make_setup(rule_count))
+    media = make_media(file_count)
+
+    def match_all():
+        for info in media:
+            config.match_rule(info)
+
+    def match_all_restricted():
+        # as done by cluster hosts limited to certain profiles
+        for info in media:
+            config.match_rule(info, restrict_profiles=['qsv'])
+
+    best = min(timeit.repeat(match_all, number=1, repeat=5))
+    print(f'{rule_count} rules, {file_count} files: {best * 1000000 / file_count:.1f} usec per file')
+    best = min(timeit.repeat(match_all_restricted, number=1, repeat=5))
+    print(f'{rule_count} rules, {file_count} files, restricted profiles: {best * 1000000 / file_count:.1f} usec per file')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,42 @@
 
+import asyncio
+import heapq
+import io
+import json
 import unittest
 import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
 from typing import Dict
 from unittest import mock
 
+import pytranscoder
+from pytranscoder import agent
+from pytranscoder.admission import AdmissionControl
+from pytranscoder.agentclient import AgentClient
 from pytranscoder.cluster import RemoteHostProperties, Cluster, StreamingManagedHost
 from pytranscoder.config import ConfigFile
-from pytranscoder.ffmpeg import status_re, FFmpeg
+from pytranscoder.ffmpeg import status_re, FFmpeg, pipe_output_options, streamable_source
+from pytranscoder.jobqueue import JobQueue, StealingQueue, JOB_ORDERS, job_order, in_order
 from pytranscoder.media import MediaInfo
+from pytranscoder.probe import MediaProbe, ProbeCache
+from pytranscoder.processor import Processor, TransactionLog, Encode, ResourceUsage
 from pytranscoder.profile import Profile
+from pytranscoder.rule import Rule
+from pytranscoder.status import StatusBoard, StatusRenderer
+from pytranscoder.supervisor import Supervisor
+from pytranscoder.timing import Timings
+from pytranscoder.events import JobEvents
+from pytranscoder.journal import Journal
+from pytranscoder.metrics import Metrics, MetricsExporter
+from pytranscoder.predict import SpeedHistory, makespan
+from pytranscoder.prefetch import Prefetcher
+from pytranscoder.resources import ResourcePool
+from pytranscoder.sshpool import SshConnection, SshPool
+from pytranscoder.transfer import Bandwidth, ResumableTransfer
 from pytranscoder.transcode import LocalHost
 from pytranscoder.utils import files_from_file, get_local_os_type, calculate_progress, dump_stats, is_exceeded_threshold
 
@@ -92,6 +120,87 @@ class TranscoderTests(unittest.TestCase):
         self.assertIsNotNone(match, 'no ffmpeg status match')
         self.assertTrue(len(match.groups()) == 5, 'Expected 5 matches')
 
+    def test_ffmpeg_progress_blocks(self):
+        block = 'frame=307\nfps=86.00\nstream_0_0_q=28.0\ntotal_size=3564544\nout_time_us=13030000\nspeed=3.67x\n'
+        proc = mock.Mock()
+        proc.stdout = io.StringIO('total_size=N/A\nout_time_us=N/A\nprogress=continue\n' +
+                                  block + 'progress=continue\n' + block + 'progress=end\n')
+        ffmpeg = FFmpeg('/usr/bin/ffmpeg', progress=True)
+        ffmpeg.monitor_interval = 0
+        params, parser, log = ffmpeg.prepare(['-i', 'in.mkv', 'out.mkv'])
+        self.assertEqual(['-progress', 'pipe:1', '-nostats', '-i', 'in.mkv', 'out.mkv'], params)
+        stats = list(ffmpeg.monitor(proc, parser))
+        ffmpeg.close_log(0)
+        self.assertEqual(2, len(stats), 'final block should not be reported')
+        self.assertEqual({'frame': 0, 'fps': '0', 'q': '0', 'size': 0, 'time': 0, 'speed': '0'}, stats[0])
+        self.assertEqual({'frame': 307, 'fps': '86.00', 'q': '28.0', 'size': 3564544, 'time': 13, 'speed': '3.67'},
+                         stats[1])
+        proc.wait.assert_called_once()
+
+    def test_transaction_log_ring(self):
+        ffmpeg = FFmpeg('/bin/sh')
+        with mock.patch.object(TransactionLog, 'LINES', 3):
+            code = ffmpeg.run(['-c', 'for i in 1 2 3 4 5 6; do echo line $i; done; exit 3'], None)
+        self.assertEqual(3, code)
+        self.assertIsNotNone(ffmpeg.log_path, 'failed run should leave a log behind')
+        with open(str(ffmpeg.log_path)) as logfile:
+            self.assertEqual(['line 4\n', 'line 5\n', 'line 6\n'], logfile.readlines())
+        os.remove(str(ffmpeg.log_path))
+
+        code = ffmpeg.run(['-c', 'echo fine'], None)
+        self.assertEqual(0, code)
+        self.assertIsNone(ffmpeg.log_path, 'successful run should not leave a log')
+
+        # slots of the asyncio engine open their logs from the same thread
+        failing, fine = FFmpeg('/bin/sh'), FFmpeg('/bin/sh')
+        failing.open_log(full=True).write('failed\n')
+        fine.open_log(full=True)
+        self.assertNotEqual(failing.log_path, fine.log_path)
+        fine.close_log(0)
+        failing.close_log(1)
+        with open(str(failing.log_path)) as logfile:
+            self.assertEqual('failed\n', logfile.read())
+        os.remove(str(failing.log_path))
+
+    @unittest.skipUnless(hasattr(os, 'wait4') and os.path.exists('/proc/self/io'), 'needs wait4 and /proc')
+    def test_encoder_resource_usage(self):
+        ffmpeg = FFmpeg('/bin/sh')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = os.path.join(tmpdir, 'out')
+            code = ffmpeg.run(['-c', f'i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done; '
+                                     f'head -c 300000 /dev/zero > {target}; exit 2'], None)
+        self.assertEqual(2, code, 'Expected the exit code to survive reaping the process ourselves')
+        usage = ffmpeg.last_usage
+        self.assertIsNotNone(usage)
+        self.assertGreater(usage.cpu_time, 0.0)
+        self.assertGreater(usage.max_rss, 0)
+        self.assertGreaterEqual(usage.write_bytes, 300000)
+        os.remove(str(ffmpeg.log_path))
+
+        # for an encoder run through ssh only the usage of ssh could be told, which is no use
+        self.assertEqual(0, ffmpeg.run_remote(['env'], ['-c', 'exit 0'], None))
+        self.assertIsNone(ffmpeg.last_usage)
+        queue = JobQueue()
+
+        class Worker:
+            def __init__(self):
+                self.queue = queue
+
+            def log(self, *args):
+                pass
+
+            def prepare(self, job):
+                return Encode(ffmpeg, ['-c', 'exit 0'], None, lambda code, elapsed: None, remote=['env'])
+
+        queue.put('remote')
+        queue.close()
+        Supervisor().run([Worker()])
+        self.assertIsNone(ffmpeg.last_usage)
+
+        sampled = ResourceUsage.sample(os.getpid())
+        self.assertGreater(sampled.max_rss, 0)
+        self.assertIsNone(ResourceUsage.sample(2 ** 22 + 1), 'Expected None for a process that is gone')
+
     def test_loadconfig(self):
         config = ConfigFile('transcode.yml')
         self.assertIsNotNone(config.settings, 'Config object not loaded')
@@ -178,6 +287,66 @@ class TranscoderTests(unittest.TestCase):
         rule = config.match_rule(info)
         self.assertIsNotNone(rule, 'Expected a matched profile')
 
+    def test_rule_compiled_predicates(self):
+        rule = Rule('test', {'profile': 'qsv', 'criteria': {'runtime': '30-65', 'res_height': '!<720',
+                                                              'vcodec': '!hevc', 'filesize_mb': 2300}})
+        info = TranscoderTests.make_media('/dev/null', 'h264', 1920, 1080, 45 * 60, 2300, 24, None, [], [])
+        self.assertTrue(rule.match(info), 'Expected rule to match')
+        info.res_height = 480
+        self.assertFalse(rule.match(info), 'Expected inverted res_height to fail')
+        info.res_height = 1080
+        info.vcodec = 'hevc'
+        self.assertFalse(rule.match(info), 'Expected inverted vcodec to fail')
+
+        # '!' inverts path regexes too, and a value missing from the media never matches, inverted or not
+        rule = Rule('not tv', {'profile': 'qsv', 'criteria': {'path': '!/media/tv/'}})
+        self.assertTrue(rule.match(TranscoderTests.make_media('/media/movies/a.mkv', 'h264', 1920, 1080, 60, 1000,
+                                                              24, None, [], [])))
+        self.assertFalse(rule.match(TranscoderTests.make_media('/media/tv/a.mkv', 'h264', 1920, 1080, 60, 1000,
+                                                               24, None, [], [])))
+        info.fps = None
+        self.assertFalse(Rule('fps', {'profile': 'qsv', 'criteria': {'fps': '>20'}}).match(info))
+        self.assertFalse(Rule('not fps', {'profile': 'qsv', 'criteria': {'fps': '!>20'}}).match(info))
+
+    def test_rule_errors_at_load(self):
+        with self.assertRaises(ValueError):
+            Rule('bad range', {'profile': 'qsv', 'criteria': {'runtime': '30-65-90'}})
+        with self.assertRaises(ValueError):
+            Rule('bad number', {'profile': 'qsv', 'criteria': {'fps': '>fast'}})
+        with self.assertRaises(ValueError):
+            Rule('bad predicate', {'profile': 'qsv', 'criteria': {'color': 'blue'}})
+        with self.assertRaises(ValueError):
+            Rule('bad regex', {'profile': 'qsv', 'criteria': {'path': '/media/(anime'}})
+
+    def test_rule_path_scan(self):
+        setup = self.get_setup()
+        setup['rules'] = {
+            'backref': {'profile': 'qsv', 'criteria': {'path': r'/(\w+)/\1/'}},
+            'anime': {'profile': 'qsv', 'criteria': {'path': '/media/(anime|cartoons)/'}},
+            'not tv': {'profile': 'hq', 'criteria': {'path': '!/media/tv/'}},
+            'default': {'profile': 'hevc_cuda'},
+        }
+        config = ConfigFile(setup)
+        self.assertIsNotNone(config.path_matcher.combined, 'Expected combined path pattern')
+        expected = {
+            '/media/anime/show.mkv': 'anime',
+            '/media/dup/dup/show.mkv': 'backref',
+            '/media/tv/show.mkv': 'default',
+            '/media/movies/show.mkv': 'not tv',
+        }
+        for path, rule_name in expected.items():
+            info = TranscoderTests.make_media(path, 'h264', 1920, 1080, 60, 1000, 24, None, [], [])
+            self.assertEqual(config.match_rule(info).name, rule_name, f'Wrong rule matched for {path}')
+
+    def test_rule_index(self):
+        config = ConfigFile(self.get_setup())
+        info = TranscoderTests.make_media('/dev/null', 'hevc', 1920, 1080, 60, 1000, 24, None, [], [])
+        names = [rule.name for rule in config.rule_index.candidates(info)]
+        self.assertEqual(names, ['too small', 'small enough already', 'feature-length treat better'],
+                         'Expected vintage tv (height) and default (!hevc) rules pruned, order kept')
+        names = [rule.name for rule in config.rule_index.candidates(info, restrict_profiles=['qsv'])]
+        self.assertEqual(names, ['feature-length treat better'], 'Expected only qsv rules for restricted host')
+
     def test_loc_os(self):
         self.assertNotEqual(get_local_os_type(), 'unknown', 'Expected other than "unknown" as os type')
 
@@ -200,6 +369,753 @@ class TranscoderTests(unittest.TestCase):
         result = is_exceeded_threshold(threshold, src, dest)
         self.assertFalse(result, "Expected threshold to be false")
 
+    def test_probe_order(self):
+        class SlowProcessor(Processor):
+            def fetch_details(self, _path: str) -> MediaInfo:
+                # make earlier files finish last
+                time.sleep(0.01 * (5 - int(_path)))
+                return TranscoderTests.make_media(_path, 'h264', 1920, 1080, 60, 1000, 24, None, [], [])
+
+        processor = SlowProcessor('/usr/bin/ffmpeg')
+        probe = MediaProbe(workers=4)
+        results = list(probe.fetch_all([(processor, str(i)) for i in range(5)]))
+        self.assertEqual([info.path for info in results], ['0', '1', '2', '3', '4'], 'Probe results out of order')
+
+    def test_probe_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            media = []
+            for i in range(3):
+                path = os.path.join(tmpdir, f'{i}.mp4')
+                with open(path, 'w') as f:
+                    f.write('x')
+                media.append(path)
+            cache = ProbeCache(os.path.join(tmpdir, 'cache.db'), max_entries=2)
+            for i, path in enumerate(media):
+                cache.put(path, TranscoderTests.make_media(path, 'h264', 1920, 1080, 60, 1000, 24, None, [], []))
+                os.utime(path, ns=(i * 10**9, i * 10**9))
+            self.assertIsNone(cache.get(media[0]), 'Expected miss after file changed')
+            cache.put(media[0], TranscoderTests.make_media(media[0], 'hevc', 1920, 1080, 60, 1000, 24, None, [], []))
+            info = cache.get(media[0])
+            self.assertIsNotNone(info, 'Expected cache hit')
+            self.assertEqual(info.vcodec, 'hevc')
+            cache.close()
+
+            cache = ProbeCache(os.path.join(tmpdir, 'cache.db'), max_entries=2)
+            self.assertIsNotNone(cache.get(media[0]), 'Most recent entry should survive eviction')
+            self.assertIsNone(cache.get(media[1]), 'Expected oldest entry evicted')
+            cache.purge()
+            self.assertIsNone(cache.get(media[0]), 'Expected empty cache after purge')
+            cache.close()
+
+            # probes still finishing after an early exit find the cache closed and gone, instead of failing on it
+            class SlowProcessor(Processor):
+                def fetch_details(self, _path: str) -> MediaInfo:
+                    time.sleep(0.2 if _path != media[0] else 0)
+                    return TranscoderTests.make_media(_path, 'h264', 1920, 1080, 60, 1000, 24, None, [], [])
+
+            probe = MediaProbe(workers=3, cache=ProbeCache(os.path.join(tmpdir, 'cache.db')))
+            late = Future()
+            late.set_result((TranscoderTests.make_media(media[1], 'h264', 1920, 1080, 60, 1000, 24, None, [], []), 1.0))
+            failed = []
+            close_cache = ProbeCache.close
+
+            def store():
+                try:
+                    probe._store(media[1], late)
+                except Exception as ex:
+                    failed.append(ex)
+
+            def close(cache):
+                close_cache(cache)
+                # a process pool callback coming in right as the cache is closed
+                callback = threading.Thread(target=store)
+                callback.start()
+                callback.join(timeout=0.5)
+                callbacks.append(callback)
+
+            callbacks = []
+            with mock.patch.object(ProbeCache, 'close', close):
+                results = probe.fetch_all([(SlowProcessor('/usr/bin/ffmpeg'), path) for path in media])
+                next(results)
+                results.close()
+            callbacks[0].join()
+            self.assertEqual([], failed)
+            self.assertIsNone(probe.cache)
+            self.assertIsNotNone(probe.fetch(SlowProcessor('/usr/bin/ffmpeg'), media[2]))
+
+    def test_jobqueue_streaming(self):
+        queue = JobQueue()
+        taken = []
+
+        def consumer():
+            while True:
+                job = queue.get()
+                if job is None:
+                    break
+                taken.append(job)
+                queue.task_done()
+
+        worker = threading.Thread(target=consumer, daemon=True)
+        worker.start()
+        for i in range(3):
+            queue.put(i)
+        queue.join()
+        self.assertEqual(taken, [0, 1, 2], 'Expected jobs consumed while queue still open')
+        self.assertTrue(worker.is_alive(), 'Worker should wait for more jobs until closed')
+        queue.close()
+        worker.join(timeout=5)
+        self.assertFalse(worker.is_alive(), 'Worker should stop once queue closed')
+
+    def test_jobqueue_order(self):
+        class Job:
+            def __init__(self, name, work, priority=0):
+                self.name = name
+                self.work = work
+                self.priority = priority
+
+        jobs = [Job('short', 10), Job('long', 1000, priority=-1), Job('medium', 100, priority=5), Job('tie', 100)]
+        expected = {'fifo': ['short', 'long', 'medium', 'tie'],
+                    'longest': ['long', 'medium', 'tie', 'short'],
+                    'shortest': ['short', 'medium', 'tie', 'long'],
+                    'priority': ['medium', 'short', 'tie', 'long']}
+        for order in JOB_ORDERS:
+            queue = JobQueue(job_order(order))
+            for job in jobs:
+                queue.put(job)
+            if order != 'fifo':
+                self.assertIsNone(queue.get(timeout=0.1), 'Ordered queue should hold jobs until closed')
+            queue.close()
+            taken = [queue.get().name for _ in jobs]
+            self.assertEqual(taken, expected[order], f'Wrong order for {order}')
+            self.assertIsNone(queue.get(), 'Expected closed queue to be drained')
+
+        config = ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg', 'queue_order': 'longest'}, 'profiles': {},
+                             'rules': {'big': {'profile': 'hevc', 'priority': 3}}})
+        self.assertEqual(config.queue_order, 'longest')
+        self.assertEqual(config.rules['big'].priority, 3)
+
+    def test_jobqueue_stealing(self):
+        qsv, cuda = JobQueue(), JobQueue()
+        JobQueue.link([qsv, cuda])
+        worker = StealingQueue(qsv, [cuda], lambda job: 'qsv' in job[1])
+        taken = []
+
+        def consumer():
+            while True:
+                job = worker.get()
+                if job is None:
+                    break
+                taken.append(job[0])
+                worker.task_done()
+
+        thread = threading.Thread(target=consumer, daemon=True)
+        thread.start()
+        cuda.put(('pinned', []))
+        cuda.put(('shared', ['qsv']))
+        qsv.put(('own', []))
+        qsv.join()
+        cuda.put(('late', ['qsv']))
+        time.sleep(0.2)
+        self.assertEqual(cuda.qsize(), 1, 'Expected only the job without fallback left behind')
+        qsv.close()
+        cuda.close()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive(), 'Worker should stop once all queues are closed')
+        self.assertEqual(sorted(taken), ['late', 'own', 'shared'])
+        self.assertEqual(cuda.get(block=False), ('pinned', []))
+
+        # an idle worker is only woken for jobs it may take, and looks no further into a queue than it has to
+        qsv, cuda = JobQueue(), JobQueue()
+        JobQueue.link([qsv, cuda])
+        checked = []
+
+        def eligible(job):
+            checked.append(job)
+            return 'qsv' in job[1]
+
+        worker = StealingQueue(qsv, [cuda], eligible)
+        thread = threading.Thread(target=consumer, daemon=True)
+        taken.clear()
+        thread.start()
+        time.sleep(0.1)
+        for i in range(50):
+            cuda.put((f'pinned{i}', []))
+            time.sleep(0.005)
+        cuda.put(('shared', ['qsv']))
+        qsv.join()
+        time.sleep(0.1)
+        self.assertEqual(['shared'], taken)
+        self.assertLess(len(checked), 5 * 51, 'Expected no rescans of the other queue on every put')
+        qsv.close()
+        cuda.close()
+        thread.join(timeout=5)
+
+        heap = []
+        for entry in [(5, 0, 'e'), (1, 1, 'a'), (3, 2, 'c'), (2, 3, 'b'), (4, 4, 'd')]:
+            heapq.heappush(heap, entry)
+        self.assertEqual(['a', 'b', 'c', 'd', 'e'], [entry[2] for entry in in_order(heap)])
+
+    def test_resource_pool(self):
+        pool = ResourcePool({'nvenc': 2, 'cpu_heavy': 1})
+        both = {'nvenc': 1, 'cpu_heavy': 1}
+        self.assertTrue(pool.acquire(both))
+        self.assertFalse(pool.acquire(both, timeout=0.1), 'Expected to wait while a token is taken')
+        self.assertTrue(pool.acquire({'nvenc': 1}, timeout=0.1))
+        self.assertEqual(pool.available, {'nvenc': 0, 'cpu_heavy': 0})
+
+        claim = pool.claim(both)
+        waiter = threading.Thread(target=claim.acquire, daemon=True)
+        waiter.start()
+        pool.release({'nvenc': 1})
+        time.sleep(0.1)
+        self.assertTrue(waiter.is_alive(), 'Claim should not take some tokens while waiting for others')
+        self.assertEqual(pool.available['nvenc'], 1)
+        pool.release(both)
+        waiter.join(timeout=5)
+        self.assertTrue(claim.held)
+        claim.release()
+        claim.release()
+        self.assertEqual(pool.available, pool.limits)
+        self.assertIsNone(pool.claim(dict()), 'Nothing to claim without needs')
+
+        setup = {'config': {'ffmpeg': '/usr/bin/ffmpeg', 'resources': {'nvenc': 2}},
+                 'profiles': {'cuda': {'resources': ['nvenc']}}, 'rules': {}}
+        config = ConfigFile(setup)
+        self.assertEqual(config.get_profile('cuda').resources, {'nvenc': 1})
+        self.assertEqual(config.resource_pool.limits, {'nvenc': 2})
+        setup['profiles']['cuda']['resources'] = {'nvenc': 3}
+        with mock.patch('builtins.print'), self.assertRaises(SystemExit):
+            ConfigFile(setup)
+
+    def test_admission_control(self):
+        control = AdmissionControl(max_load=4, min_memory=1024, min_disk=10, interval=0.05)
+        with tempfile.TemporaryDirectory() as tmpdir, mock.patch('builtins.print') as printed, \
+                mock.patch('pytranscoder.admission.available_memory_mb', return_value=4096), \
+                mock.patch('pytranscoder.admission.load_average', side_effect=[6.5, 5.0, 2.0, 2.0, 2.0]):
+            started = time.monotonic()
+            control.admit(tmpdir)
+            self.assertGreaterEqual(time.monotonic() - started, 0.1, 'Expected to wait while load is high')
+            self.assertIsNone(control.paused)
+            self.assertEqual(2, printed.call_count, 'Expected one pause and one resume message')
+            self.assertIn('load 6.5', str(printed.call_args_list[0]))
+            self.assertTrue(control.check(tmpdir))
+
+            with mock.patch('pytranscoder.admission.available_memory_mb', return_value=512):
+                self.assertIn('memory', control.pressure(tmpdir))
+            self.assertIn('free on', AdmissionControl(min_disk=2 ** 40).pressure(tmpdir))
+
+        # slots held back start one per interval once there is room again, not all at once
+        control = AdmissionControl(max_load=4, interval=0.2)
+        load = [6.0]
+        admitted = []
+
+        def slot():
+            control.admit('.')
+            admitted.append(time.monotonic())
+
+        with mock.patch('builtins.print'), mock.patch('pytranscoder.admission.load_average', lambda: load[0]):
+            slots = [threading.Thread(target=slot) for _ in range(3)]
+            for thread in slots:
+                thread.start()
+            time.sleep(0.1)
+            load[0] = 1.0
+            for thread in slots:
+                thread.join()
+        admitted.sort()
+        self.assertEqual(3, len(admitted))
+        for earlier, later in zip(admitted, admitted[1:]):
+            self.assertGreaterEqual(later - earlier, 0.19, 'Expected one start per interval')
+
+        self.assertIsNone(AdmissionControl.from_config({'interval': 5}), 'Nothing to check without limits')
+        with mock.patch('builtins.print'), self.assertRaises(SystemExit):
+            AdmissionControl.from_config({'max_laod': 4})
+
+    @unittest.skipIf(os.name == 'nt', 'needs a posix shell')
+    def test_ssh_pool(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # stand-in for ssh that plays along with the control socket commands
+            calls = os.path.join(tmpdir, 'calls')
+            fake = os.path.join(tmpdir, 'ssh')
+            with open(fake, 'w') as f:
+                f.write('#!/bin/sh\n'
+                        f'echo "$@" >> {calls}\n'
+                        'for a in "$@"; do case "$a" in ControlPath=*) cp="${a#ControlPath=}";; esac; done\n'
+                        'case "$*" in *"-O check"*) [ -e "$cp" ]; exit $?;; *"-O exit"*) rm -f "$cp"; exit 0;; esac\n'
+                        'case "$*" in *" -N "*) touch "$cp";; esac\n')
+            os.chmod(fake, 0o755)
+
+            plain = SshPool(fake).get('me', '10.0.0.1')
+            self.assertEqual([fake, 'me@10.0.0.1'], plain.command(), 'Expected plain ssh without multiplexing')
+
+            pool = SshPool(fake, multiplex=True)
+            connection = pool.get('me', '10.0.0.2')
+            self.assertIs(connection, pool.get('me', '10.0.0.2'), 'Expected one connection per host')
+            cli = connection.command('-v')
+            self.assertIn(f'ControlPath={connection.control_path}', cli)
+            self.assertEqual(['-v', 'me@10.0.0.2'], [cli[1], cli[-1]])
+            self.assertTrue(connection.alive(), 'Expected a master started on first use')
+            connection.scp('/tmp/a', connection.remote('/work'))
+            with open(calls) as f:
+                self.assertEqual(1, sum(1 for line in f if ' -N ' in line), 'Master should be reused')
+
+            os.remove(connection.control_path)      # master went away
+            with mock.patch.object(SshConnection, 'CHECK_INTERVAL', 0):
+                connection.command()
+            self.assertTrue(connection.alive(), 'Expected the dead master replaced')
+            control_dir = pool.control_dir
+            pool.close()
+            self.assertFalse(os.path.exists(control_dir), 'Expected sockets cleaned up')
+
+            # a host the master can't be started for gets plain ssh for a while, without trying on every command
+            failing = os.path.join(tmpdir, 'failing-ssh')
+            with open(failing, 'w') as f:
+                f.write('#!/bin/sh\n'
+                        f'echo "$@" >> {calls}\n'
+                        'case "$*" in *" -N "*) exit 255;; esac\n')
+            os.chmod(failing, 0o755)
+            os.remove(calls)
+            pool = SshPool(failing, multiplex=True)
+            connection = pool.get('me', '10.0.0.3')
+            for _ in range(3):
+                self.assertEqual([failing, 'me@10.0.0.3'], connection.command())
+            with open(calls) as f:
+                self.assertEqual(1, sum(1 for line in f if ' -N ' in line), 'Expected one attempt per interval')
+            with mock.patch.object(SshConnection, 'CHECK_INTERVAL', 0):
+                connection.command()
+            with open(calls) as f:
+                self.assertEqual(2, sum(1 for line in f if ' -N ' in line), 'Expected another attempt later')
+            pool.close()
+
+    def test_prefetcher(self):
+        queue = JobQueue()
+        staged = []
+        room = threading.Event()
+
+        def stage(job):
+            staged.append(job)
+            return job != 'bad'
+
+        slot = Prefetcher(queue, stage, depth=1, room=lambda job: job != 'big' or room.is_set(), wait=0.05)
+        for job in ('a', 'bad', 'b', 'big', 'c'):
+            queue.put(job)
+        queue.close()
+
+        self.assertEqual(slot.get(), 'a')
+        time.sleep(0.2)
+        self.assertEqual(staged, ['a', 'bad', 'b'], 'Expected one job staged ahead, failed ones dropped')
+        self.assertEqual(slot.get(), 'b')
+        slot.task_done()
+        time.sleep(0.2)
+        self.assertEqual(staged, ['a', 'bad', 'b'], 'Expected staging to wait for room while a job runs')
+        room.set()
+        slot.task_done()
+        self.assertEqual(slot.get(), 'big')
+        slot.task_done()
+        self.assertEqual(slot.get(), 'c')
+        slot.task_done()
+        self.assertIsNone(slot.get())
+        queue.join()
+
+        # a job wrapped up in the background still takes up room until it is finished
+        queue = JobQueue()
+        staged.clear()
+        slot = Prefetcher(queue, stage, depth=1, room=lambda job: job != 'big', wait=0.05)
+        for job in ('a', 'big'):
+            queue.put(job)
+        queue.close()
+        self.assertEqual(slot.get(), 'a')
+        slot.finishing()
+        slot.task_done()
+        time.sleep(0.2)
+        self.assertEqual(staged, ['a'], 'Expected staging to wait while results are retrieved')
+        slot.finished()
+        self.assertEqual(slot.get(), 'big')
+        slot.task_done()
+        self.assertIsNone(slot.get())
+
+    def test_pipe_options(self):
+        self.assertEqual(pipe_output_options(['-c:v', 'hevc'], '.mkv'), ['-f', 'matroska'])
+        self.assertEqual(pipe_output_options(['-f', 'mpegts', '-c:v', 'hevc'], '.mp4'), [])
+        self.assertEqual(pipe_output_options(['-c:v', 'hevc'], '.MP4'), ['-f', 'mp4', '-movflags',
+                                                                         'frag_keyframe+empty_moov+default_base_moof'])
+        self.assertIsNone(pipe_output_options(['-movflags', '+faststart'], '.mp4'), 'faststart needs a seekable output')
+        self.assertIsNone(pipe_output_options([], '.avi'))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def mp4(name, *boxes):
+                path = os.path.join(tmpdir, name)
+                with open(path, 'wb') as f:
+                    for kind, body in boxes:
+                        f.write((8 + len(body)).to_bytes(4, 'big') + kind + body)
+                return path
+
+            self.assertTrue(streamable_source(mp4('fast.mp4', (b'ftyp', b'isom'), (b'moov', b'x' * 20), (b'mdat', b'y'))))
+            self.assertFalse(streamable_source(mp4('slow.mp4', (b'ftyp', b'isom'), (b'mdat', b'y'), (b'moov', b'x'))))
+            self.assertFalse(streamable_source(os.path.join(tmpdir, 'missing.mov')))
+            self.assertTrue(streamable_source(os.path.join(tmpdir, 'any.mkv')))
+
+    def test_resumable_transfer(self):
+        bandwidth = Bandwidth(1)
+        started = time.monotonic()
+        for _ in range(3):
+            bandwidth.take(256 * 1024)
+        self.assertGreaterEqual(time.monotonic() - started, 0.45, 'Expected the rate capped to 1 MB/s')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # stand-in for ssh running the remote command right here
+            fake = os.path.join(tmpdir, 'ssh')
+            with open(fake, 'w') as f:
+                f.write('#!/bin/sh\nshift\nexec sh -c "$1"\n')
+            os.chmod(fake, 0o755)
+            transfer = ResumableTransfer(SshPool(fake).get('me', '10.0.0.1'))
+
+            source, remote, local = (os.path.join(tmpdir, name) for name in ('source.mkv', 'remote.mkv', 'local.mkv'))
+            data = os.urandom(3 * 1024 * 1024 + 17)
+            with open(source, 'wb') as f:
+                f.write(data)
+            with open(remote + '.part', 'wb') as f:
+                f.write(data[:1000000])          # left by a dropped connection
+            self.assertEqual(transfer.upload(source, remote)[0], 0)
+            with open(remote, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertFalse(os.path.exists(remote + '.part'))
+            self.assertEqual(transfer.upload(source, remote), (0, 'already present'))
+
+            # a new copy reads the source once, checksumming it while sending
+            fresh = os.path.join(tmpdir, 'fresh.mkv')
+            with mock.patch('pytranscoder.transfer.file_checksum') as full:
+                self.assertEqual(transfer.upload(source, fresh)[0], 0)
+            full.assert_not_called()
+            with open(fresh, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            os.remove(fresh)
+            with open(fresh + '.part', 'wb') as f:
+                f.write(b'garbage')              # resumed from, but caught by the checksum and copied again
+            self.assertEqual(transfer.upload(source, fresh)[0], 0)
+            with open(fresh, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+            with open(local + '.part', 'wb') as f:
+                f.write(b'garbage')              # corrupted, to be copied again
+            self.assertEqual(transfer.download(remote, local)[0], 0)
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), data)
+            self.assertEqual(transfer.download(os.path.join(tmpdir, 'missing'), local)[0], 1)
+
+    def test_agent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # stand-in for ffmpeg writing -progress blocks
+            encoder = os.path.join(tmpdir, 'ffmpeg')
+            with open(encoder, 'w') as f:
+                f.write(f'#!{sys.executable}\n'
+                        'import sys, time\n'
+                        'sys.stderr.write("console\\n")\n'
+                        'for i in range(1, 4):\n'
+                        '    print(f"frame={i}\\nfps=25.0\\ntotal_size={i * 1000}\\nout_time_us={i * 1000000}\\n'
+                        'speed=2.0x\\nprogress=continue", flush=True)\n'
+                        '    time.sleep(0.05)\n'
+                        'print("progress=end", flush=True)\n')
+            os.chmod(encoder, 0o755)
+
+            # the agent run over a local pipe instead of ssh
+            client = AgentClient([sys.executable, '-u', agent.__file__])
+            first = client.run(['sh', '-c', 'sleep 0.2; echo one; exit 3'])
+            second = client.run(['sh', '-c', 'echo two'])
+            self.assertEqual([r['event'] for r in second], ['started', 'output', 'exit'])
+            records = list(first)
+            self.assertEqual(records[1]['line'], 'one\n')
+            self.assertEqual(records[-1]['code'], 3, 'Expected both jobs run at once over one agent')
+
+            ffmpeg = FFmpeg(encoder)
+            ffmpeg.monitor_interval = 0
+            stats = []
+            self.assertEqual(ffmpeg.run_agent(client, ['-i', 'in.mkv', 'out.mkv'], lambda s: stats.append(s)), 0)
+            self.assertEqual([s['time'] for s in stats], [1, 2, 3])
+            self.assertEqual(stats[0]['speed'], '2.0')
+            self.assertIsNone(ffmpeg.run_agent(client, ['-i', 'in.mkv', 'out.mkv'], lambda s: True),
+                              'Expected the job killed when vetoed')
+
+            lost = client.run(['sleep', '10'])
+            self.assertEqual(lost.records.get(timeout=5)['event'], 'started')
+            client.proc.kill()                  # connection lost
+            client.proc.wait()
+            self.assertEqual(list(client.run(['true']))[-1]['code'], 0, 'Expected a new agent started')
+            self.assertEqual(lost.records.get(timeout=5), {'id': lost.id, 'event': 'exit', 'code': 255},
+                             'Expected the job of the lost agent ended')
+            client.close()
+            self.assertIsNone(client.proc)
+
+    def test_supervisor_engine(self):
+        queue = JobQueue()
+        status = 'frame=  307 fps= 86 q=-0.0 size=    3481kB time=00:00:13.03 bitrate=2187.9kbits/s speed=3.67x\\r'
+        scripts = {'ok': f'printf "{status}{status}"',
+                   'veto': f'printf "{status}{status}"; exec sleep 5',
+                   'fail': 'exit 3'}
+        results = dict()
+        reported = list()
+        callers = set()
+
+        class Worker:
+            def __init__(self):
+                self.queue = queue
+
+            def log(self, *args):
+                pass
+
+            def prepare(self, job):
+                ffmpeg = FFmpeg('/bin/sh')
+                ffmpeg.monitor_interval = 0
+
+                def callback(stats):
+                    reported.append((job, stats['size']))
+                    callers.add(threading.current_thread().name)
+                    return job == 'veto'
+
+                def finish(code, elapsed):
+                    results[job] = code
+                return Encode(ffmpeg, ['-c', scripts[job]], callback, finish)
+
+        for job in scripts:
+            queue.put(job)
+        queue.close()
+        started = time.time()
+        Supervisor().run([Worker(), Worker(), Worker()])
+        self.assertLess(time.time() - started, 4, 'vetoed encode should be killed')
+        self.assertEqual({'ok': 0, 'veto': None, 'fail': 3}, results)
+        self.assertEqual([('ok', 3481 * 1024)] * 2, [r for r in reported if r[0] == 'ok'])
+        self.assertIn(('veto', 3481 * 1024), reported)
+        self.assertEqual({'supervisor-callbacks_0'}, callers, 'Expected callbacks kept off the event loop')
+        if (3, 9) <= sys.version_info < (3, 12) and hasattr(os, 'pidfd_open'):
+            self.assertIsInstance(asyncio.get_event_loop_policy().get_child_watcher(), asyncio.PidfdChildWatcher)
+
+    def test_supervisor_slots(self):
+        # blocking steps like copies to streaming hosts must not queue behind each other, however many slots
+        queue = JobQueue()
+        prepared = list()
+
+        class Worker:
+            def __init__(self):
+                self.queue = queue
+
+            def log(self, *args):
+                pass
+
+            def prepare(self, job):
+                time.sleep(0.3)
+                prepared.append(threading.current_thread().name)
+
+        slots = Supervisor.THREADS * 2
+        for job in range(slots):
+            queue.put(job)
+        queue.close()
+        started = time.time()
+        Supervisor().run([Worker() for _ in range(slots)])
+        self.assertLess(time.time() - started, 1.2, 'slots should share a pool of THREADS threads')
+        self.assertEqual(slots, len(prepared))
+        self.assertEqual(Supervisor.THREADS, len(set(prepared)), 'Expected the pool bounded')
+
+        with mock.patch('pytranscoder.config.sys.version_info', (3, 7, 9)), \
+                mock.patch('builtins.print'), self.assertRaises(SystemExit):
+            ConfigFile({'config': {'ffmpeg': '/usr/bin/ffmpeg', 'engine': 'asyncio'}, 'profiles': {}, 'rules': {}})
+
+    def test_supervisor_agent(self):
+        queue = JobQueue()
+        client = AgentClient([sys.executable, '-u', agent.__file__])
+        scripts = {f'ok{i}': 'echo done; sleep 0.5' for i in range(6)}
+        scripts['veto'] = 'echo done; exec sleep 5'
+        results = dict()
+
+        class Worker:
+            def __init__(self):
+                self.queue = queue
+
+            def log(self, *args):
+                pass
+
+            def prepare(self, job):
+                processor = Processor('/bin/sh')
+                parser = mock.Mock(logged=False)
+                parser.feed.side_effect = lambda line: {'line': line}
+
+                def finish(code, elapsed):
+                    results[job] = code
+                processor.prepare_agent = lambda params: (params, parser, False)
+                return Encode(processor, ['-c', scripts[job]], lambda stats: job == 'veto', finish, agent=client)
+
+        for job in scripts:
+            queue.put(job)
+        queue.close()
+        started = time.time()
+        Supervisor().run([Worker() for _ in scripts])
+        client.close()
+        self.assertLess(time.time() - started, 3, 'Expected agent encodes run side by side and the vetoed one killed')
+        self.assertEqual({**{job: 0 for job in scripts}, 'veto': None}, results)
+
+    def test_status_board(self):
+        board = StatusBoard()
+        out = io.StringIO()
+        renderer = StatusRenderer(board, threading.Lock(), show_host=True, stream=out)
+        for done in range(0, 100, 10):
+            board.put({'host': 'h1', 'file': 'a.mp4', 'speed': '2.1', 'comp': 5, 'done': done})
+        board.put({'host': 'h2', 'file': 'b.mp4', 'speed': '1.0', 'comp': 0, 'done': 1})
+        self.assertEqual(2, len(board), 'Expected only latest report per host and file')
+        renderer.render()
+        self.assertEqual(['h1                  |a.mp4: speed: 2.1x, comp: 5%, done:  90%',
+                          'h2                  |b.mp4: speed: 1.0x, comp: 0%, done:   1%'], out.getvalue().splitlines())
+
+        # only changes are printed after that
+        out.truncate(0)
+        out.seek(0)
+        renderer.render()
+        board.put({'host': 'h2', 'file': 'b.mp4', 'speed': '1.0', 'comp': 0, 'done': 2})
+        board.remove('h1', 'a.mp4')
+        renderer.render()
+        self.assertEqual(['h2                  |b.mp4: speed: 1.0x, comp: 0%, done:   2%'], out.getvalue().splitlines())
+
+    def test_status_table_redraw(self):
+        class Terminal(io.StringIO):
+            def isatty(self):
+                return True
+
+        board = StatusBoard()
+        out = Terminal()
+        renderer = StatusRenderer(board, threading.Lock(), stream=out, interval=60)
+        renderer.start()
+        board.put({'host': 'local', 'file': 'a.mp4', 'speed': '2.1', 'comp': 5, 'done': 10})
+        renderer.render()
+        board.put({'host': 'local', 'file': 'a.mp4', 'speed': '2.1', 'comp': 5, 'done': 20})
+        renderer.render()
+        board.remove('local', 'a.mp4')
+        renderer.stop()
+        table = 'file    speed   comp   done\n'
+        self.assertEqual(table + 'a.mp4    2.1x     5%    10%\n' +
+                         '\x1b[2F\x1b[J' + table + 'a.mp4    2.1x     5%    20%\n' +
+                         '\x1b[2F\x1b[J', out.getvalue())
+
+    def test_phase_timings(self):
+        timings = Timings()
+        for i in range(1, 11):
+            timings.record(f'/media/{i}.mp4', 'encode', float(i))
+            timings.record(f'/media/{i}.mp4', 'probe', 0.5)
+        with timings.measure('/media/1.mp4', 'move'):
+            pass
+        timings.record('/media/1.mp4', 'probe', 0.25)
+
+        summary = timings.summary()
+        self.assertEqual(['probe', 'encode', 'move'], list(summary.keys()), 'Expected phases in job order')
+        self.assertEqual(10, summary['encode']['count'])
+        self.assertEqual(55.0, summary['encode']['total'])
+        self.assertEqual(5.0, summary['encode']['p50'])
+        self.assertEqual(9.0, summary['encode']['p90'])
+        self.assertEqual(10.0, summary['encode']['max'])
+        self.assertEqual(0.75, summary['probe']['max'], 'Expected repeated phases of a job to add up')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'timings.json')
+            timings.save(path)
+            with open(path) as f:
+                saved = json.load(f)
+        self.assertEqual(3.0, saved['jobs']['/media/3.mp4']['encode'])
+        self.assertEqual(summary['encode'], saved['summary']['encode'])
+
+    def test_metrics(self):
+        events = JobEvents()
+        metrics = Metrics()
+        events.listen(metrics)
+        timings = Timings(events)
+        for name in ['a', 'b', 'c']:
+            events.emit('queued', path=f'/media/{name}.mp4', queue='q1')
+        for name in ['a', 'b']:
+            events.emit('dispatched', path=f'/media/{name}.mp4', queue='q1', host='box')
+            events.emit('started', path=f'/media/{name}.mp4', queue='q1', host='box')
+            events.emit('progress', path=f'/media/{name}.mp4', host='box', fps='30.5', speed='1.5')
+        events.emit('finished', path='/media/a.mp4', queue='q1', host='box', size_in=1000, size_out=250)
+        timings.record('/media/a.mp4', 'encode', 42.0)
+
+        text = metrics.render()
+        self.assertIn('pytranscoder_jobs_queued{queue="q1"} 1\n', text)
+        self.assertIn('pytranscoder_jobs_running{host="box",queue="q1"} 1\n', text)
+        self.assertIn('pytranscoder_jobs_completed_total{host="box",queue="q1"} 1\n', text)
+        self.assertIn('pytranscoder_jobs_failed_total{host="box",queue="q1"} 0\n', text)
+        self.assertIn('pytranscoder_encode_fps{host="box"} 30.5\n', text, 'Expected rates of finished jobs dropped')
+        self.assertIn('pytranscoder_compression_ratio{host="box"} 0.2500\n', text)
+        self.assertIn('pytranscoder_phase_seconds_bucket{phase="encode",le="15"} 0\n', text)
+        self.assertIn('pytranscoder_phase_seconds_bucket{phase="encode",le="60"} 1\n', text)
+        self.assertIn('pytranscoder_phase_seconds_count{phase="encode"} 1\n', text)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'pytranscoder.prom')
+            exporter = MetricsExporter(metrics, path=path)
+            exporter.start()
+            exporter.stop()
+            with open(path) as f:
+                text = f.read()
+            self.assertIn('pytranscoder_jobs_queued{queue="q1"} 1', text)
+            self.assertIn('# TYPE pytranscoder_last_update_seconds gauge\npytranscoder_last_update_seconds ', text)
+            self.assertEqual(['pytranscoder.prom'], os.listdir(tmpdir), 'Expected no temporary file left behind')
+
+    def test_journal(self):
+        events = JobEvents()
+        timings = Timings(events)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'journal.jsonl')
+            journal = Journal(path)
+            events.listen(journal)
+            timings.record('/media/a.mp4', 'probe', 0.5)
+            events.emit('probed', path='/media/a.mp4', valid=True, vcodec='h264')
+            events.emit('started', path='/media/a.mp4', queue='q1', host='box', profile='hevc', mixins=['surround'])
+            events.emit('progress', path='/media/a.mp4', host='box', fps='24', speed='1.2', done=50, comp=40)
+            timings.record('/media/a.mp4', 'encode', 60.0)
+            events.emit('aborted', path='/media/a.mp4', queue='q1', host='box', reason='threshold')
+            events.emit('matched', path='/media/b.mp4', rule='old', profile='SKIP', skip=True)
+            timings.record('/media/d.mp4', 'probe', 0.5)
+            events.emit('planned', path='/media/d.mp4', queue='q1', host='local', profile='hevc', mixins=None)
+            journal.close()
+            events.emit('queued', path='/media/c.mp4', queue='q1')
+
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual(['probed', 'started', 'progress', 'aborted', 'matched', 'planned'],
+                         [r['event'] for r in records],
+                         'Expected phase events folded into outcomes and nothing written after close')
+        aborted = records[3]
+        self.assertEqual('threshold', aborted['reason'])
+        self.assertEqual('hevc', aborted['profile'])
+        self.assertEqual(['surround'], aborted['mixins'])
+        self.assertEqual({'probe': 0.5, 'encode': 60.0}, aborted['phases'])
+        self.assertEqual({'probe': 0.5}, records[5]['phases'], 'Expected dry runs journaled with their phases')
+        self.assertEqual({}, journal.jobs, 'Expected no state kept for finished or skipped files')
+
+    def test_speed_history(self):
+        events = JobEvents()
+        timings = Timings(events)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'speeds.json')
+            history = SpeedHistory(path)
+            events.listen(history)
+            for i, seconds in enumerate([1800.0, 1200.0]):
+                media = f'/media/{i}.mkv'
+                events.emit('probed', path=media, valid=True, vcodec='h264', height=1080, runtime=3600)
+                events.emit('started', path=media, queue='q1', host='box', profile='hevc', mixins=None)
+                timings.record(media, 'encode', seconds)
+                events.emit('finished', path=media, queue='q1', host='box', size_in=10, size_out=5)
+            events.emit('probed', path='/media/x.mkv', valid=True, vcodec='h264', height=1080, runtime=3600)
+            events.emit('started', path='/media/x.mkv', queue='q1', host='box', profile='hevc', mixins=None)
+            timings.record('/media/x.mkv', 'encode', 10.0)
+            events.emit('failed', path='/media/x.mkv', queue='q1', host='box', code=1)
+            history.save()
+
+            loaded = SpeedHistory(path)
+        self.assertEqual((2.5, 2), loaded.speed('hevc', 'h264', 1080, 'box'), 'Expected failed jobs not learned')
+        self.assertEqual(1800.0, loaded.predict('hevc', 'vc1', 1088, 4500, 'other'),
+                         'Expected fallback to other hosts and codecs of the same resolution')
+        self.assertIsNone(loaded.predict('hevc', 'h264', 2160, 3600))
+        self.assertEqual({}, history.pending)
+
+        # longest jobs first over 2 slots: [50, 20] and [40, 30], and another queue running alongside
+        self.assertEqual(70.0, makespan([('q1', 20.0), ('q1', 50.0), ('q1', 30.0), ('q1', 40.0), ('q2', 60.0)],
+                                        {'q1': 2, 'q2': 1}))
+
     @staticmethod
     def get_setup():
         setup = {
@@ -397,10 +1313,67 @@ class TranscoderTests(unittest.TestCase):
         cluster.testrun()
         for host in cluster.hosts:
             if host.hostname == 'm1' and len(host._complete) > 0:
-                filename, elapsed = host.completed.pop()
+                filename, elapsed, _ = host.completed.pop()
                 self.assertEqual('/dev/null.mp4', filename, 'Completed filename missing from assigned host')
                 break
 
+    @mock.patch.object(AgentClient, 'run')
+    @mock.patch('pytranscoder.cluster.filter_threshold')
+    @mock.patch('pytranscoder.cluster.os.rename')
+    @mock.patch('pytranscoder.cluster.os.remove')
+    @mock.patch.object(FFmpeg, 'fetch_details')
+    def test_cluster_mounted_agent(self, mock_ffmpeg_details, mock_os_rename, mock_os_remove,
+                                   mock_filter_threshold, mock_agent_run):
+        setup = self.get_setup()
+        setup['config']['clusters']['cluster1']['m1']['agent'] = True
+        setup = ConfigFile(setup)
+        mock_agent_run.return_value = iter([{'id': 1, 'event': 'exit', 'code': 0}])
+        mock_filter_threshold.return_value = True
+        info = TranscoderTests.make_media('/dev/null', 'x264', 1920, 1080, 45 * 60, 3200, 24, None, [], [])
+        mock_ffmpeg_details.return_value = info
+
+        cluster = self.setup_cluster1(setup)
+        cluster.enqueue('/volume2/my movie.mp4', None)
+        cluster.testrun()
+        cmd = mock_agent_run.call_args[0][0]
+        self.assertEqual('/usr/bin/ffmpeg', cmd[0])
+        self.assertIn('/media/my movie.mp4', cmd, 'Expected the substituted input path without shell quoting')
+        self.assertEqual('/media/my movie.mkv.tmp', cmd[-1])
+
+    @mock.patch.object(AgentClient, 'run')
+    @mock.patch.object(FFmpeg, 'fetch_details')
+    def test_cluster_journal_ends(self, mock_ffmpeg_details, mock_agent_run):
+        setup = self.get_setup()
+        setup['config']['clusters']['cluster1']['m1']['agent'] = True
+        setup = ConfigFile(setup)
+        mock_agent_run.side_effect = RuntimeError('agent exploded')
+        mock_ffmpeg_details.return_value = TranscoderTests.make_media('/dev/null', 'x264', 1920, 1080, 45 * 60,
+                                                                      3200, 24, None, [], [])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal = Journal(os.path.join(tmpdir, 'journal.jsonl'))
+            pytranscoder.job_events.listen(journal)
+            try:
+                # a dry run leaves a trace of what would have been done
+                with mock.patch('pytranscoder.dry_run', True):
+                    cluster = self.setup_cluster1(setup)
+                    cluster.enqueue('/volume2/planned.mp4', None)
+                    cluster.testrun()
+                # a job that raises ends as failed
+                cluster = self.setup_cluster1(setup)
+                cluster.enqueue('/volume2/broken.mp4', None)
+                with mock.patch('builtins.print'):
+                    cluster.testrun()
+            finally:
+                pytranscoder.job_events.unlisten(journal)
+                journal.close()
+            with open(journal.path) as f:
+                records = [json.loads(line) for line in f]
+        ends = {r['path']: r for r in records if r['event'] in ('planned', 'failed')}
+        self.assertEqual('planned', ends['/volume2/planned.mp4']['event'])
+        self.assertEqual('hevc_cuda', ends['/volume2/planned.mp4']['profile'])
+        self.assertEqual('error', ends['/volume2/broken.mp4']['reason'])
+        self.assertEqual({}, journal.jobs, 'Expected no state kept for jobs that ended either way')
+
     @staticmethod
     def setup_cluster1(config) -> Cluster:
         cluster_config = config.settings['clusters']
@@ -472,7 +1445,7 @@ class TranscoderTests(unittest.TestCase):
         cluster.testrun()
         for host in cluster.hosts:
             if host.hostname == 'm2' and len(host._complete) > 0:
-                filename, elapsed = host.completed.pop()
+                filename, elapsed, _ = host.completed.pop()
                 self.assertEqual('/dev/null.mp4', filename,
                                   'Completed filename missing from assigned host')
                 break
@@ -511,7 +1484,7 @@ class TranscoderTests(unittest.TestCase):
         for host in cluster.hosts:
             if host.hostname == 'workstation' and len(host._complete) > 0:
                 dump_stats(host._complete)
-                filename, elapsed = host.completed.pop()
+                filename, elapsed, _ = host.completed.pop()
                 self.assertEqual('/dev/null.mp4', filename, 'Completed filename missing from assigned host')
                 break
 